@@ -1,23 +1,199 @@
 import os
 import sys
 import asyncio
+import contextlib
 import hashlib
+import json
+import re
+import tempfile
+import sqlite3
+import socket
 import time
+import shutil
+import subprocess
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from urllib.parse import urlparse
-from typing import Dict, Any, Optional
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from typing import Dict, Any, Optional, Callable, Tuple, List
 from datetime import datetime
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 import yt_dlp
 
+try:
+    import numpy as np
+except ImportError:  # 可选依赖：缺失时不生成波形峰值
+    np = None
+
 PORT = int(os.environ.get("PORT", 8000))
 TEMP_DIR = Path(os.environ.get("VT_TEMP_DIR", "/tmp/video_transcriber"))
 TEMP_DIR.mkdir(parents=True, exist_ok=True)
 
+# 提取执行后端：thread（默认，asyncio.to_thread）| process（常驻进程池，绕开 GIL）
+EXTRACT_BACKEND = os.environ.get("EXTRACT_BACKEND", "thread").strip().lower()
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", os.cpu_count() or 2))
+
+# 两阶段流水线：下载并发按网络带宽设置，转码并发按 CPU 核数设置
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 8))
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", os.cpu_count() or 2))
+TRANSCODE_QUEUE_SIZE = int(os.environ.get("TRANSCODE_QUEUE_SIZE", TRANSCODE_WORKERS * 2))
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", max(1, (os.cpu_count() or 2) // TRANSCODE_WORKERS)))
+FFMPEG_NICE = int(os.environ.get("FFMPEG_NICE", 10))
+# 原始音源保留时长（秒），期间同源的其他格式/片段请求跳过下载；0 表示用完即删
+SOURCE_REUSE_SECONDS = int(os.environ.get("SOURCE_REUSE_SECONDS", 600))
+
+# mode='url' 直链解析缓存：链接本身不带过期时间时的默认 TTL（秒）与条目上限
+STREAM_URL_TTL = int(os.environ.get("STREAM_URL_TTL", 1800))
+STREAM_CACHE_SIZE = int(os.environ.get("STREAM_CACHE_SIZE", 1000))
+# 原生快速解析的平台（逗号分隔，bilibili,douyin；为空则全部走 yt-dlp）与页面/下载请求的连接、读取超时（秒）
+NATIVE_RESOLVERS = {p.strip() for p in os.environ.get("NATIVE_RESOLVERS", "bilibili,douyin").split(",") if p.strip()}
+NATIVE_TIMEOUT = float(os.environ.get("NATIVE_TIMEOUT", 15))
+
+# 短链（b23.tv、v.douyin.com 等）解析结果缓存条目上限；跳转超时（秒）
+ALIAS_CACHE_SIZE = int(os.environ.get("ALIAS_CACHE_SIZE", 10000))
+SHORT_LINK_TIMEOUT = float(os.environ.get("SHORT_LINK_TIMEOUT", 8))
+
+# 波形峰值：PCM 采样率与各缩放级别（每个峰值覆盖的采样数）
+PEAKS_ENABLED = np is not None and os.environ.get("PEAKS_ENABLED", "1") == "1"
+PEAKS_SAMPLE_RATE = int(os.environ.get("PEAKS_SAMPLE_RATE", 8000))
+PEAKS_LEVELS = sorted(int(x) for x in os.environ.get("PEAKS_LEVELS", "64,256,1024").split(","))
+# 语音输出（quality=speech）：单声道、采样率 SPEECH_SAMPLE_RATE；trim_silence 时压缩长静音：
+# 低于 SPEECH_SILENCE_DB 且长于 SPEECH_SILENCE_MIN 秒的静音压缩成短停顿（保留 SPEECH_SILENCE_KEEP 秒；
+# ffmpeg 6.1 起 silenceremove 还会额外保留 SPEECH_SILENCE_MIN 秒）
+SPEECH_SAMPLE_RATE = int(os.environ.get("SPEECH_SAMPLE_RATE", 16000))
+SPEECH_SILENCE_DB = float(os.environ.get("SPEECH_SILENCE_DB", -45))
+SPEECH_SILENCE_MIN = float(os.environ.get("SPEECH_SILENCE_MIN", 0.5))
+SPEECH_SILENCE_KEEP = float(os.environ.get("SPEECH_SILENCE_KEEP", 0.3))
+# 分段输出（segment_seconds）：按静音切分时在每段终点前 SEGMENT_SILENCE_WINDOW 秒内找最安静处下刀
+SEGMENT_SILENCE_WINDOW = float(os.environ.get("SEGMENT_SILENCE_WINDOW", 5))
+
+# 音频指纹去重：转码时用同一路 PCM 计算指纹（需要 numpy，PCM 采样率需高于 4kHz），
+# 与已有成品近似重复时直接复用，不再另存一份
+FINGERPRINT_ENABLED = (np is not None and PEAKS_SAMPLE_RATE > 4000
+                       and os.environ.get("FINGERPRINT_ENABLED", "1") == "1")
+FINGERPRINT_INDEX_PATH = os.environ.get("FINGERPRINT_INDEX_PATH", str(TEMP_DIR / "fingerprints.db"))
+# 判定为重复的最大误码率、两段音频至少重叠的比例（片段不会被当成整首）、每次比对的候选数
+FINGERPRINT_MAX_BER = float(os.environ.get("FINGERPRINT_MAX_BER", 0.3))
+FINGERPRINT_MIN_OVERLAP = float(os.environ.get("FINGERPRINT_MIN_OVERLAP", 0.9))
+FINGERPRINT_CANDIDATES = int(os.environ.get("FINGERPRINT_CANDIDATES", 20))
+FINGERPRINT_LOOKUP_MAX_MB = int(os.environ.get("FINGERPRINT_LOOKUP_MAX_MB", 50))
+
+# 作业队列：local（默认，API 进程内执行）| sqlite | 模块:类名（自定义 broker）
+JOB_QUEUE = os.environ.get("JOB_QUEUE", "local").strip()
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", str(TEMP_DIR / "jobs.db"))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 30))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+# 任务默认总时限（秒），超时自动取消并释放 worker；0 表示不限制
+TASK_TIMEOUT = float(os.environ.get("TASK_TIMEOUT", 3600))
+# 本地模式（JOB_QUEUE=local）的任务持久化：提交时与每次阶段变化时写入，重启后未完成的任务重新排队、
+# 从已下载的部分续传；已结束的任务保留 TASK_JOURNAL_RETENTION 秒供查询。TASK_JOURNAL_PATH 为空则关闭
+TASK_JOURNAL_PATH = os.environ.get("TASK_JOURNAL_PATH", str(TEMP_DIR / "tasks.db"))
+TASK_JOURNAL_RETENTION = float(os.environ.get("TASK_JOURNAL_RETENTION", 86400))
+# 关停时等待进行中任务完成的最长秒数，仍未完成的任务保留断点，下次启动后继续
+SHUTDOWN_GRACE_SECONDS = float(os.environ.get("SHUTDOWN_GRACE_SECONDS", 20))
+# 失败重试：按错误类别各自的重试次数与首次退避秒数（之后逐次翻倍，最长 RETRY_MAX_DELAY 秒）。
+# RETRY_POLICY=类别=次数:秒 覆盖默认值，如 RETRY_POLICY=rate_limit=5:120,geo=0
+_RETRY_DEFAULTS = "network=3:10,rate_limit=3:60,geo=1:5,auth=1:60,unavailable=0:0,permanent=0:0"
+RETRY_POLICY = {
+    cls.strip(): (int(count or 0), float(delay or 0))
+    for cls, _, spec in (item.partition('=') for item in
+                         f"{_RETRY_DEFAULTS},{os.environ.get('RETRY_POLICY', '')}".split(',') if item.strip())
+    for count, _, delay in [spec.partition(':')]
+}
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 900))
+# yt-dlp 内部的重试次数：只覆盖瞬时抖动，更长的退避交给任务级重试（重新排队，等待期间不占 worker）
+YDL_RETRIES = int(os.environ.get("YDL_RETRIES", 1))
+# 客户端 API Key：API_KEYS=名称:密钥[:权重[:并发[:每分钟提交数]]]，逗号分隔，如 app:k_abc:3:4:120,batch:k_def:1:2:30；
+# 请求头 X-API-Key 或 Authorization: Bearer 传入。未带 Key 的请求归为 anonymous（API_KEY_REQUIRED=1 时拒绝），
+# 并发与速率取 API_DEFAULT_CONCURRENCY / API_DEFAULT_RATE。并发、速率为 0 表示不限制
+API_KEYS = {
+    parts[1]: {
+        'name': parts[0],
+        'weight': float(parts[2]) if len(parts) > 2 and parts[2] else 1.0,
+        'concurrency': int(parts[3]) if len(parts) > 3 and parts[3] else 0,
+        'rate': float(parts[4]) if len(parts) > 4 and parts[4] else 0.0,
+    }
+    for parts in (item.strip().split(':') for item in os.environ.get("API_KEYS", "").split(',') if item.strip())
+}
+API_KEY_REQUIRED = os.environ.get("API_KEY_REQUIRED", "0") == "1"
+API_DEFAULT_CONCURRENCY = int(os.environ.get("API_DEFAULT_CONCURRENCY", 0))
+API_DEFAULT_RATE = float(os.environ.get("API_DEFAULT_RATE", 0))
+# 下载槽位调度：预计时长未知时按 SCHED_DEFAULT_COST 秒计；排队每等 1 秒，预计时长折减 SCHED_AGING 秒，长任务不会饿死；
+# SCHED_PROBE=1 时为排队中、时长未知的任务先解析一次时长（并发 SCHED_PROBE_CONCURRENCY）；
+# 分布式模式下每次领取从最早的 SCHED_CLAIM_WINDOW 个待领取任务中挑选
+SCHED_DEFAULT_COST = float(os.environ.get("SCHED_DEFAULT_COST", 600))
+SCHED_AGING = float(os.environ.get("SCHED_AGING", 1))
+SCHED_PROBE = os.environ.get("SCHED_PROBE", "1") == "1"
+SCHED_PROBE_CONCURRENCY = int(os.environ.get("SCHED_PROBE_CONCURRENCY", 2))
+SCHED_CLAIM_WINDOW = int(os.environ.get("SCHED_CLAIM_WINDOW", 200))
+# 下载前预检：时长（秒）与预估下载量（MB）上限，0 表示不限制；
+# 超限时 PREFLIGHT_ACTION=reject（拒绝）| clip（只取开头一段）| downgrade（改用最低码率音轨、成品按 normal 音质）
+MAX_DURATION = float(os.environ.get("MAX_DURATION", 14400))
+MAX_DOWNLOAD_MB = int(os.environ.get("MAX_DOWNLOAD_MB", 2048))
+PREFLIGHT_ACTION = os.environ.get("PREFLIGHT_ACTION", "reject").strip().lower()
+# clip 时能保留的长度（秒）不足此值则不截取，按超限拒绝
+PREFLIGHT_MIN_CLIP = float(os.environ.get("PREFLIGHT_MIN_CLIP", 1))
+# 估算转码耗时用的转码速度（相对实时的倍数）
+TRANSCODE_SPEED = float(os.environ.get("TRANSCODE_SPEED", 100))
+
+# 按平台自适应限流的默认值：每秒请求数、突发量、最大并发；冷却时间（秒）
+THROTTLE_RATE = float(os.environ.get("THROTTLE_RATE", 2))
+THROTTLE_BURST = int(os.environ.get("THROTTLE_BURST", 5))
+THROTTLE_CONCURRENCY = int(os.environ.get("THROTTLE_CONCURRENCY", 4))
+THROTTLE_COOLDOWN = float(os.environ.get("THROTTLE_COOLDOWN", 15))
+THROTTLE_MAX_COOLDOWN = float(os.environ.get("THROTTLE_MAX_COOLDOWN", 600))
+
+# 代理池：YDL_PROXIES（逗号分隔）优先，否则退回单个 YDL_PROXY
+PROXY_LIST = [p.strip() for p in (os.environ.get("YDL_PROXIES") or os.environ.get("YDL_PROXY") or "").split(",") if p.strip()]
+PROXY_MAX_FAILURES = int(os.environ.get("PROXY_MAX_FAILURES", 3))
+PROXY_QUARANTINE_SECONDS = int(os.environ.get("PROXY_QUARANTINE_SECONDS", 300))
+PROXY_CHECK_INTERVAL = int(os.environ.get("PROXY_CHECK_INTERVAL", 60))
+PROXY_CHECK_URL = os.environ.get("PROXY_CHECK_URL", "")
+
+# 状态推送：长轮询最长等待、SSE 保活注释间隔、分布式模式下轮询共享队列的间隔（秒）
+STATUS_MAX_WAIT = float(os.environ.get("STATUS_MAX_WAIT", 60))
+SSE_KEEPALIVE = float(os.environ.get("SSE_KEEPALIVE", 15))
+STATUS_QUEUE_POLL = float(os.environ.get("STATUS_QUEUE_POLL", 1))
+
+# 完成回调：签名密钥、持久化重试队列、并发上限、单次超时与退避（秒）
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_PATH = os.environ.get("WEBHOOK_QUEUE_PATH", str(TEMP_DIR / "webhooks.db"))
+WEBHOOK_CONCURRENCY = int(os.environ.get("WEBHOOK_CONCURRENCY", 4))
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", 10))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", 8))
+WEBHOOK_BACKOFF_BASE = float(os.environ.get("WEBHOOK_BACKOFF_BASE", 5))
+WEBHOOK_BACKOFF_MAX = float(os.environ.get("WEBHOOK_BACKOFF_MAX", 3600))
+# 成品存储：local（默认，TEMP_DIR）| s3（S3 兼容对象存储）| 模块:类名
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local").strip()
+S3_BUCKET = os.environ.get("S3_BUCKET", "")
+S3_PREFIX = os.environ.get("S3_PREFIX", "audio/")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+S3_REGION = os.environ.get("S3_REGION") or None
+# 分片大小（S3 要求除最后一片外不小于 5MB）、预签名链接有效期（秒）、对象存储模式下本地缓存上限（MB）
+STORAGE_PART_SIZE = max(5 << 20, int(os.environ.get("STORAGE_PART_SIZE_MB", 8)) << 20)
+STORAGE_URL_EXPIRES = int(os.environ.get("STORAGE_URL_EXPIRES", 3600))
+LOCAL_CACHE_MAX_MB = int(os.environ.get("LOCAL_CACHE_MAX_MB", 2048))
+# 本地搜索索引：曾返回过的歌曲与解析过的视频标题（SQLite FTS5）
+SEARCH_INDEX_PATH = os.environ.get("SEARCH_INDEX_PATH", str(TEMP_DIR / "search.db"))
+# /api/music/search 默认模式：upstream（每次请求上游）| local_first（本地命中足够且新鲜时直接返回）
+SEARCH_MODE = os.environ.get("SEARCH_MODE", "upstream")
+SEARCH_LOCAL_MIN_HITS = int(os.environ.get("SEARCH_LOCAL_MIN_HITS", 10))
+SEARCH_FRESH_SECONDS = int(os.environ.get("SEARCH_FRESH_SECONDS", 86400))
+# 搜索结果预取：对前 N 条结果后台解析播放地址和歌词（0 关闭）、预取并发、排队上限、播放地址缓存时长（秒）
+PREFETCH_TOP_N = int(os.environ.get("PREFETCH_TOP_N", 0))
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 2))
+PREFETCH_QUEUE_SIZE = int(os.environ.get("PREFETCH_QUEUE_SIZE", 50))
+MUSIC_URL_TTL = int(os.environ.get("MUSIC_URL_TTL", 900))
+# 回调里文件下载地址的前缀，如 https://api.example.com；为空时给出相对路径
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
+
 app = FastAPI(
     title="Video Audio Extractor (Local)",
     version="1.0.0",
@@ -33,12 +209,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class OutputSpec(BaseModel):
+    format: str = Field("m4a", description="mp3|m4a|wav|opus")
+    quality: str = Field("good", description="best|good|normal|speech")
+
 class ProcessRequest(BaseModel):
     url: str = Field(..., description="Video URL (YouTube/Bilibili)")
     extract_audio: bool = Field(True)
     keep_video: bool = Field(False)
-    audio_format: str = Field("m4a", description="mp3|m4a|wav")
-    audio_quality: str = Field("good", description="best|good|normal")
+    audio_format: str = Field("m4a", description="mp3|m4a|wav|opus")
+    audio_quality: str = Field("good", description="best|good|normal|speech（单声道 16kHz，供转写使用）")
+    start: Optional[float] = Field(None, ge=0, description="片段起点（秒），为空则从头开始")
+    end: Optional[float] = Field(None, gt=0, description="片段终点（秒），为空则到结尾")
+    outputs: Optional[List[OutputSpec]] = Field(None, description="多格式输出，只下载一次；为空则使用 audio_format/audio_quality")
+    mode: str = Field("file", description="file（服务端下载转码）| url（只解析音频直链）")
+    timeout: Optional[float] = Field(None, gt=0, description="任务总时限（秒），超时自动取消；默认 TASK_TIMEOUT")
+    callback_url: Optional[str] = Field(None, description="任务完成或失败时 POST 签名回调到此地址")
+    trim_silence: bool = Field(False, description="去掉长静音（转写场景），与转码在同一遍 ffmpeg 中完成")
+    segment_seconds: Optional[float] = Field(None, ge=1, description="按 N 秒分段输出（长录音并行转写），每段写完即可下载")
+    segment_overlap: float = Field(0, ge=0, description="相邻分段重叠的秒数")
+    segment_at_silence: bool = Field(False, description="在每段终点前的窗口内找最安静处切分，避免切断句子")
 
 class ProcessResponse(BaseModel):
     task_id: str
@@ -50,26 +240,103 @@ class TaskStatusResponse(BaseModel):
     message: str
     video_title: Optional[str] = None
     audio_file: Optional[str] = None
+    audio_files: Optional[List[Dict[str, str]]] = None
+    download_url: Optional[str] = None
+    stream: Optional[Dict[str, Any]] = None
     duration: Optional[int] = None
+    canonical_id: Optional[str] = None
+    deduplicated: bool = False
+    estimate: Optional[Dict[str, Any]] = None
+    segments: Optional[List[Dict[str, Any]]] = None
     error_detail: Optional[str] = None
+    error_class: Optional[str] = None
+    retries: Optional[Dict[str, int]] = None
+    retry_at: Optional[float] = None
 
 # in-memory task store
-TASKS: Dict[str, Dict[str, Any]] = {}
+# task_id -> 订阅该任务变化的 _TaskWatcher（SSE / WebSocket / 长轮询）
+_TASK_WATCHERS: Dict[str, set] = {}
+
+
+def _notify_task(task_id: Optional[str]) -> None:
+    for watcher in list(_TASK_WATCHERS.get(task_id, ())):
+        watcher.notify()
+
+
+class _TaskState(dict):
+    """TASKS 条目。任何修改都会使预先序列化好的状态响应失效（下次查询时再重建），并通知订阅者。"""
+    __slots__ = ('_status_body', '_task_id')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._status_body: Optional[Tuple[bytes, str]] = None
+        self._task_id: Optional[str] = None
+
+    def _changed(self) -> None:
+        self._status_body = None
+        _notify_task(self._task_id)
+        if _TASK_JOURNAL is not None and self._task_id is not None:
+            _TASK_JOURNAL.checkpoint(self._task_id, self)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._changed()
+        return value
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self._changed()
+        return value
+
+
+class _TaskStore(dict):
+    """写入的状态字典统一包装成 _TaskState。"""
+
+    def __setitem__(self, task_id: str, task: Dict[str, Any]):
+        if not isinstance(task, _TaskState):
+            task = _TaskState(task)
+        task._task_id = task_id
+        super().__setitem__(task_id, task)
+        _notify_task(task_id)
+
+
+TASKS: Dict[str, Dict[str, Any]] = _TaskStore()
 
 AUDIO_QUALITY_MAP = {
     "best": "0",
     "good": "128",
     "normal": "96",
+    "speech": "32",
 }
 
 
-def _ydl_opts(output_tmpl: str, audio_format: str, quality: str, url: str = "") -> Dict[str, Any]:
+def _ydl_opts(output_tmpl: str, audio_format: str, quality: str, url: str = "",
+              proxy: Optional[str] = None) -> Dict[str, Any]:
     base = {
         'outtmpl': output_tmpl,
         'quiet': False,
         'no_warnings': False,
-        'retries': 3,
+        'retries': YDL_RETRIES,
+        # 重试间隔指数退避，避免被限流时立刻重试加重封禁
+        'retry_sleep_functions': {
+            'http': lambda n: min(2 ** n, 30),
+            'fragment': lambda n: min(2 ** n, 30),
+        },
         'socket_timeout': 30,
+        # 重启后沿用同一 basename 时从已有的 .part 续传
+        'continuedl': True,
         'http_headers': {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
         }
@@ -83,7 +350,7 @@ def _ydl_opts(output_tmpl: str, audio_format: str, quality: str, url: str = "")
         }]
     })
     # 允许通过环境变量声明代理（也支持平台级 HTTP(S)_PROXY）
-    ydl_proxy = os.environ.get('YDL_PROXY')
+    ydl_proxy = proxy or os.environ.get('YDL_PROXY')
     if ydl_proxy:
         base['proxy'] = ydl_proxy
 
@@ -157,109 +424,3591 @@ def _ydl_opts(output_tmpl: str, audio_format: str, quality: str, url: str = "")
                     except Exception as e:
                         print(f"[douyin cookies] load failed: {e}", file=sys.stderr)
 
-    return base
+    return base
+
+
+def _is_youtube_url(url: str) -> bool:
+    try:
+        host = (urlparse(url).netloc or '').lower()
+        return 'youtube.com' in host or 'youtu.be' in host
+    except Exception:
+        return False
+
+
+def _is_douyin_url(url: str) -> bool:
+    try:
+        host = (urlparse(url).netloc or '').lower()
+        return 'douyin.com' in host or 'iesdouyin.com' in host
+    except Exception:
+        return False
+
+
+class _TaskCancelled(yt_dlp.utils.DownloadCancelled):
+    msg = 'task cancelled'
+
+
+def _progress_hook(progress_cb: Optional[Callable[[int, str], None]],
+                   cancel_check: Optional[Callable[[], bool]] = None) -> Callable[[Dict[str, Any]], None]:
+    """把 yt-dlp 的下载回调折算成 10-80 的任务进度，只在百分比变化时上报。
+
+    下载过程中每个数据块都会回调，顺便检查取消标记，抛出异常中断 yt-dlp。
+    """
+    last = {'progress': -1}
+
+    def hook(d: Dict[str, Any]) -> None:
+        if cancel_check and cancel_check():
+            raise _TaskCancelled()
+        if d.get('status') != 'downloading' or not progress_cb:
+            return
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        if not total:
+            return
+        progress = 10 + int(70 * min(d.get('downloaded_bytes', 0) / total, 1.0))
+        if progress != last['progress']:
+            last['progress'] = progress
+            progress_cb(progress, 'downloading')
+
+    return hook
+
+
+# ===== 按平台自适应限流 =====
+# 每个平台一个限流器：令牌桶限制请求速率，AIMD 控制并发上限。
+# 遇到 429/403/“确认不是机器人” 时速率与并发减半并冷却一段时间（连续触发则冷却翻倍），
+# 之后每次成功按加法缓慢恢复。
+
+def _is_throttle_error(exc: BaseException) -> bool:
+    """与重试分类共用判断（_classify_error）：HTTP 429/403 或 “确认不是机器人” 之类的限流提示。"""
+    return _classify_error(exc) == 'rate_limit'
+
+
+def _platform_key(url: str) -> str:
+    if url.startswith('ytsearch') or _is_youtube_url(url):
+        return 'youtube'
+    if _is_douyin_url(url):
+        return 'douyin'
+    host = (urlparse(url).netloc or '').lower()
+    if 'bilibili.com' in host or 'b23.tv' in host:
+        return 'bilibili'
+    return host or 'other'
+
+
+class _HostLimiter:
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int):
+        self.name = name
+        self.lock = threading.Lock()
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.max_limit = concurrency
+        self.limit = float(concurrency)
+        self.active = 0
+        self.cooldown = 0.0
+        self.cooldown_until = 0.0
+        self.successes = 0
+        self.throttles = 0
+
+    def _try_acquire(self) -> float:
+        """成功返回 0，否则返回建议等待的秒数。"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if now < self.cooldown_until:
+                return self.cooldown_until - now
+            if self.active >= int(self.limit):
+                return 0.2
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.active += 1
+            return 0.0
+
+    def _release(self, exc: Optional[BaseException]) -> None:
+        with self.lock:
+            self.active -= 1
+            if exc is not None and _is_throttle_error(exc):
+                # 乘法减小
+                self.throttles += 1
+                self.limit = max(1.0, self.limit / 2)
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+                self.tokens = 0.0
+                self.cooldown = min(THROTTLE_MAX_COOLDOWN, max(THROTTLE_COOLDOWN, self.cooldown * 2))
+                self.cooldown_until = time.monotonic() + self.cooldown
+                print(f"[throttle] {self.name}: backing off, limit={int(self.limit)} "
+                      f"rate={self.rate:.2f}/s cooldown={self.cooldown:.0f}s", file=sys.stderr)
+            elif exc is None:
+                # 加法增大：每个并发窗口的成功把上限 +1
+                self.successes += 1
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                self.cooldown = self.cooldown / 2 if self.cooldown > THROTTLE_COOLDOWN else 0.0
+
+    @contextlib.contextmanager
+    def slot(self):
+        """同步占用一个配额；yield 的 done() 可提前归还（不传异常即视为成功）。"""
+        while (wait := self._try_acquire()) > 0:
+            time.sleep(wait)
+        done = self._once()
+        try:
+            yield done
+        except BaseException as e:
+            done(e)
+            raise
+        done(None)
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self):
+        while (wait := self._try_acquire()) > 0:
+            await asyncio.sleep(wait)
+        done = self._once()
+        try:
+            yield done
+        except BaseException as e:
+            done(e)
+            raise
+        done(None)
+
+    def _once(self) -> Callable[[Optional[BaseException]], None]:
+        released = []
+
+        def done(exc: Optional[BaseException] = None) -> None:
+            if not released:
+                released.append(True)
+                self._release(exc)
+
+        return done
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'rate': round(self.rate, 3),
+                'max_rate': self.max_rate,
+                'concurrency_limit': int(self.limit),
+                'max_concurrency': self.max_limit,
+                'active': self.active,
+                'cooldown_remaining': max(0, round(self.cooldown_until - time.monotonic(), 1)),
+                'successes': self.successes,
+                'throttles': self.throttles,
+            }
+
+
+_HOST_LIMITERS: Dict[str, _HostLimiter] = {}
+_HOST_LIMITERS_LOCK = threading.Lock()
+
+
+def _host_limiter(url: str) -> _HostLimiter:
+    name = _platform_key(url)
+    with _HOST_LIMITERS_LOCK:
+        limiter = _HOST_LIMITERS.get(name)
+        if limiter is None:
+            # THROTTLE_<PLATFORM>=速率,突发,并发 覆盖默认值，如 THROTTLE_YOUTUBE=0.5,2,2
+            custom = os.environ.get(f"THROTTLE_{name.upper().replace('.', '_').replace('-', '_')}")
+            rate, burst, concurrency = THROTTLE_RATE, THROTTLE_BURST, THROTTLE_CONCURRENCY
+            if custom:
+                r, b, c = custom.split(',')
+                rate, burst, concurrency = float(r), int(b), int(c)
+            limiter = _HOST_LIMITERS[name] = _HostLimiter(name, rate, burst, concurrency)
+        return limiter
+
+
+# ===== 代理池 =====
+# YDL_PROXIES 配置多个出口（逗号分隔），按任务挑选负载最低的健康代理；
+# 需要 cookies 的平台固定使用同一个代理，避免会话 IP 漂移触发风控。
+# 连续失败或被封（429/403/人机验证）的代理自动隔离，后台健康检查通过后恢复。
+
+class _ProxyStats:
+    def __init__(self, url: str):
+        self.url = url
+        self.active = 0
+        self.successes = 0
+        self.errors = 0
+        self.bans = 0
+        self.consecutive_failures = 0
+        self.latency: Optional[float] = None      # 健康检查连接耗时（秒，EWMA）
+        self.throughput: Optional[float] = None   # 下载吞吐（字节/秒，EWMA）
+        self.quarantined_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.quarantined_until
+
+    def error_rate(self) -> float:
+        total = self.successes + self.errors
+        return self.errors / total if total else 0.0
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        return {
+            'active': self.active,
+            'successes': self.successes,
+            'errors': self.errors,
+            'bans': self.bans,
+            'latency_ms': round(self.latency * 1000) if self.latency is not None else None,
+            'throughput_kbps': round(self.throughput * 8 / 1000) if self.throughput else None,
+            'quarantined_for': max(0, round(self.quarantined_until - now)),
+        }
+
+
+def _ewma(old: Optional[float], new: float, alpha: float = 0.3) -> float:
+    return new if old is None else old + alpha * (new - old)
+
+
+def _redact_proxy(url: str) -> str:
+    """诊断输出中隐藏代理账号密码。"""
+    parsed = urlparse(url)
+    if parsed.password:
+        return url.replace(f":{parsed.password}@", ":***@")
+    return url
+
+
+class _ProxyPool:
+    def __init__(self, urls: List[str]):
+        self.lock = threading.Lock()
+        self.proxies = {u: _ProxyStats(u) for u in urls}
+        # 平台 -> 固定代理（cookies 会话）
+        self.sticky: Dict[str, str] = {}
+        self.checker: Optional[threading.Thread] = None
+
+    def pick(self, url: str) -> str:
+        platform = _platform_key(url)
+        sticky = _cookies_configured(platform)
+        now = time.time()
+        with self.lock:
+            self._ensure_checker()
+            if sticky:
+                current = self.proxies.get(self.sticky.get(platform, ''))
+                if current and current.healthy(now):
+                    return current.url
+            healthy = [p for p in self.proxies.values() if p.healthy(now)]
+            if healthy:
+                best = min(healthy, key=lambda p: (p.active, p.error_rate(), p.latency or 0.0))
+            else:
+                # 全部隔离时退而求其次：最早解除隔离的那个
+                best = min(self.proxies.values(), key=lambda p: p.quarantined_until)
+            if sticky:
+                self.sticky[platform] = best.url
+            return best.url
+
+    @contextlib.contextmanager
+    def lease(self, url: str):
+        """为一次请求挑选代理并记录结果；yield 的字典里可回填 bytes 以统计吞吐。"""
+        proxy = self.pick(url)
+        stats = self.proxies[proxy]
+        with self.lock:
+            stats.active += 1
+        box = {'proxy': proxy, 'bytes': 0}
+        started = time.monotonic()
+        try:
+            yield box
+        except Exception as e:
+            self._report(stats, e, 0, 0)
+            raise
+        else:
+            self._report(stats, None, time.monotonic() - started, box['bytes'])
+        finally:
+            with self.lock:
+                stats.active -= 1
+
+    def _report(self, stats: _ProxyStats, exc: Optional[BaseException], elapsed: float, nbytes: int) -> None:
+        now = time.time()
+        with self.lock:
+            if exc is None:
+                stats.successes += 1
+                stats.consecutive_failures = 0
+                if nbytes and elapsed > 0:
+                    stats.throughput = _ewma(stats.throughput, nbytes / elapsed)
+                return
+            stats.errors += 1
+            stats.consecutive_failures += 1
+            banned = _is_throttle_error(exc)
+            if banned:
+                stats.bans += 1
+            if banned or stats.consecutive_failures >= PROXY_MAX_FAILURES:
+                stats.quarantined_until = now + PROXY_QUARANTINE_SECONDS
+                print(f"[proxy] quarantined {_redact_proxy(stats.url)}: {str(exc)[:100]}", file=sys.stderr)
+
+    def _ensure_checker(self) -> None:
+        if self.checker is None and PROXY_CHECK_INTERVAL > 0:
+            self.checker = threading.Thread(target=self._check_loop, daemon=True)
+            self.checker.start()
+
+    def _check_loop(self) -> None:
+        while True:
+            time.sleep(PROXY_CHECK_INTERVAL)
+            self.check_all()
+
+    def check_all(self) -> None:
+        for stats in list(self.proxies.values()):
+            latency = _probe_proxy(stats.url)
+            with self.lock:
+                if latency is None:
+                    stats.consecutive_failures += 1
+                    if stats.consecutive_failures >= PROXY_MAX_FAILURES:
+                        stats.quarantined_until = max(stats.quarantined_until,
+                                                      time.time() + PROXY_QUARANTINE_SECONDS)
+                else:
+                    stats.latency = _ewma(stats.latency, latency)
+                    if not stats.healthy(time.time()):
+                        print(f"[proxy] {_redact_proxy(stats.url)} passed health check, back in pool",
+                              file=sys.stderr)
+                    stats.quarantined_until = 0.0
+                    stats.consecutive_failures = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        with self.lock:
+            return {
+                'proxies': {_redact_proxy(u): p.snapshot(now) for u, p in self.proxies.items()},
+                'sticky': {k: _redact_proxy(v) for k, v in self.sticky.items()},
+            }
+
+
+def _probe_proxy(proxy: str) -> Optional[float]:
+    """健康检查：设置了 PROXY_CHECK_URL 时经代理发一次 HTTP 请求，否则只测 TCP 连接。返回耗时秒数。"""
+    started = time.monotonic()
+    try:
+        if PROXY_CHECK_URL:
+            import requests
+            r = requests.get(PROXY_CHECK_URL, proxies={'http': proxy, 'https': proxy}, timeout=10)
+            if r.status_code >= 500 or r.status_code == 407:
+                return None
+        else:
+            parsed = urlparse(proxy)
+            with socket.create_connection((parsed.hostname, parsed.port), timeout=5):
+                pass
+        return time.monotonic() - started
+    except Exception:
+        return None
+
+
+def _cookies_configured(platform: str) -> bool:
+    prefix = {'youtube': 'YT', 'douyin': 'DY'}.get(platform)
+    return bool(prefix) and any(
+        os.environ.get(f"{prefix}_COOKIES_{kind}") for kind in ('FILE', 'URL', 'B64')
+    )
+
+
+_PROXY_POOL: Optional[_ProxyPool] = None
+
+
+def _proxy_lease(url: str):
+    """返回代理租用上下文；未配置代理时 proxy 为 None（沿用 YDL_PROXY/环境代理）。"""
+    global _PROXY_POOL
+    if not PROXY_LIST:
+        return contextlib.nullcontext({'proxy': None, 'bytes': 0})
+    if _PROXY_POOL is None:
+        _PROXY_POOL = _ProxyPool(PROXY_LIST)
+    return _PROXY_POOL.lease(url)
+
+
+# ===== URL 规范化 =====
+# 同一内容会以 youtu.be、watch?v=…&si=…、m.youtube.com、shorts、抖音分享短链、b23.tv 等形式到达。
+# 已知形态离线规范成 "平台:ID"，短链跟随跳转一次后缓存别名 → 规范 ID 的映射；
+# 来源复用、直链缓存、文件命名等都以规范 ID 为键。
+
+_YT_ID_RE = re.compile(r'^[0-9A-Za-z_-]{11}$')
+_BILI_ID_RE = re.compile(r'/video/(BV[0-9A-Za-z]{10}|av\d+)', re.I)
+_DOUYIN_ID_RE = re.compile(r'/(?:video|note|share/video|share/note)/(\d+)')
+_SHORT_LINK_HOSTS = {'b23.tv', 'bili2233.cn', 'v.douyin.com'}
+# 通用链接中去掉的分享/统计参数
+_TRACKING_PARAMS = {'si', 'feature', 'spm_id_from', 'vd_source', 'share_source', 'share_medium',
+                    'share_plat', 'share_session_id', 'share_tag', 'from', 'timestamp', 'unique_k',
+                    'bbid', 'ts', 'fbclid', 'gclid'}
+
+_ALIAS_CACHE: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+_ALIAS_CACHE_LOCK = threading.Lock()
+
+
+def _canonical_offline(url: str) -> Optional[Tuple[str, str]]:
+    """不联网规范化，返回 (规范 ID, 规范 URL)；短链返回 None（需跟随跳转）。"""
+    if not url.startswith(('http://', 'https://')):
+        # ytsearch1: 等伪 URL 原样作为 ID
+        return url, url
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if host in _SHORT_LINK_HOSTS:
+        return None
+    qs = parse_qs(parsed.query)
+    parts = [p for p in parsed.path.split('/') if p]
+
+    video_id = None
+    if host == 'youtu.be' and parts:
+        video_id = parts[0]
+    elif host.endswith('youtube.com') or host.endswith('youtube-nocookie.com'):
+        if qs.get('v'):
+            video_id = qs['v'][0]
+        elif len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v', 'e'):
+            video_id = parts[1]
+    if video_id and _YT_ID_RE.match(video_id):
+        return f"youtube:{video_id}", f"https://www.youtube.com/watch?v={video_id}"
+
+    if host.endswith('bilibili.com'):
+        m = _BILI_ID_RE.search(parsed.path)
+        if m:
+            bvid = m.group(1)
+            bvid = bvid.lower() if bvid.lower().startswith('av') else bvid
+            page = (qs.get('p') or ['1'])[0]
+            if page.isdigit() and int(page) > 1:
+                return f"bilibili:{bvid}:p{page}", f"https://www.bilibili.com/video/{bvid}?p={page}"
+            return f"bilibili:{bvid}", f"https://www.bilibili.com/video/{bvid}"
+
+    if host.endswith('douyin.com') or host.endswith('iesdouyin.com'):
+        m = _DOUYIN_ID_RE.search(parsed.path)
+        aweme_id = m.group(1) if m else (qs.get('modal_id') or [None])[0]
+        if aweme_id and aweme_id.isdigit():
+            return f"douyin:{aweme_id}", f"https://www.douyin.com/video/{aweme_id}"
+
+    # 其他站点：小写主机名、去掉片段与统计参数、参数排序
+    query = '&'.join(
+        f"{k}={v}" for k, vs in sorted(qs.items())
+        if k not in _TRACKING_PARAMS and not k.startswith('utm_') for v in vs
+    )
+    netloc = host + (f":{parsed.port}" if parsed.port else '')
+    normalized = f"{parsed.scheme}://{netloc}{parsed.path or '/'}" + (f"?{query}" if query else '')
+    return normalized, normalized
+
+
+def _resolve_short_link_blocking(url: str, max_hops: int = 5) -> str:
+    """逐跳跟随短链跳转，落到非短链地址即返回，不请求目标页面本身。"""
+    import requests
+    from urllib.parse import urljoin
+    headers = {'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 16_0 like Mac OS X) AppleWebKit/605.1.15 '
+                             '(KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1'}
+    for _ in range(max_hops):
+        r = requests.get(url, headers=headers, timeout=SHORT_LINK_TIMEOUT, allow_redirects=False, stream=True)
+        r.close()
+        location = r.headers.get('Location')
+        if not r.is_redirect or not location:
+            raise RuntimeError(f"short link did not redirect (HTTP {r.status_code})")
+        url = urljoin(url, location)
+        if _canonical_offline(url) is not None:
+            return url
+    raise RuntimeError("too many redirects")
+
+
+def _cached_alias(url: str) -> Optional[Tuple[str, str]]:
+    with _ALIAS_CACHE_LOCK:
+        hit = _ALIAS_CACHE.get(url)
+        if hit is not None:
+            _ALIAS_CACHE.move_to_end(url)
+        return hit
+
+
+def _canonicalize(url: str) -> Tuple[str, str]:
+    """返回 (规范 ID, 用于抓取的规范 URL)。短链跳转失败时退回原始链接，且不缓存。"""
+    result = _canonical_offline(url)
+    if result is not None:
+        return result
+    hit = _cached_alias(url)
+    if hit is not None:
+        return hit
+    try:
+        target = _resolve_short_link_blocking(url)
+    except Exception as e:
+        print(f"[canonical] short link resolution failed for {url}: {e}", file=sys.stderr)
+        return url, url
+    result = _canonical_offline(target)
+    if result is None:
+        # 跳转后仍是短链（循环或被拦截），按原始链接处理
+        return url, url
+    with _ALIAS_CACHE_LOCK:
+        _ALIAS_CACHE[url] = result
+        while len(_ALIAS_CACHE) > ALIAS_CACHE_SIZE:
+            _ALIAS_CACHE.popitem(last=False)
+    return result
+
+
+async def _canonicalize_async(url: str) -> Tuple[str, str]:
+    """离线可规范或已缓存时直接返回，需要跟随跳转时放到线程里执行。"""
+    result = _canonical_offline(url) or _cached_alias(url)
+    if result is not None:
+        return result
+    return await asyncio.to_thread(_canonicalize, url)
+
+
+def _new_basename(canonical_id: str) -> str:
+    import uuid
+    url_hash = hashlib.md5(canonical_id.encode()).hexdigest()[:8]
+    ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+    # 同一秒内同源的多个请求（复用音源时很常见）不能互相覆盖
+    return f"audio_{url_hash}_{ts}_{uuid.uuid4().hex[:6]}"
+
+
+def _clip_range(start: Optional[float], end: Optional[float]) -> Optional[Tuple[float, Optional[float]]]:
+    """把请求里的 start/end 规范成 (start, end)；整段提取返回 None。"""
+    if start is None and end is None:
+        return None
+    start = start or 0.0
+    if end is not None and end <= start:
+        raise HTTPException(status_code=400, detail="end must be greater than start")
+    return (start, end)
+
+
+def _clip_duration(duration: Optional[float], clip: Optional[Tuple[float, Optional[float]]]) -> Optional[float]:
+    if not clip:
+        return duration
+    clip_start, clip_end = clip
+    if duration:
+        return max(0, min(clip_end or duration, duration) - clip_start)
+    if clip_end is not None:
+        return clip_end - clip_start
+    return duration
+
+
+def _apply_platform_opts(opts: Dict[str, Any], url: str) -> None:
+    """按平台补充 yt-dlp 参数（客户端、UA、Referer 等）。"""
+    # 云端 YouTube 适配（地区/反爬 + cookies 客户端选择）
+    if _is_youtube_url(url):
+        geo_country = os.environ.get('GEO_BYPASS_COUNTRY', 'US')
+        cookies_in_use = bool(opts.get('cookiefile'))
+        if cookies_in_use:
+            # 强制 cookies 模式走 web_safari/web，避免 android 客户端与 cookies 不兼容
+            yt_clients = ['web_safari', 'web']
+            ua = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 13_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.5 Safari/605.1.15'
+        else:
+            yt_clients = os.environ.get('YT_CLIENTS', 'android,web').split(',')
+            ua = 'com.google.android.youtube/17.36.4 (Linux; U; Android 11) gzip'
+        opts.update({
+            'geo_bypass': True,
+            'geo_bypass_country': geo_country,
+            'extractor_args': {
+                'youtube': {
+                    'player_client': yt_clients,
+                }
+            },
+            'http_headers': {
+                'User-Agent': ua,
+                'Accept-Language': 'en-US,en;q=0.9'
+            }
+        })
+
+    # Douyin specific handling
+    if _is_douyin_url(url):
+        douyin_cookies_in_use = bool(opts.get('cookiefile'))
+        if douyin_cookies_in_use:
+            # Use desktop user agent when cookies are available
+            ua = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 13_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.5 Safari/605.1.15'
+        else:
+            ua = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
+
+        opts.update({
+            'http_headers': {
+                'User-Agent': ua,
+                'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+                'Referer': 'https://www.douyin.com/',
+            }
+        })
+
+
+# ===== 下载前预检 =====
+# 用 extract_info 拿到的格式信息估算下载量、转码耗时与成品大小，超限的在下载前拒绝、截断或降级。
+
+def _output_kbps(audio_format: str, quality: str) -> float:
+    if quality == 'speech':
+        return {'wav': SPEECH_SAMPLE_RATE * 16 / 1000, 'opus': 24}.get(audio_format, 32)
+    if audio_format == 'wav':
+        return 1411
+    bitrate = AUDIO_QUALITY_MAP.get(quality, '128')
+    if bitrate == '0':
+        return {'m4a': 256, 'opus': 160}.get(audio_format, 245)
+    return float(bitrate)
+
+
+def _format_bytes(fmt: Dict[str, Any], duration: Optional[float]) -> Optional[float]:
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return float(size)
+    kbps = fmt.get('abr') or fmt.get('tbr')
+    if kbps and duration:
+        return kbps * 125 * duration
+    return None
+
+
+def _estimate_cost(info: Dict[str, Any], clip: Optional[Tuple[float, Optional[float]]],
+                   outputs: List[Tuple[str, str]], fmt: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """按选中的格式（默认为 yt-dlp 已选好的格式）估算成本；未知的项为 None。"""
+    full = info.get('duration') or None
+    duration = _clip_duration(full, clip)
+    sizes = [_format_bytes(f, full) for f in ([fmt] if fmt else info.get('requested_formats') or [info])]
+    download = sum(sizes) if sizes and None not in sizes else None
+    if download and full and duration is not None:
+        # 分段下载只拉取所需区间
+        download *= duration / full
+    return {
+        'duration': duration,
+        'download_bytes': int(download) if download is not None else None,
+        'transcode_seconds': round(duration / TRANSCODE_SPEED, 1) if duration else None,
+        'output_bytes': int(sum(_output_kbps(f, q) for f, q in outputs) * 125 * duration) if duration else None,
+    }
+
+
+def _over_limits(estimate: Dict[str, Any]) -> Optional[str]:
+    duration, download = estimate['duration'] or 0, estimate['download_bytes'] or 0
+    if MAX_DURATION and duration > MAX_DURATION:
+        return f"duration {duration:.0f}s exceeds MAX_DURATION={MAX_DURATION:g}s"
+    if MAX_DOWNLOAD_MB and download > MAX_DOWNLOAD_MB << 20:
+        return f"estimated download {download >> 20}MB exceeds MAX_DOWNLOAD_MB={MAX_DOWNLOAD_MB}"
+    return None
+
+
+def _preflight(info: Dict[str, Any], clip: Optional[Tuple[float, Optional[float]]],
+               outputs: List[Tuple[str, str]]) -> Tuple[Dict[str, Any], Optional[Tuple[float, Optional[float]]],
+                                                        Optional[str]]:
+    """返回 (估算, 实际下载区间, 降级后的格式 ID 或 None)；无法满足限制时抛出 413。"""
+    estimate = _estimate_cost(info, clip, outputs)
+    reason = _over_limits(estimate)
+    if reason and PREFLIGHT_ACTION == 'clip' and estimate['duration']:
+        allowed = estimate['duration']
+        if MAX_DURATION:
+            allowed = min(allowed, MAX_DURATION)
+        if MAX_DOWNLOAD_MB and estimate['download_bytes']:
+            allowed = min(allowed, estimate['duration'] * (MAX_DOWNLOAD_MB << 20) / estimate['download_bytes'])
+        if allowed >= PREFLIGHT_MIN_CLIP:
+            start = clip[0] if clip else 0.0
+            clip = (start, start + allowed)
+            estimate = dict(_estimate_cost(info, clip, outputs), action='clipped')
+            reason = None
+    elif reason and PREFLIGHT_ACTION == 'downgrade':
+        full = info.get('duration') or None
+        audio = [f for f in info.get('formats') or []
+                 if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+                 and _format_bytes(f, full) is not None]
+        if audio:
+            smallest = min(audio, key=lambda f: _format_bytes(f, full))
+            estimate = dict(_estimate_cost(info, clip, [(f, 'normal') for f, _ in outputs], smallest),
+                            action='downgraded')
+            # 降级只解决体积问题：最低码率仍超出下载上限时照样拒绝
+            if not (MAX_DOWNLOAD_MB and (estimate['download_bytes'] or 0) > MAX_DOWNLOAD_MB << 20):
+                return estimate, clip, smallest['format_id']
+    if reason:
+        raise HTTPException(status_code=413, detail=reason)
+    needed = (estimate['download_bytes'] or 0) + (estimate['output_bytes'] or 0)
+    if needed and shutil.disk_usage(TEMP_DIR).free < needed:
+        raise HTTPException(status_code=507, detail=f"insufficient disk space for estimated {needed >> 20}MB")
+    return estimate, clip, None
+
+
+def _download_source_blocking(url: str, basename: str,
+                              progress_cb: Optional[Callable[[int, str], None]] = None,
+                              clip: Optional[Tuple[float, Optional[float]]] = None,
+                              proxy: Optional[str] = None,
+                              cancel_check: Optional[Callable[[], bool]] = None,
+                              outputs: Optional[List[Tuple[str, str]]] = None,
+                              on_estimate: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """下载阶段：只拉取原始音频流，不做转码（网络密集）。
+
+    指定 clip 时交给 yt-dlp 的分段下载，只拉取所需区间的分片。
+    下载前先做预检（见 _preflight），估算结果交给 on_estimate；outputs 用于估算成品大小。
+    cancel_check 返回 True 时中断下载并删除已下载的部分文件。
+    """
+    outtmpl = str(TEMP_DIR / f"{basename}.source.%(ext)s")
+
+    opts = _ydl_opts(outtmpl, 'm4a', 'best', url, proxy)
+    # 转码交给独立的转码阶段
+    opts.pop('postprocessors', None)
+
+    _apply_platform_opts(opts, url)
+
+    if progress_cb or cancel_check:
+        opts['progress_hooks'] = [_progress_hook(progress_cb, cancel_check)]
+
+    def set_ranges(ydl_opts: Dict[str, Any]) -> None:
+        from yt_dlp.utils import download_range_func
+        clip_start, clip_end = clip
+        ydl_opts['download_ranges'] = download_range_func(
+            None, [(clip_start, clip_end if clip_end is not None else float('inf'))]
+        )
+
+    if clip:
+        set_ranges(opts)
+
+    downgraded = False
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            if not info:
+                raise HTTPException(status_code=404, detail="Cannot fetch video info")
+            title = (info.get('title') or 'Unknown')
+            duration = info.get('duration', 0)
+            estimate, preflight_clip, format_id = _preflight(info, clip, outputs or [('m4a', 'good')])
+            if on_estimate:
+                on_estimate(estimate)
+            if preflight_clip != clip:
+                clip = preflight_clip
+                set_ranges(opts)
+                ydl.params['download_ranges'] = opts['download_ranges']
+            if format_id:
+                downgraded = True
+                opts['format'] = format_id
+                ydl.format_selector = ydl.build_format_selector(format_id)
+            acodec = info.get('acodec')
+            if cancel_check and cancel_check():
+                raise _TaskCancelled()
+            try:
+                # 复用上面解析好的信息直接下载，不再重新解析一遍页面
+                info = ydl.process_ie_result(info, download=True)
+                acodec = info.get('acodec') or acodec
+            except Exception as e:
+                if _is_youtube_url(url) and not (cancel_check and cancel_check()):
+                    # 尝试备用客户端组合
+                    fallback = opts.copy()
+                    cookies_in_use = bool(opts.get('cookiefile'))
+                    if cookies_in_use:
+                        fallback.setdefault('extractor_args', {}).setdefault('youtube', {})['player_client'] = ['web_safari', 'web']
+                    else:
+                        fallback.setdefault('extractor_args', {}).setdefault('youtube', {})['player_client'] = ['ios', 'android_creator']
+                    if downgraded:
+                        # 各客户端的格式 ID 不通用，降级时改用最低码率音轨
+                        fallback['format'] = 'worstaudio/worst'
+                    with yt_dlp.YoutubeDL(fallback) as y2:
+                        y2.download([url])
+                    # 备用客户端可能拿到不同编码的音轨，交给转码阶段按扩展名判断
+                    acodec = None
+                else:
+                    raise
+    except Exception:
+        if cancel_check and cancel_check():
+            if not _interrupted_by_shutdown(basename):
+                for p in TEMP_DIR.glob(f"{basename}.source.*"):
+                    p.unlink(missing_ok=True)
+            raise _TaskCancelled() from None
+        raise
+
+    files = [p for p in TEMP_DIR.glob(f"{basename}.source.*") if not p.name.endswith('.part')]
+    if not files:
+        raise HTTPException(status_code=500, detail="Audio file not generated")
+
+    return {
+        'basename': basename,
+        'source_path': str(files[0]),
+        'acodec': acodec,
+        'title': title,
+        'duration': _clip_duration(duration, clip),
+        # 整个视频的时长（收录索引用），duration 是截取后的长度
+        'full_duration': duration or None,
+        # 已按区间下载则转码阶段无需再 seek
+        'clip': None,
+        'estimate': estimate,
+        'downgraded': downgraded,
+    }
+
+
+# ===== 直链解析（mode='url'） =====
+# 只解析最佳音频流地址，由客户端直接拉取媒体；解析结果缓存到链接过期前。
+
+_STREAM_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_STREAM_CACHE_LOCK = threading.Lock()
+
+
+def _stream_expiry(stream_url: str) -> float:
+    """从直链查询参数推断过期时间（YouTube expire / Bilibili deadline 等），否则按默认 TTL。"""
+    try:
+        qs = parse_qs(urlparse(stream_url).query)
+        for key in ('expire', 'deadline', 'x-expires', 'Expires'):
+            if qs.get(key):
+                return float(qs[key][0])
+    except Exception:
+        pass
+    return time.time() + STREAM_URL_TTL
+
+
+def _resolve_stream_blocking(url: str) -> Dict[str, Any]:
+    """解析最佳音频流直链及客户端拉流所需的请求头，不下载。"""
+    canonical_id, url = _canonicalize(url)
+    now = time.time()
+    with _STREAM_CACHE_LOCK:
+        cached = _STREAM_CACHE.get(canonical_id)
+        # 预留 60 秒，避免客户端拿到即将过期的链接
+        if cached and cached['expires_at'] - 60 > now:
+            _STREAM_CACHE.move_to_end(canonical_id)
+            return cached
+
+    with _host_limiter(url).slot(), _proxy_lease(url) as lease:
+        opts = _ydl_opts('', 'm4a', 'best', url, lease['proxy'])
+        opts.pop('postprocessors', None)
+        opts.pop('outtmpl', None)
+        _apply_platform_opts(opts, url)
+        opts.update({'quiet': True, 'no_warnings': True, 'nocheckcertificate': True})
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+    if info and info.get('entries'):
+        info = next((e for e in info['entries'] if e), None)
+    if not info:
+        raise HTTPException(status_code=404, detail="Cannot fetch video info")
+    # bestaudio 不可用时 yt-dlp 可能给出音视频分离的 requested_formats，取其中的音轨
+    fmt = info
+    if not info.get('url'):
+        fmt = next((f for f in info.get('requested_formats') or [] if f.get('acodec') not in (None, 'none')), None)
+        if not fmt or not fmt.get('url'):
+            raise HTTPException(status_code=404, detail="No direct audio stream")
+
+    stream = {
+        'url': fmt['url'],
+        'codec': fmt.get('acodec'),
+        'ext': fmt.get('ext'),
+        'bitrate': fmt.get('abr') or fmt.get('tbr'),
+        'filesize': fmt.get('filesize') or fmt.get('filesize_approx'),
+        'protocol': fmt.get('protocol'),
+        'headers': fmt.get('http_headers') or {},
+        'expires_at': int(_stream_expiry(fmt['url'])),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+    }
+    _index_video(canonical_id, url, stream['title'], stream['duration'])
+    with _STREAM_CACHE_LOCK:
+        _STREAM_CACHE[canonical_id] = stream
+        _STREAM_CACHE.move_to_end(canonical_id)
+        while len(_STREAM_CACHE) > STREAM_CACHE_SIZE:
+            _STREAM_CACHE.popitem(last=False)
+    return stream
+
+
+# ===== 成品存储 =====
+# 默认成品留在 TEMP_DIR 由 /api/download 提供；配置对象存储后转码输出边生成边分片上传，
+# 状态里给出预签名下载地址，本地文件只作为有上限的缓存。
+
+_AUDIO_MEDIA_TYPES = {'mp3': 'audio/mpeg', 'm4a': 'audio/mp4', 'wav': 'audio/wav', 'opus': 'audio/ogg'}
+
+
+def _media_type(filename: str) -> str:
+    if filename.endswith('.json'):
+        return 'application/json'
+    return _AUDIO_MEDIA_TYPES.get(filename.rsplit('.', 1)[-1].lower(), 'application/octet-stream')
+
+
+class StorageBackend:
+    """成品存储接口。自定义实现可通过 STORAGE_BACKEND=模块:类名 接入；key 为成品文件名。"""
+    remote = False
+
+    def create_multipart(self, key: str, content_type: str) -> str:
+        raise NotImplementedError
+
+    def upload_part(self, key: str, upload_id: str, part_number: int, data: bytes) -> str:
+        """上传一个分片，返回其 ETag。"""
+        raise NotImplementedError
+
+    def complete_multipart(self, key: str, upload_id: str, parts: List[Tuple[int, str]]) -> None:
+        raise NotImplementedError
+
+    def abort_multipart(self, key: str, upload_id: str) -> None:
+        raise NotImplementedError
+
+    def put(self, key: str, data: bytes, content_type: str) -> None:
+        raise NotImplementedError
+
+    def fetch(self, key: str, dest: Path) -> bool:
+        """下载到本地缓存，对象不存在时返回 False。"""
+        raise NotImplementedError
+
+    def presign(self, key: str, expires: int) -> str:
+        raise NotImplementedError
+
+
+class LocalStorage(StorageBackend):
+    """成品只保存在 TEMP_DIR。"""
+
+
+class S3Storage(StorageBackend):
+    """S3 兼容对象存储（AWS S3、MinIO、R2 等），需要 boto3。凭证走 boto3 默认链（AWS_ACCESS_KEY_ID 等）。"""
+    remote = True
+
+    def __init__(self):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires boto3 (pip install boto3)") from None
+        if not S3_BUCKET:
+            raise RuntimeError("S3_BUCKET is required for STORAGE_BACKEND=s3")
+        self.bucket = S3_BUCKET
+        self.client = boto3.client(
+            's3', endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION,
+            config=Config(signature_version='s3v4', retries={'max_attempts': 5, 'mode': 'adaptive'},
+                          max_pool_connections=max(10, TRANSCODE_WORKERS * 2)),
+        )
+
+    def _key(self, key: str) -> str:
+        return S3_PREFIX + key
+
+    def create_multipart(self, key, content_type):
+        r = self.client.create_multipart_upload(Bucket=self.bucket, Key=self._key(key), ContentType=content_type)
+        return r['UploadId']
+
+    def upload_part(self, key, upload_id, part_number, data):
+        r = self.client.upload_part(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                                    PartNumber=part_number, Body=data)
+        return r['ETag']
+
+    def complete_multipart(self, key, upload_id, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etag} for n, etag in sorted(parts)]},
+        )
+
+    def abort_multipart(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id)
+
+    def put(self, key, data, content_type):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data, ContentType=content_type)
+
+    def fetch(self, key, dest):
+        from botocore.exceptions import ClientError
+        tmp = dest.with_name(dest.name + '.fetch')
+        try:
+            self.client.download_file(self.bucket, self._key(key), str(tmp))
+        except ClientError as e:
+            tmp.unlink(missing_ok=True)
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return False
+            raise
+        tmp.replace(dest)
+        return True
+
+    def presign(self, key, expires):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self._key(key)}, ExpiresIn=expires,
+        )
+
+
+_STORAGE: Optional[StorageBackend] = None
+
+
+def _storage() -> StorageBackend:
+    global _STORAGE
+    if _STORAGE is None:
+        if STORAGE_BACKEND in ('', 'local'):
+            _STORAGE = LocalStorage()
+        elif STORAGE_BACKEND == 's3':
+            _STORAGE = S3Storage()
+        else:
+            import importlib
+            module_name, _, class_name = STORAGE_BACKEND.partition(':')
+            _STORAGE = getattr(importlib.import_module(module_name), class_name)()
+    return _STORAGE
+
+
+@app.on_event("startup")
+async def _open_storage():
+    # 存储配置有误（缺 boto3、S3_BUCKET 等）时启动即失败，而不是等到第一个任务转码时才报错
+    await asyncio.to_thread(_storage)
+
+
+class _StreamingUpload:
+    """转码过程中把输出文件分片上传。
+
+    ffmpeg 收尾时只会回写文件头（mp4 的 mdat 长度、mp3 的 Xing 帧、wav 的 RIFF 长度），
+    所以第 1 片留到 ffmpeg 退出后再传，之后的分片在文件写过其末尾时即上传；
+    S3 按分片编号拼接，上传顺序无关。不足两片的小文件结束后直接整体上传。
+    （因此转码参数里不能加 -movflags +faststart，它会在结束时重写整个文件。）
+    """
+
+    def __init__(self, storage: StorageBackend, path: Path, key: str):
+        self.storage = storage
+        self.path = path
+        self.key = key
+        self.content_type = _media_type(key)
+        self.upload_id: Optional[str] = None
+        self.parts: List[Tuple[int, str]] = []
+        # 下一个待传分片的起始偏移；第 1 片 [0, STORAGE_PART_SIZE) 留到最后
+        self.offset = STORAGE_PART_SIZE
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._tail, daemon=True)
+        self.thread.start()
+
+    def _size(self) -> int:
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _upload_range(self, start: int, end: int) -> None:
+        if self.upload_id is None:
+            self.upload_id = self.storage.create_multipart(self.key, self.content_type)
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        part_number = start // STORAGE_PART_SIZE + 1
+        self.parts.append((part_number, self.storage.upload_part(self.key, self.upload_id, part_number, data)))
+
+    def _tail(self) -> None:
+        try:
+            while not self.done.wait(0.5):
+                while self._size() >= self.offset + STORAGE_PART_SIZE:
+                    self._upload_range(self.offset, self.offset + STORAGE_PART_SIZE)
+                    self.offset += STORAGE_PART_SIZE
+        except BaseException as e:
+            self.error = e
+
+    def finish(self) -> None:
+        """ffmpeg 成功退出后调用：补传剩余部分与第 1 片并完成上传。"""
+        self.done.set()
+        self.thread.join()
+        try:
+            if self.error is not None:
+                raise self.error
+            size = self._size()
+            if self.upload_id is None and size < 2 * STORAGE_PART_SIZE:
+                self.storage.put(self.key, self.path.read_bytes(), self.content_type)
+                return
+            while self.offset < size:
+                end = min(self.offset + STORAGE_PART_SIZE, size)
+                self._upload_range(self.offset, end)
+                self.offset = end
+            self._upload_range(0, STORAGE_PART_SIZE)
+            self.storage.complete_multipart(self.key, self.upload_id, self.parts)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self) -> None:
+        self.done.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.upload_id is not None:
+            try:
+                self.storage.abort_multipart(self.key, self.upload_id)
+            except Exception as e:
+                print(f"[storage] abort {self.key}: {e}", file=sys.stderr)
+            self.upload_id = None
+
+
+def _trim_local_cache() -> None:
+    """对象存储模式下按最近访问时间淘汰本地成品，总量不超过 LOCAL_CACHE_MAX_MB。"""
+    limit = LOCAL_CACHE_MAX_MB << 20
+    files = []
+    for p in TEMP_DIR.glob('audio_*'):
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        # 下载中的音源与正在写入的文件不动
+        if '.source.' in p.name or p.suffix in ('.part', '.fetch') or time.time() - st.st_mtime < 60:
+            continue
+        files.append((max(st.st_atime, st.st_mtime), st.st_size, p))
+    total = sum(size for _, size, _ in files)
+    for _, size, p in sorted(files):
+        if total <= limit:
+            break
+        p.unlink(missing_ok=True)
+        total -= size
+
+
+def _presign_outputs(t: Dict[str, Any]) -> None:
+    """给任务里的成品生成预签名下载地址（对象存储模式），本地模式给出 /api/download 地址。"""
+    storage = _storage()
+    if storage.remote:
+        expires_at = int(time.time()) + STORAGE_URL_EXPIRES
+
+        def url(filename: str) -> str:
+            return storage.presign(filename, STORAGE_URL_EXPIRES)
+    else:
+        expires_at, url = None, _file_url
+    files = [dict(f, url=url(f['filename'])) for f in t.get('audio_files') or []]
+    changes = dict(audio_files=files, download_url=files[0]['url'] if files else None, urls_expire_at=expires_at)
+    if t.get('segments'):
+        changes['segments'] = [dict(s, url=url(s['filename'])) for s in t['segments']]
+    t.update(changes)
+
+
+# ===== 转码阶段 =====
+
+# 源编码与目标格式一致时直接封装，不重新编码
+_COPYABLE_CODECS = {
+    'm4a': ('mp4a', 'aac'),
+    'mp3': ('mp3',),
+    'opus': ('opus',),
+}
+
+
+def _speech_codec_args(audio_format: str) -> list:
+    """语音档：单声道、16kHz；wav 为 ASR 模型常用的 16-bit PCM，opus 用 voip 模式。"""
+    args = ['-ac', '1', '-ar', str(SPEECH_SAMPLE_RATE)]
+    if audio_format == 'wav':
+        return args + ['-c:a', 'pcm_s16le']
+    if audio_format == 'opus':
+        return args + ['-c:a', 'libopus', '-b:a', '24k', '-application', 'voip']
+    if audio_format == 'mp3':
+        return args + ['-c:a', 'libmp3lame', '-b:a', '32k']
+    return args + ['-c:a', 'aac', '-b:a', '32k']
+
+
+def _silence_filter() -> str:
+    return (f"silenceremove=start_periods=1:start_threshold={SPEECH_SILENCE_DB}dB:"
+            f"stop_periods=-1:stop_duration={SPEECH_SILENCE_MIN}:stop_threshold={SPEECH_SILENCE_DB}dB:"
+            f"stop_silence={SPEECH_SILENCE_KEEP}")
+
+
+def _ffmpeg_codec_args(audio_format: str, quality: str, acodec: Optional[str]) -> list:
+    if quality == 'speech':
+        return _speech_codec_args(audio_format)
+    codec = (acodec or '').lower()
+    if codec and codec.startswith(_COPYABLE_CODECS.get(audio_format, ())):
+        return ['-c:a', 'copy']
+    bitrate = AUDIO_QUALITY_MAP.get(quality, '128')
+    if audio_format == 'wav':
+        return ['-c:a', 'pcm_s16le']
+    if audio_format == 'opus':
+        return ['-c:a', 'libopus', '-b:a', '160k' if bitrate == '0' else f'{bitrate}k']
+    if audio_format == 'mp3':
+        if bitrate == '0':
+            return ['-c:a', 'libmp3lame', '-q:a', '0']
+        return ['-c:a', 'libmp3lame', '-b:a', f'{bitrate}k']
+    if audio_format == 'm4a':
+        return ['-c:a', 'aac', '-b:a', '256k' if bitrate == '0' else f'{bitrate}k']
+    return [] if bitrate == '0' else ['-b:a', f'{bitrate}k']
+
+
+# ===== 波形峰值 =====
+# 转码时 ffmpeg 额外输出一路单声道 PCM 到 stdout，分块做向量化 min/max，
+# 生成多个缩放级别的峰值，写入 <文件名>.peaks.json 供 /api/peaks 使用。
+
+class _PeaksBuilder:
+    def __init__(self, samples_per_peak: int):
+        self.spp = samples_per_peak
+        self.mins = []
+        self.maxs = []
+        self.rest = b''
+
+    def feed(self, chunk: bytes) -> None:
+        buf = self.rest + chunk
+        window_bytes = self.spp * 2
+        usable = len(buf) - len(buf) % window_bytes
+        self.rest = buf[usable:]
+        if not usable:
+            return
+        frames = np.frombuffer(buf[:usable], dtype='<i2').reshape(-1, self.spp)
+        self.mins.append(frames.min(axis=1))
+        self.maxs.append(frames.max(axis=1))
+
+    def finish(self) -> Dict[str, Any]:
+        if len(self.rest) >= 2:
+            tail = np.frombuffer(self.rest[:len(self.rest) - len(self.rest) % 2], dtype='<i2')
+            self.mins.append(tail.min(keepdims=True))
+            self.maxs.append(tail.max(keepdims=True))
+        mins = np.concatenate(self.mins) if self.mins else np.zeros(0, dtype='<i2')
+        maxs = np.concatenate(self.maxs) if self.maxs else np.zeros(0, dtype='<i2')
+
+        levels = []
+        for spp in PEAKS_LEVELS:
+            factor = max(1, spp // self.spp)
+            pad = (-len(mins)) % factor
+            lo = np.pad(mins, (0, pad), mode='edge') if pad and len(mins) else mins
+            hi = np.pad(maxs, (0, pad), mode='edge') if pad and len(maxs) else maxs
+            lo = lo.reshape(-1, factor).min(axis=1)
+            hi = hi.reshape(-1, factor).max(axis=1)
+            # 交错存放 [min0, max0, min1, max1, ...]，量化到 int8
+            data = np.empty(len(lo) * 2, dtype=np.int8)
+            data[0::2] = lo >> 8
+            data[1::2] = hi >> 8
+            levels.append({'samples_per_peak': self.spp * factor, 'length': len(lo), 'data': data.tolist()})
+        return {'version': 1, 'sample_rate': PEAKS_SAMPLE_RATE, 'bits': 8, 'levels': levels}
+
+
+def _peaks_path(filename: str) -> Path:
+    return TEMP_DIR / f"{filename}.peaks.json"
+
+
+# ===== 音频指纹 =====
+# 与波形峰值共用转码时输出的单声道 PCM。每帧（0.256s，步长 64ms）取 300–2000Hz 内 33 个对数频带的能量，
+# 相邻频带能量差在时间上的变化取符号，得到一个 32 位子指纹（Haitsma-Kalker 思路）；
+# 对重新编码、音量变化和小幅错位都比较稳定，一首 4 分钟的歌约 15KB。
+
+_FP_FRAME_SECONDS = 0.256
+_FP_HOP_SECONDS = 0.064
+_FP_BANDS = 33
+# 倒排索引只收录低 3 位为 0 的子指纹（按值抽样，各来源抽到的是同一批），静音帧的全 0/全 1 不收录
+_FP_KEY_MASK = 7
+_FP_DEGENERATE = (0, 0xFFFFFFFF)
+
+
+class _FingerprintBuilder:
+    def __init__(self, sample_rate: int):
+        self.n = int(sample_rate * _FP_FRAME_SECONDS)
+        self.hop = int(sample_rate * _FP_HOP_SECONDS)
+        self.window = np.hanning(self.n).astype(np.float32)
+        edges = np.geomspace(300, 2000, _FP_BANDS + 1)
+        self.bins = np.round(edges * self.n / sample_rate).astype(int)
+        self.samples = np.zeros(0, dtype='<i2')
+        self.rest = b''
+        self.prev = None
+        self.out = []
+
+    def _frames(self, count: int) -> None:
+        frames = np.lib.stride_tricks.sliding_window_view(self.samples, self.n)[::self.hop][:count]
+        spec = np.abs(np.fft.rfft(frames.astype(np.float32) * self.window, axis=1)) ** 2
+        energy = np.add.reduceat(spec, self.bins, axis=1)[:, :_FP_BANDS]
+        diff = energy[:, :-1] - energy[:, 1:]
+        if self.prev is not None:
+            diff = np.vstack([self.prev, diff])
+        self.prev = diff[-1:]
+        if len(diff) > 1:
+            bits = (diff[1:] - diff[:-1]) > 0
+            self.out.append(np.packbits(bits, axis=1, bitorder='little').view('<u4').ravel())
+        self.samples = self.samples[count * self.hop:]
+
+    def feed(self, chunk: bytes) -> None:
+        buf = self.rest + chunk
+        usable = len(buf) - len(buf) % 2
+        self.rest = buf[usable:]
+        self.samples = np.concatenate([self.samples, np.frombuffer(buf[:usable], dtype='<i2')])
+        # 分批做 FFT，长音频也不会一次占用大量内存
+        while len(self.samples) >= self.n + 511 * self.hop:
+            self._frames(512)
+
+    def finish(self) -> 'np.ndarray':
+        if len(self.samples) >= self.n:
+            self._frames((len(self.samples) - self.n) // self.hop + 1)
+        return np.concatenate(self.out) if self.out else np.zeros(0, dtype='<u4')
+
+
+def _fp_compare(a: 'np.ndarray', b: 'np.ndarray') -> Tuple[float, int]:
+    """比较两个指纹，返回 (最佳对齐下的误码率, 重叠帧数)。
+
+    先用完全相同的子指纹的位置差估计偏移；相同子指纹太少时在长度差附近逐个偏移抽样比较。
+    """
+    def ber(offset: int, step: int = 1) -> Tuple[float, int]:
+        x, y = (a[:len(b) - offset], b[offset:]) if offset >= 0 else (a[-offset:], b[:len(a) + offset])
+        m = min(len(x), len(y))
+        if m == 0:
+            return 1.0, 0
+        diff = (x[:m:step] ^ y[:m:step]).view(np.uint8)
+        return float(np.unpackbits(diff).sum()) / (len(diff) * 8), m
+
+    va, ia = np.unique(a, return_index=True)
+    vb, ib = np.unique(b, return_index=True)
+    _, xa, xb = np.intersect1d(va, vb, assume_unique=True, return_indices=True)
+    if len(xa) >= 3:
+        offsets, counts = np.unique(ib[xb] - ia[xa], return_counts=True)
+        candidates = offsets[np.argsort(-counts)[:3]]
+    else:
+        spread = abs(len(a) - len(b)) + int(2 / _FP_HOP_SECONDS)
+        candidates = sorted(range(-spread, spread + 1), key=lambda o: ber(o, 4)[0])[:3]
+    return min(ber(int(o)) for o in candidates)
+
+
+class _FingerprintIndex:
+    """音频指纹索引（SQLite）。
+
+    fingerprints 存指纹本身；fp_sources 把来源（规范化 ID，片段请求带上区间）映射到指纹，
+    多个平台的同一首歌指向同一条指纹；fp_artifacts 记录每种格式/音质已有的成品文件。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                id INTEGER PRIMARY KEY,
+                hashes BLOB NOT NULL,
+                frames INTEGER NOT NULL,
+                title TEXT,
+                duration REAL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS fingerprints_frames ON fingerprints (frames);
+            CREATE TABLE IF NOT EXISTS fp_hashes (hash INTEGER NOT NULL, fp_id INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS fp_hashes_hash ON fp_hashes (hash);
+            CREATE TABLE IF NOT EXISTS fp_sources (source_key TEXT PRIMARY KEY, fp_id INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS fp_artifacts (
+                fp_id INTEGER NOT NULL,
+                format TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (fp_id, format, quality)
+            );
+            CREATE TEMP TABLE IF NOT EXISTS fp_query (hash INTEGER PRIMARY KEY);
+        ''')
+
+    def match(self, hashes: 'np.ndarray') -> Optional[Tuple[int, float]]:
+        """在时长相近的指纹里找最相似的一条，误码率不超过阈值时返回 (指纹 ID, 误码率)。"""
+        if len(hashes) == 0:
+            return None
+        frames = len(hashes)
+        keys = np.unique(hashes[(hashes & _FP_KEY_MASK) == 0])
+        keys = keys[~np.isin(keys, _FP_DEGENERATE)]
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.execute('DELETE FROM fp_query')
+                self.db.executemany('INSERT INTO fp_query (hash) VALUES (?)', ((int(k),) for k in keys))
+                # 重叠比例的要求决定了候选的时长范围；其中共同子指纹多、时长接近的优先比对
+                rows = self.db.execute(
+                    "SELECT f.id, f.hashes, COUNT(h.hash) AS n FROM fingerprints f "
+                    "LEFT JOIN fp_hashes h ON h.fp_id = f.id AND h.hash IN (SELECT hash FROM fp_query) "
+                    "WHERE f.frames BETWEEN ? AND ? GROUP BY f.id ORDER BY n DESC, ABS(f.frames - ?) LIMIT ?",
+                    (int(frames * FINGERPRINT_MIN_OVERLAP), int(frames / FINGERPRINT_MIN_OVERLAP) + 1,
+                     frames, FINGERPRINT_CANDIDATES),
+                ).fetchall()
+            finally:
+                self.db.execute('COMMIT')
+        best = None
+        for fp_id, blob, _ in rows:
+            other = np.frombuffer(blob, dtype='<u4')
+            ber, overlap = _fp_compare(hashes, other)
+            if ber > FINGERPRINT_MAX_BER or overlap < FINGERPRINT_MIN_OVERLAP * max(len(hashes), len(other)):
+                continue
+            if best is None or ber < best[1]:
+                best = (fp_id, ber)
+        return best
+
+    def add(self, hashes: 'np.ndarray', title: Optional[str], duration: Optional[float]) -> int:
+        keys = np.unique(hashes[(hashes & _FP_KEY_MASK) == 0])
+        keys = keys[~np.isin(keys, _FP_DEGENERATE)]
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                fp_id = self.db.execute(
+                    "INSERT INTO fingerprints (hashes, frames, title, duration, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (hashes.astype('<u4').tobytes(), len(hashes), title, duration, time.time()),
+                ).lastrowid
+                self.db.executemany('INSERT INTO fp_hashes (hash, fp_id) VALUES (?, ?)',
+                                    ((int(k), fp_id) for k in keys))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return fp_id
+
+    def link(self, source_key: str, fp_id: int) -> None:
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO fp_sources (source_key, fp_id) VALUES (?, ?)", (source_key, fp_id))
+
+    def add_artifact(self, fp_id: int, audio_format: str, quality: str, filename: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO fp_artifacts (fp_id, format, quality, filename, created_at) "
+                "VALUES (?, ?, ?, ?, ?)", (fp_id, audio_format, quality, filename, time.time()),
+            )
+
+    def forget_artifact(self, fp_id: int, filename: str) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM fp_artifacts WHERE fp_id = ? AND filename = ?", (fp_id, filename))
+
+    def lookup_source(self, source_key: str) -> Optional[int]:
+        with self.lock:
+            row = self.db.execute("SELECT fp_id FROM fp_sources WHERE source_key = ?", (source_key,)).fetchone()
+        return row[0] if row else None
+
+    def info(self, fp_id: int) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.db.execute("SELECT title, duration FROM fingerprints WHERE id = ?", (fp_id,)).fetchone()
+            if row is None:
+                return None
+            sources = [r[0] for r in self.db.execute(
+                "SELECT source_key FROM fp_sources WHERE fp_id = ? ORDER BY rowid", (fp_id,))]
+            artifacts = [
+                {'format': f, 'quality': q, 'filename': name}
+                for f, q, name in self.db.execute(
+                    "SELECT format, quality, filename FROM fp_artifacts WHERE fp_id = ? ORDER BY created_at", (fp_id,))
+            ]
+        return {'fingerprint_id': fp_id, 'title': row[0], 'duration': row[1], 'sources': sources, 'artifacts': artifacts}
+
+    def count(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+
+
+_FINGERPRINTS: Optional[_FingerprintIndex] = None
+_FINGERPRINTS_LOCK = threading.Lock()
+
+
+def _fingerprints() -> _FingerprintIndex:
+    global _FINGERPRINTS
+    with _FINGERPRINTS_LOCK:
+        if _FINGERPRINTS is None:
+            _FINGERPRINTS = _FingerprintIndex(FINGERPRINT_INDEX_PATH)
+    return _FINGERPRINTS
+
+
+def _source_key(canonical_id: str, clip: Optional[Tuple[float, Optional[float]]]) -> str:
+    if not clip:
+        return canonical_id
+    return f"{canonical_id}@{clip[0]:g}-{'' if clip[1] is None else f'{clip[1]:g}'}"
+
+
+def _artifact_alive(filename: str) -> bool:
+    """成品还能提供下载：对象存储里的成品一直保留；本地成品刷新修改时间，避免随即被定时清理删掉。"""
+    if _storage().remote:
+        return True
+    p = TEMP_DIR / filename
+    try:
+        os.utime(p)
+    except FileNotFoundError:
+        return False
+    peaks = _peaks_path(filename)
+    if peaks.exists():
+        os.utime(peaks)
+    return True
+
+
+def _fingerprint_output(hashes: 'np.ndarray', source: Dict[str, Any],
+                        audio_format: str, quality: str) -> Tuple[int, Optional[str]]:
+    """登记新转好的成品的指纹。返回 (指纹 ID, 可直接复用的已有成品文件名或 None)。"""
+    index = _fingerprints()
+    found = index.match(hashes)
+    if found is None:
+        fp_id = index.add(hashes, source.get('title'), source.get('duration'))
+    else:
+        fp_id = found[0]
+    if source.get('source_key'):
+        index.link(source['source_key'], fp_id)
+    if found is not None:
+        for artifact in index.info(fp_id)['artifacts']:
+            if (artifact['format'], artifact['quality']) == (audio_format, quality):
+                if _artifact_alive(artifact['filename']):
+                    print(f"[fingerprint] {source.get('source_key')} duplicates {artifact['filename']} "
+                          f"(ber={found[1]:.3f})", file=sys.stderr)
+                    return fp_id, artifact['filename']
+                index.forget_artifact(fp_id, artifact['filename'])
+    return fp_id, None
+
+
+def _known_outputs(source_key: str, outputs: List[Tuple[str, str]]) -> Optional[List[Dict[str, Any]]]:
+    """来源已登记过指纹且每个请求的格式/音质都有可用成品时，直接返回这些成品（跳过下载）。"""
+    index = _fingerprints()
+    fp_id = index.lookup_source(source_key)
+    info = index.info(fp_id) if fp_id is not None else None
+    if info is None:
+        return None
+    by_output = {(a['format'], a['quality']): a['filename'] for a in info['artifacts']}
+    results = []
+    for fmt, quality in outputs:
+        filename = by_output.get((fmt, quality))
+        if filename is None or not _artifact_alive(filename):
+            return None
+        results.append({
+            'filename': filename, 'file_path': str(TEMP_DIR / filename), 'format': fmt, 'quality': quality,
+            'title': info['title'], 'duration': info['duration'], 'deduplicated': True,
+        })
+    return results
+
+
+def _kill_on_cancel(proc: subprocess.Popen, cancel_check: Callable[[], bool]) -> threading.Thread:
+    """看门狗线程：任务取消时立即结束 ffmpeg 子进程。"""
+    def watch() -> None:
+        while proc.poll() is None:
+            if cancel_check():
+                proc.kill()
+                return
+            time.sleep(0.2)
+
+    t = threading.Thread(target=watch, daemon=True)
+    t.start()
+    return t
+
+
+def _transcode_blocking(source: Dict[str, Any], audio_format: str, quality: str,
+                        out_name: Optional[str] = None,
+                        cancel_check: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+    """转码阶段：ffmpeg 子进程把原始音频转成目标格式（CPU 密集）。"""
+    if source.get('segment'):
+        return _transcode_segments_blocking(source, audio_format, quality, out_name, cancel_check)
+    if source.get('downgraded') and audio_format != 'wav' and quality != 'speech':
+        # 预检降级的超长音频，成品也按 normal 音质输出
+        quality = 'normal'
+    src = Path(source['source_path'])
+    out = TEMP_DIR / (out_name or f"{source['basename']}.{audio_format}")
+    cmd = []
+    if FFMPEG_NICE and shutil.which('nice'):
+        cmd += ['nice', '-n', str(FFMPEG_NICE)]
+    cmd += ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error']
+    clip = source.get('clip')
+    if clip:
+        # 输入侧 seek：只解码/编码所需区间
+        cmd += ['-ss', str(clip[0])]
+        if clip[1] is not None:
+            cmd += ['-to', str(clip[1])]
+    cmd += ['-i', str(src), '-vn', '-threads', str(FFMPEG_THREADS)]
+    trim = source.get('trim_silence')
+    # 去静音需要过滤器，不能直接封装
+    cmd += _ffmpeg_codec_args(audio_format, quality, None if trim else source.get('acodec'))
+    filters = ['-af', _silence_filter()] if trim else []
+    cmd += filters
+    cmd.append(str(out))
+
+    peaks = _PeaksBuilder(min(PEAKS_LEVELS)) if PEAKS_ENABLED else None
+    # 去过静音的成品与原音频时间轴不同，不参与指纹去重
+    fingerprint = _FingerprintBuilder(PEAKS_SAMPLE_RATE) if FINGERPRINT_ENABLED and not trim else None
+    pcm = peaks or fingerprint
+    if pcm:
+        # 同一次解码顺带输出波形和指纹用的 PCM，避免再解码一遍成品文件
+        cmd += ['-map', '0:a:0', *filters, '-ac', '1', '-ar', str(PEAKS_SAMPLE_RATE), '-f', 's16le', 'pipe:1']
+
+    storage = _storage()
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE if pcm else subprocess.DEVNULL, stderr=err)
+        upload = _StreamingUpload(storage, out, out.name) if storage.remote else None
+        try:
+            if cancel_check:
+                _kill_on_cancel(proc, cancel_check)
+            if pcm:
+                for chunk in iter(lambda: proc.stdout.read(1 << 16), b''):
+                    if peaks:
+                        peaks.feed(chunk)
+                    if fingerprint:
+                        fingerprint.feed(chunk)
+                proc.stdout.close()
+            returncode = proc.wait()
+        except BaseException:
+            proc.kill()
+            if upload:
+                upload.abort()
+            raise
+        err.seek(0)
+        stderr = err.read().decode(errors='replace')
+    failed = (cancel_check and cancel_check()) or returncode != 0 or not out.exists()
+    if failed and upload:
+        upload.abort()
+    if cancel_check and cancel_check():
+        out.unlink(missing_ok=True)
+        raise _TaskCancelled()
+    if failed:
+        out.unlink(missing_ok=True)
+        raise RuntimeError(f"ffmpeg failed: {stderr.strip()[-200:]}")
+
+    fp_id = None
+    if fingerprint:
+        try:
+            fp_id, existing = _fingerprint_output(fingerprint.finish(), source, audio_format, quality)
+        except Exception as e:
+            print(f"[fingerprint] {out.name}: {e}", file=sys.stderr)
+            existing = None
+        if existing:
+            # 与已有成品近似重复：丢弃这次的输出（含已上传的分片），直接复用已有成品
+            if upload:
+                upload.abort()
+            out.unlink(missing_ok=True)
+            return {
+                'filename': existing,
+                'file_path': str(TEMP_DIR / existing),
+                'format': audio_format,
+                'quality': quality,
+                'title': source['title'],
+                'duration': source['duration'],
+                'deduplicated': True,
+            }
+
+    if upload:
+        try:
+            upload.finish()
+        except Exception as e:
+            out.unlink(missing_ok=True)
+            raise RuntimeError(f"upload failed: {e}") from e
+
+    if peaks:
+        try:
+            peaks_file = _peaks_path(out.name)
+            peaks_file.write_text(json.dumps(peaks.finish(), separators=(',', ':')))
+            if upload:
+                storage.put(peaks_file.name, peaks_file.read_bytes(), 'application/json')
+        except Exception as e:
+            print(f"[peaks] {out.name}: {e}", file=sys.stderr)
+    if fp_id is not None:
+        try:
+            _fingerprints().add_artifact(fp_id, audio_format, quality, out.name)
+        except Exception as e:
+            print(f"[fingerprint] {out.name}: {e}", file=sys.stderr)
+    if upload:
+        _trim_local_cache()
+
+    return {
+        'filename': out.name,
+        'file_path': str(out),
+        'format': audio_format,
+        'quality': quality,
+        'title': source['title'],
+        'duration': source['duration'],
+    }
+
+
+# ===== 分段输出 =====
+# 长录音按 segment_seconds 切段，供转写 worker 并行处理。ffmpeg 的 segment 封装器做不到重叠，
+# 也没法按静音下刀，所以只解码一遍输出 PCM，在这里按时间窗口切分，每段交给一个从 stdin 读 PCM 的
+# ffmpeg 编码进程；每段编码（对象存储模式下还有上传）完成就回调 on_segment，不必等整个任务结束。
+
+def _quietest_frame(pcm: bytes, channels: int, sample_rate: int) -> int:
+    """返回 PCM 中能量最低的 50ms 窗口的中点（帧序号）；没有 numpy 时返回末尾。"""
+    frames = len(pcm) // (2 * channels)
+    win = max(1, sample_rate // 20)
+    if np is None or frames < win:
+        return frames
+    count = frames // win
+    x = np.frombuffer(pcm, dtype='<i2', count=count * win * channels).astype(np.float32)
+    energy = np.square(x).reshape(count, win * channels).mean(axis=1)
+    # 同样安静时取最靠后的窗口，段长尽量接近 segment_seconds
+    i = count - 1 - int(np.argmin(energy[::-1]))
+    return i * win + win // 2
+
+
+class _Segmenter:
+    """把连续的 s16le PCM 流切成 [start, end) 帧区间的分段，相邻分段重叠 overlap 秒。
+
+    open_segment(index) 返回该段的写入函数，close_segment(index, start, end) 在该段写完时调用。
+    只缓存还不能确定归属的尾部（静音搜索窗口 + 重叠），内存占用与段长无关。
+    """
+
+    def __init__(self, sample_rate: int, channels: int, seconds: float, overlap: float, at_silence: bool,
+                 open_segment: Callable[[int], Callable[[bytes], Any]],
+                 close_segment: Callable[[int, int, int], None]):
+        self.rate = sample_rate
+        self.channels = channels
+        self.frame_bytes = 2 * channels
+        self.length = int(seconds * sample_rate)
+        self.overlap = int(overlap * sample_rate)
+        # 搜索窗口不超过 (段长 - 重叠) 的一半，保证下一段的起点总在当前段起点之后
+        window = min(SEGMENT_SILENCE_WINDOW, (seconds - overlap) / 2) if at_silence else 0
+        self.window = int(window * sample_rate)
+        self.open_segment, self.close_segment = open_segment, close_segment
+        self.buf = bytearray()
+        self.buf_start = 0  # buf[0] 的帧序号
+        self.index = 0
+        self.start = 0      # 当前段起点
+        self.written = 0    # 当前段已写出到的帧
+        self.unique = 0     # 上一段终点，之后的内容才是当前段新增的
+        self.writer: Optional[Callable[[bytes], Any]] = None
+
+    def _frames(self) -> int:
+        return self.buf_start + len(self.buf) // self.frame_bytes
+
+    def _slice(self, start: int, end: int) -> bytes:
+        offset = self.buf_start
+        return bytes(self.buf[(start - offset) * self.frame_bytes:(end - offset) * self.frame_bytes])
+
+    def _write_to(self, end: int) -> None:
+        if end > self.written:
+            if self.writer is None:
+                self.writer = self.open_segment(self.index)
+            self.writer(self._slice(self.written, end))
+            self.written = end
+
+    def _close(self, end: int) -> None:
+        self.writer = None
+        self.close_segment(self.index, self.start, end)
+        self.index += 1
+        self.unique = end
+
+    def feed(self, chunk: bytes) -> None:
+        self.buf += chunk
+        while self._frames() >= self.start + self.length:
+            cut = self.start + self.length
+            if self.window:
+                lo = cut - self.window
+                cut = lo + _quietest_frame(self._slice(lo, cut), self.channels, self.rate)
+            self._write_to(cut)
+            self._close(cut)
+            self.start = self.written = cut - self.overlap
+            del self.buf[:(self.start - self.buf_start) * self.frame_bytes]
+            self.buf_start = self.start
+        if self._frames() > self.unique:
+            # 搜索窗口与重叠之前的部分一定属于当前段，先写给编码进程
+            self._write_to(min(self._frames(), self.start + self.length - self.window - self.overlap))
+            del self.buf[:(self.written - self.buf_start) * self.frame_bytes]
+            self.buf_start = self.written
+
+    def finish(self) -> None:
+        end = self._frames()
+        if end > self.unique:
+            self._write_to(end)
+            self._close(end)
+
+
+def _transcode_segments_blocking(source: Dict[str, Any], audio_format: str, quality: str,
+                                 out_name: Optional[str] = None,
+                                 cancel_check: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+    """分段转码：成品为 <名称>_0001.<格式> 起的一组文件，结果里的 segments 带每段的起止时间。"""
+    if source.get('downgraded') and audio_format != 'wav' and quality != 'speech':
+        quality = 'normal'
+    spec = source['segment']
+    on_segment = source.get('on_segment')
+    rate, channels = (SPEECH_SAMPLE_RATE, 1) if quality == 'speech' else (44100, 2)
+    stem = Path(out_name or f"{source['basename']}.{audio_format}").stem
+    nice = ['nice', '-n', str(FFMPEG_NICE)] if FFMPEG_NICE and shutil.which('nice') else []
+    cmd = nice + ['ffmpeg', '-nostdin', '-loglevel', 'error']
+    clip = source.get('clip')
+    if clip:
+        cmd += ['-ss', str(clip[0])]
+        if clip[1] is not None:
+            cmd += ['-to', str(clip[1])]
+    cmd += ['-i', source['source_path'], '-vn', '-map', '0:a:0', '-threads', str(FFMPEG_THREADS)]
+    if source.get('trim_silence'):
+        cmd += ['-af', _silence_filter()]
+    cmd += ['-ac', str(channels), '-ar', str(rate), '-f', 's16le', 'pipe:1']
+
+    storage = _storage()
+    segments: List[Dict[str, Any]] = []
+    files: List[Path] = []
+    current: Dict[str, Any] = {}
+
+    def open_segment(index: int) -> Callable[[bytes], Any]:
+        out = TEMP_DIR / f"{stem}_{index + 1:04d}.{audio_format}"
+        files.append(out)
+        err = tempfile.TemporaryFile()
+        proc = subprocess.Popen(
+            nice + ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 's16le', '-ar', str(rate),
+                    '-ac', str(channels), '-i', 'pipe:0', '-threads', str(FFMPEG_THREADS),
+                    *_ffmpeg_codec_args(audio_format, quality, None), str(out)],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=err,
+        )
+        current.update(proc=proc, out=out, err=err,
+                       upload=_StreamingUpload(storage, out, out.name) if storage.remote else None)
+        return proc.stdin.write
+
+    def close_segment(index: int, start: int, end: int) -> None:
+        proc, out, err, upload = current['proc'], current['out'], current['err'], current['upload']
+        proc.stdin.close()
+        returncode = proc.wait()
+        current.clear()
+        with err:
+            err.seek(0)
+            stderr = err.read().decode(errors='replace')
+        if returncode != 0 or not out.exists():
+            if upload:
+                upload.abort()
+            raise RuntimeError(f"ffmpeg failed: {stderr.strip()[-200:]}")
+        if upload:
+            upload.finish()
+        segment = {
+            'index': index,
+            'start': round(start / rate, 3),
+            'end': round(end / rate, 3),
+            'format': audio_format,
+            'quality': quality,
+            'filename': out.name,
+        }
+        segments.append(segment)
+        if on_segment:
+            on_segment(segment)
+
+    segmenter = _Segmenter(rate, channels, spec['seconds'], spec['overlap'], spec['at_silence'],
+                           open_segment, close_segment)
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        try:
+            if cancel_check:
+                _kill_on_cancel(proc, cancel_check)
+            for chunk in iter(lambda: proc.stdout.read(1 << 16), b''):
+                segmenter.feed(chunk)
+            proc.stdout.close()
+            returncode = proc.wait()
+            err.seek(0)
+            stderr = err.read().decode(errors='replace')
+            if cancel_check and cancel_check():
+                raise _TaskCancelled()
+            if returncode != 0:
+                raise RuntimeError(f"ffmpeg failed: {stderr.strip()[-200:]}")
+            segmenter.finish()
+            if not segments:
+                raise RuntimeError("no audio to segment")
+        except BaseException:
+            proc.kill()
+            if current:
+                current['proc'].kill()
+                current['err'].close()
+                if current['upload']:
+                    current['upload'].abort()
+            for p in files:
+                p.unlink(missing_ok=True)
+            raise
+    if storage.remote:
+        _trim_local_cache()
+
+    return {
+        'filename': segments[0]['filename'],
+        'file_path': str(TEMP_DIR / segments[0]['filename']),
+        'format': audio_format,
+        'quality': quality,
+        'title': source['title'],
+        'duration': source['duration'],
+        'segments': segments,
+    }
+
+
+def _extract_audio_blocking(url: str, audio_format: str, quality: str,
+                            progress_cb: Optional[Callable[[int, str], None]] = None,
+                            clip: Optional[Tuple[float, Optional[float]]] = None,
+                            trim_silence: bool = False) -> Dict[str, Any]:
+    """阻塞式提取（下载 + 转码串行），适合放入线程池或进程池执行。"""
+    canonical_id, url = _canonicalize(url)
+    source = _download_source_blocking(url, _new_basename(canonical_id), progress_cb, clip,
+                                       outputs=[(audio_format, quality)])
+    source.update(source_key=_source_key(canonical_id, clip), trim_silence=trim_silence)
+    _index_video(canonical_id, url, source['title'], source.get('full_duration'))
+    try:
+        if progress_cb:
+            progress_cb(85, 'converting')
+        return _transcode_blocking(source, audio_format, quality)
+    finally:
+        Path(source['source_path']).unlink(missing_ok=True)
+
+
+# ===== 进程池执行后端 =====
+# 子进程常驻：yt-dlp 的 extractor 只加载一次，进度通过 multiprocessing 队列回传。
+
+_PROCESS_POOL: Optional[ProcessPoolExecutor] = None
+_PROCESS_POOL_LOCK = threading.Lock()
+_PROGRESS_QUEUE = None
+_WORKER_PROGRESS_QUEUE = None
+# task_id -> 进度回调（运行在事件循环线程）
+_PROGRESS_LISTENERS: Dict[str, Callable[[int, str], None]] = {}
+_ESTIMATE_LISTENERS: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+
+
+def _worker_init(progress_queue) -> None:
+    """进程池 worker 初始化：保存 IPC 队列并预热 yt-dlp。"""
+    global _WORKER_PROGRESS_QUEUE
+    _WORKER_PROGRESS_QUEUE = progress_queue
+    try:
+        from yt_dlp.extractor import gen_extractor_classes
+        gen_extractor_classes()
+    except Exception as e:
+        print(f"[pool] warmup failed: {e}", file=sys.stderr)
+
+
+class _WorkerHTTPError(Exception):
+    """子进程里的 HTTPException（无法 pickle）：args 为 (status_code, detail)，父进程还原成 HTTPException。"""
+
+
+def _download_in_worker(job_id: str, url: str, basename: str,
+                        clip: Optional[Tuple[float, Optional[float]]] = None,
+                        proxy: Optional[str] = None,
+                        outputs: Optional[List[Tuple[str, str]]] = None) -> Dict[str, Any]:
+    """在子进程中执行下载阶段；异常统一转成可 pickle 的 RuntimeError，HTTPException 保留状态码。
+
+    取消通过标记文件跨进程传递（父进程创建 <basename>.cancel）。
+    """
+    cancel_marker = _cancel_marker(basename)
+
+    def report(progress: int, message: str) -> None:
+        _WORKER_PROGRESS_QUEUE.put((job_id, progress, message))
+
+    def report_estimate(estimate: Dict[str, Any]) -> None:
+        _WORKER_PROGRESS_QUEUE.put((job_id, None, estimate))
+
+    try:
+        return _download_source_blocking(url, basename, report, clip, proxy, cancel_marker.exists,
+                                         outputs, report_estimate)
+    except HTTPException as e:
+        # 预检 413、磁盘不足 507 等需要原样返回给客户端
+        raise _WorkerHTTPError(e.status_code, e.detail) from None
+    except Exception as e:
+        raise RuntimeError(str(e)) from None
+    finally:
+        cancel_marker.unlink(missing_ok=True)
+
+
+def _cancel_marker(basename: str) -> Path:
+    return TEMP_DIR / f"{basename}.cancel"
+
+
+def _interrupted_by_shutdown(basename: str) -> bool:
+    """关停中断（而不是取消）的下载保留已下载的部分，重启后续传。子进程通过取消标记的内容得知。"""
+    if _SHUTTING_DOWN:
+        return True
+    try:
+        return _cancel_marker(basename).read_text() == 'shutdown'
+    except OSError:
+        return False
+
+
+def _progress_reader(progress_queue, loop: asyncio.AbstractEventLoop) -> None:
+    """后台线程：把子进程上报的进度转发到事件循环。"""
+    while True:
+        item = progress_queue.get()
+        if item is None:
+            return
+        job_id, progress, message = item
+        if progress is None:
+            # 预检估算结果
+            listener = _ESTIMATE_LISTENERS.get(job_id)
+            if listener:
+                loop.call_soon_threadsafe(listener, message)
+            continue
+        listener = _PROGRESS_LISTENERS.get(job_id)
+        if listener:
+            loop.call_soon_threadsafe(listener, progress, message)
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _PROCESS_POOL, _PROGRESS_QUEUE
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is None:
+            ctx = multiprocessing.get_context('spawn')
+            if _PROGRESS_QUEUE is None:
+                _PROGRESS_QUEUE = ctx.Queue()
+                threading.Thread(
+                    target=_progress_reader,
+                    args=(_PROGRESS_QUEUE, asyncio.get_running_loop()),
+                    daemon=True,
+                ).start()
+            _PROCESS_POOL = ProcessPoolExecutor(
+                max_workers=EXTRACT_WORKERS,
+                mp_context=ctx,
+                initializer=_worker_init,
+                initargs=(_PROGRESS_QUEUE,),
+            )
+        return _PROCESS_POOL
+
+
+def _restart_process_pool(broken: ProcessPoolExecutor) -> None:
+    """worker 崩溃后整个池不可用，替换为新池（仅替换一次）。"""
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is broken:
+            print("[pool] worker crashed, restarting process pool", file=sys.stderr)
+            _PROCESS_POOL = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+async def _run_download(url: str, basename: str,
+                        on_progress: Callable[[int, str], None],
+                        clip: Optional[Tuple[float, Optional[float]]] = None,
+                        outputs: Optional[List[Tuple[str, str]]] = None,
+                        on_estimate: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """按 EXTRACT_BACKEND 执行下载阶段（B 站/抖音先试原生快速路径），并把结果计入所用代理的统计。"""
+    with _proxy_lease(url) as lease:
+        source = None
+        if clip is None and NATIVE_RESOLVERS:
+            # B 站/抖音先走原生快速路径，失败时退回 yt-dlp
+            source = await _native_download(url, basename, on_progress, outputs, on_estimate, lease['proxy'])
+        if source is None:
+            source = await _run_download_on_backend(url, basename, on_progress, clip, lease['proxy'],
+                                                    outputs, on_estimate)
+        try:
+            lease['bytes'] = Path(source['source_path']).stat().st_size
+        except OSError:
+            pass
+        return source
+
+
+async def _run_download_on_backend(url: str, basename: str,
+                                   on_progress: Callable[[int, str], None],
+                                   clip: Optional[Tuple[float, Optional[float]]],
+                                   proxy: Optional[str],
+                                   outputs: Optional[List[Tuple[str, str]]] = None,
+                                   on_estimate: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+
+    if EXTRACT_BACKEND != 'process':
+        def thread_progress(progress: int, message: str) -> None:
+            loop.call_soon_threadsafe(on_progress, progress, message)
+
+        def thread_estimate(estimate: Dict[str, Any]) -> None:
+            if on_estimate:
+                loop.call_soon_threadsafe(on_estimate, estimate)
+        # 协程被取消（DELETE/超时/客户端断开）时通知下载线程尽快退出
+        stop = threading.Event()
+        try:
+            return await loop.run_in_executor(
+                _pipeline().download_executor,
+                _download_source_blocking, url, basename, thread_progress, clip, proxy, stop.is_set,
+                outputs, thread_estimate,
+            )
+        except asyncio.CancelledError:
+            stop.set()
+            raise
+
+    _PROGRESS_LISTENERS[basename] = on_progress
+    if on_estimate:
+        _ESTIMATE_LISTENERS[basename] = on_estimate
+    try:
+        # 崩溃的 worker 只重试一次，避免同一个“毒任务”反复拖垮进程池
+        for attempt in range(2):
+            pool = _get_process_pool()
+            try:
+                return await asyncio.wrap_future(
+                    pool.submit(_download_in_worker, basename, url, basename, clip, proxy, outputs)
+                )
+            except _WorkerHTTPError as e:
+                raise HTTPException(status_code=e.args[0], detail=e.args[1]) from None
+            except BrokenProcessPool:
+                _restart_process_pool(pool)
+                if attempt:
+                    raise RuntimeError("extraction worker crashed")
+            except asyncio.CancelledError:
+                _cancel_marker(basename).write_text('shutdown' if _SHUTTING_DOWN else '')
+                raise
+    finally:
+        _PROGRESS_LISTENERS.pop(basename, None)
+        _ESTIMATE_LISTENERS.pop(basename, None)
+
+
+# ===== 原生快速解析（B 站 / 抖音） =====
+# 这两个平台的数据流很简单：B 站视频页的 __playinfo__ 直接给出 DASH 纯音轨（AAC），
+# 抖音分享页的 _ROUTER_DATA 给出播放地址。一次页面请求拿到地址后，用共享的 aiohttp 连接池异步下载；
+# 源编码与目标格式一致时转码阶段直接封装。解析或下载失败都返回 None，由调用方退回 yt-dlp。
+
+# 页面地址模板（测试时指向本地录制的响应）
+_BILIBILI_PAGE = "https://www.bilibili.com/video/{bvid}{query}"
+_DOUYIN_SHARE_PAGE = "https://www.iesdouyin.com/share/video/{aweme_id}/"
+_DESKTOP_UA = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/121.0.0.0 Safari/537.36')
+_MOBILE_UA = ('Mozilla/5.0 (iPhone; CPU iPhone OS 16_0 like Mac OS X) AppleWebKit/605.1.15 '
+              '(KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1')
+
+# (事件循环, aiohttp 会话)：会话绑定创建它的事件循环
+_NATIVE_SESSION: Optional[Tuple[asyncio.AbstractEventLoop, Any]] = None
+
+
+def _native_session():
+    """共享的 aiohttp 会话，页面请求与下载复用 keep-alive 连接。"""
+    global _NATIVE_SESSION
+    import aiohttp
+    loop = asyncio.get_running_loop()
+    if _NATIVE_SESSION is None or _NATIVE_SESSION[0] is not loop or _NATIVE_SESSION[1].closed:
+        connector = aiohttp.TCPConnector(limit_per_host=DOWNLOAD_WORKERS * 2, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(sock_connect=NATIVE_TIMEOUT, sock_read=NATIVE_TIMEOUT)
+        _NATIVE_SESSION = (loop, aiohttp.ClientSession(connector=connector, timeout=timeout))
+    return _NATIVE_SESSION[1]
+
+
+def _json_after(html: str, marker: str) -> Dict[str, Any]:
+    """取出页面脚本中 marker 之后的第一个 JSON 对象。"""
+    start = html.index('{', html.index(marker) + len(marker))
+    return json.JSONDecoder().raw_decode(html, start)[0]
+
+
+def _parse_bilibili_page(html: str) -> Dict[str, Any]:
+    """B 站视频页 → 码率最高的 DASH 纯音轨。"""
+    data = _json_after(html, 'window.__playinfo__=')['data']
+    tracks = data['dash'].get('audio') or []
+    if not tracks:
+        raise ValueError("no DASH audio track")
+    best = max(tracks, key=lambda a: a.get('bandwidth') or 0)
+    try:
+        title = _json_after(html, 'window.__INITIAL_STATE__=')['videoData']['title']
+    except (ValueError, KeyError):
+        m = re.search(r'<title[^>]*>(.*?)</title>', html, re.S)
+        title = m.group(1).split('_哔哩哔哩')[0].strip() if m else None
+    return {
+        'urls': [best.get('baseUrl') or best['base_url'], *(best.get('backupUrl') or best.get('backup_url') or [])],
+        'acodec': best.get('codecs'),
+        'ext': 'm4a',
+        'abr': (best.get('bandwidth') or 0) / 1000 or None,
+        'duration': data['dash'].get('duration') or (data.get('timelength') or 0) / 1000 or None,
+        'title': title,
+        'headers': {'User-Agent': _DESKTOP_UA, 'Referer': 'https://www.bilibili.com/'},
+    }
+
+
+def _parse_douyin_page(html: str) -> Dict[str, Any]:
+    """抖音分享页 → 无水印播放地址（音视频合一的 mp4，音轨为 AAC）。"""
+    data = _json_after(html, 'window._ROUTER_DATA')
+    for page in data['loaderData'].values():
+        items = ((page or {}).get('videoInfoRes') or {}).get('item_list') or []
+        if items:
+            item = items[0]
+            break
+    else:
+        raise ValueError("no item_list in page data")
+    video = item['video']
+    urls = [u.replace('/playwm/', '/play/') for u in video['play_addr']['url_list']]
+    if not urls:
+        raise ValueError("empty play_addr")
+    return {
+        'urls': urls,
+        'acodec': 'aac',
+        'ext': 'mp4',
+        'abr': None,
+        'duration': (video.get('duration') or 0) / 1000 or None,
+        'title': item.get('desc') or None,
+        'headers': {'User-Agent': _MOBILE_UA, 'Referer': 'https://www.douyin.com/'},
+    }
+
+
+async def _native_resolve(canonical_id: str, proxy: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """一次页面请求解析出音频地址；不支持的平台返回 None。"""
+    platform, _, rest = canonical_id.partition(':')
+    if platform not in NATIVE_RESOLVERS:
+        return None
+    if platform == 'bilibili':
+        bvid, _, page = rest.partition(':')
+        page_url = _BILIBILI_PAGE.format(bvid=bvid, query=f"?p={page[1:]}" if page else '')
+        headers, parse = {'User-Agent': _DESKTOP_UA, 'Referer': 'https://www.bilibili.com/'}, _parse_bilibili_page
+    elif platform == 'douyin':
+        page_url = _DOUYIN_SHARE_PAGE.format(aweme_id=rest)
+        headers, parse = {'User-Agent': _MOBILE_UA}, _parse_douyin_page
+    else:
+        return None
+    async with _native_session().get(page_url, headers=headers, proxy=proxy) as resp:
+        resp.raise_for_status()
+        html = await resp.text()
+    return parse(html)
+
+
+async def _native_fetch(url: str, headers: Dict[str, str], dest: Path,
+                        on_progress: Callable[[int, str], None], proxy: Optional[str] = None) -> None:
+    """异步下载到 dest；已有 <dest>.part 时带 Range 续传。"""
+    part = dest.with_name(dest.name + '.part')
+    offset = part.stat().st_size if part.exists() else 0
+    if offset:
+        headers = dict(headers, Range=f"bytes={offset}-")
+    async with _native_session().get(url, headers=headers, proxy=proxy) as resp:
+        resp.raise_for_status()
+        if resp.status != 206:
+            # 服务端不支持 Range，从头下载
+            offset = 0
+        total = offset + (resp.content_length or 0)
+        done, last = offset, -1
+        with open(part, 'ab' if offset else 'wb') as f:
+            async for chunk in resp.content.iter_chunked(1 << 16):
+                f.write(chunk)
+                done += len(chunk)
+                progress = 10 + int(70 * min(done / total, 1.0)) if total else 10
+                if progress != last:
+                    last = progress
+                    on_progress(progress, 'downloading')
+    part.replace(dest)
+
+
+async def _native_download(url: str, basename: str,
+                           on_progress: Callable[[int, str], None],
+                           outputs: Optional[List[Tuple[str, str]]] = None,
+                           on_estimate: Optional[Callable[[Dict[str, Any]], None]] = None,
+                           proxy: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """原生快速路径的下载阶段，返回与 _download_source_blocking 相同结构的音源；无法处理时返回 None。"""
+    canonical = _canonical_offline(url)
+    if canonical is None or canonical[0].partition(':')[0] not in NATIVE_RESOLVERS:
+        return None
+    if proxy and not proxy.startswith(('http://', 'https://')):
+        # aiohttp 只支持 HTTP 代理，socks 代理交给 yt-dlp
+        return None
+    canonical_id = canonical[0]
+    dest = None
+    try:
+        stream = await _native_resolve(canonical_id, proxy)
+        if stream is None:
+            return None
+        estimate, clip, format_id = _preflight({'duration': stream['duration'], 'abr': stream['abr']}, None,
+                                               outputs or [('m4a', 'good')])
+        if clip or format_id:
+            # 需要截断或降级时交给 yt-dlp（按区间下载、选择低码率格式）
+            return None
+        if on_estimate:
+            on_estimate(estimate)
+        dest = TEMP_DIR / f"{basename}.source.{stream['ext']}"
+        for i, stream_url in enumerate(stream['urls']):
+            try:
+                await _native_fetch(stream_url, stream['headers'], dest, on_progress, proxy)
+                break
+            except Exception:
+                # 依次尝试备用地址（B 站的 backupUrl、抖音的多条线路）
+                if i == len(stream['urls']) - 1:
+                    raise
+    except HTTPException:
+        raise
+    except asyncio.CancelledError:
+        if dest is not None and not _SHUTTING_DOWN:
+            dest.with_name(dest.name + '.part').unlink(missing_ok=True)
+        raise
+    except Exception as e:
+        print(f"[native] {canonical_id}: {type(e).__name__}: {e}; falling back to yt-dlp", file=sys.stderr)
+        if dest is not None:
+            # yt-dlp 的文件名不同，用不上这里的部分文件
+            dest.with_name(dest.name + '.part').unlink(missing_ok=True)
+        return None
+    return {
+        'basename': basename,
+        'source_path': str(dest),
+        'acodec': stream['acodec'],
+        'title': stream['title'] or 'Unknown',
+        'duration': stream['duration'],
+        'full_duration': stream['duration'],
+        'clip': None,
+        'estimate': estimate,
+        'downgraded': False,
+    }
+
+
+# ===== 原始音源复用窗口 =====
+# 同一来源（URL + 片段）下载一次后保留 SOURCE_REUSE_SECONDS，
+# 期间其他格式/片段的请求直接复用，不再重复下载。
+
+SourceKey = Tuple[str, Optional[Tuple[float, Optional[float]]]]
+
+
+class _SourceCache:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.entries: Dict[SourceKey, Dict[str, Any]] = {}
+        # 正在下载的来源，后到的同源请求等它完成而不是重复下载
+        self.inflight: Dict[SourceKey, asyncio.Future] = {}
+
+    def _take(self, key: SourceKey) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if not Path(entry['source']['source_path']).exists():
+            del self.entries[key]
+            return None
+        entry['refs'] += 1
+        return entry['source']
+
+    async def acquire(self, canonical_id: str, clip) -> Tuple[SourceKey, Optional[Dict[str, Any]]]:
+        """返回可复用的来源（引用计数 +1）；没有则返回 (key, None)。"""
+        key = (canonical_id, clip)
+        while True:
+            source = self._take(key)
+            if source is not None:
+                return key, source
+            if clip:
+                # 完整音源也能满足片段请求：转码阶段按 clip 做输入侧 seek
+                full = self._take((canonical_id, None))
+                if full is not None:
+                    return (canonical_id, None), dict(full, clip=clip, duration=_clip_duration(full['duration'], clip))
+            pending = self.inflight.get(key) or (self.inflight.get((canonical_id, None)) if clip else None)
+            if pending is None:
+                return key, None
+            await asyncio.shield(pending)
+
+    async def fill(self, key: SourceKey, download) -> Dict[str, Any]:
+        """执行下载并登记来源，登记时引用计数为 1。"""
+        signal = self.loop.create_future()
+        self.inflight[key] = signal
+        try:
+            source = await download
+            self.entries[key] = {'source': source, 'refs': 1, 'expires': 0.0}
+            return source
+        finally:
+            del self.inflight[key]
+            signal.set_result(None)
+
+    def release(self, key: SourceKey) -> None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry['refs'] -= 1
+        entry['expires'] = time.time() + SOURCE_REUSE_SECONDS
+        if SOURCE_REUSE_SECONDS > 0:
+            self.loop.call_later(SOURCE_REUSE_SECONDS, self.sweep)
+        self.sweep()
+
+    def sweep(self) -> None:
+        now = time.time()
+        for key, entry in list(self.entries.items()):
+            if entry['refs'] <= 0 and entry['expires'] <= now:
+                Path(entry['source']['source_path']).unlink(missing_ok=True)
+                del self.entries[key]
+
+
+# ===== 客户端配额与公平调度 =====
+# 按 API Key 识别客户端：提交时检查每分钟提交数；下载槽位由 _FairScheduler 分配——
+# 客户端之间按权重做加权公平排队（WFQ，虚拟完成时间最小者先得），同一客户端内按预计时长从短到长（SJF），
+# 并受各自的并发上限约束。预计时长来自信息解析（本地索引里已知的时长，或排队时先解析一次）。
+
+_ANONYMOUS = 'anonymous'
+
+# 客户端名 -> 累计用量（本进程）；排队/下载中的实时数量见 _FairScheduler.snapshot
+_CLIENT_USAGE: Dict[str, Dict[str, float]] = {}
+# 客户端名 -> [令牌数, 上次补充时间]，每分钟提交数配额
+_SUBMIT_BUCKETS: Dict[str, List[float]] = {}
+
+
+def _client_config(name: str) -> Dict[str, Any]:
+    for cfg in API_KEYS.values():
+        if cfg['name'] == name:
+            return cfg
+    return {'name': _ANONYMOUS, 'weight': 1.0, 'concurrency': API_DEFAULT_CONCURRENCY, 'rate': API_DEFAULT_RATE}
+
+
+def _client_of(request: Request) -> str:
+    """按 X-API-Key / Authorization: Bearer 识别客户端；Key 无效，或要求 Key 而未提供时返回 401。"""
+    auth = request.headers.get('authorization') or ''
+    key = request.headers.get('x-api-key') or (auth[7:].strip() if auth.lower().startswith('bearer ') else None)
+    if key:
+        if key not in API_KEYS:
+            raise HTTPException(status_code=401, detail="invalid API key")
+        return API_KEYS[key]['name']
+    if API_KEY_REQUIRED:
+        raise HTTPException(status_code=401, detail="API key required")
+    return _ANONYMOUS
+
+
+def _usage(name: str) -> Dict[str, float]:
+    return _CLIENT_USAGE.setdefault(name, {
+        'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0, 'cancelled': 0,
+        'media_seconds': 0.0, 'download_bytes': 0, 'wait_seconds': 0.0,
+    })
+
+
+def _admit_submission(name: str) -> None:
+    """按客户端的每分钟提交数配额放行，超出时返回 429（带 Retry-After）。"""
+    rate = _client_config(name)['rate']
+    if rate > 0:
+        now = time.monotonic()
+        tokens, refilled = _SUBMIT_BUCKETS.get(name, (rate, now))
+        tokens = min(rate, tokens + (now - refilled) * rate / 60)
+        if tokens < 1:
+            _SUBMIT_BUCKETS[name] = [tokens, now]
+            _usage(name)['rejected'] += 1
+            retry_after = max(1, int((1 - tokens) * 60 / rate + 0.999))
+            raise HTTPException(status_code=429, detail=f"rate limit of {rate:g} submissions/minute exceeded",
+                                headers={'Retry-After': str(retry_after)})
+        _SUBMIT_BUCKETS[name] = [tokens - 1, now]
+    _usage(name)['submitted'] += 1
+
+
+def _record_usage(t: Dict[str, Any]) -> None:
+    """任务结束时计入所属客户端的用量。"""
+    usage = _usage(t.get('client') or _ANONYMOUS)
+    status = t.get('status')
+    if status in ('completed', 'failed', 'cancelled'):
+        usage[status] += 1
+    if status == 'completed':
+        estimate = t.get('estimate') or {}
+        usage['media_seconds'] += float(estimate.get('duration') or t.get('duration') or 0)
+        usage['download_bytes'] += int(estimate.get('download_bytes') or 0)
+
+
+def _expected_cost(t: Dict[str, Any], clip: Optional[Tuple[float, Optional[float]]] = None) -> float:
+    """调度用的预计时长（秒）：按片段区间截取，未知时取 SCHED_DEFAULT_COST。"""
+    duration = t.get('expected_duration')
+    if clip:
+        start, end = clip
+        if end is not None:
+            return max(0.0, min(duration or end, end) - start)
+        if duration:
+            return max(0.0, duration - start)
+    return float(duration) if duration else SCHED_DEFAULT_COST
+
+
+def _known_duration(canonical_id: str) -> Optional[float]:
+    """本地索引里已知的整段时长（之前处理或解析过的视频）；片段长度不算，按区间截取交给 _expected_cost。"""
+    try:
+        data = _search_index().get(canonical_id)
+    except Exception as e:
+        print(f"[sched] index lookup failed: {e}", file=sys.stderr)
+        return None
+    return (data or {}).get('full_duration') or None
+
+
+def _probe_info_blocking(url: str, proxy: Optional[str] = None) -> Dict[str, Any]:
+    """只解析信息、不选格式不下载，取时长与标题。"""
+    opts = _ydl_opts(str(TEMP_DIR / "probe.%(ext)s"), 'm4a', 'best', url, proxy)
+    opts.pop('postprocessors', None)
+    _apply_platform_opts(opts, url)
+    opts['quiet'] = True
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        return ydl.extract_info(url, download=False, process=False) or {}
+
+
+async def _probe_duration(task_id: str, url: str, canonical_id: str, slots: asyncio.Semaphore) -> None:
+    """为排队中的任务解析预计时长，写入 TASKS[task_id]['expected_duration'] 并收录进索引供下次直接使用。"""
+    known = await asyncio.to_thread(_known_duration, canonical_id)
+    if known:
+        if task_id in TASKS:
+            TASKS[task_id]['expected_duration'] = known
+        return
+    async with slots:
+        try:
+            async with _host_limiter(url).slot_async():
+                with _proxy_lease(url) as lease:
+                    info = None
+                    if NATIVE_RESOLVERS:
+                        try:
+                            info = await _native_resolve(canonical_id, lease['proxy'])
+                        except Exception as e:
+                            # 与下载路径一致：原生解析失败时退回 yt-dlp 探测
+                            print(f"[sched] native probe failed for {task_id}: {type(e).__name__}: {e}; "
+                                  f"falling back to yt-dlp", file=sys.stderr)
+                    if info is None:
+                        info = await asyncio.to_thread(_probe_info_blocking, url, lease['proxy'])
+        except Exception as e:
+            print(f"[sched] probe failed for {task_id}: {type(e).__name__}: {e}", file=sys.stderr)
+            return
+    if info.get('duration') and task_id in TASKS:
+        TASKS[task_id]['expected_duration'] = info['duration']
+    await asyncio.to_thread(_index_video, canonical_id, url, info.get('title'), info.get('duration'))
+
+
+class _FairScheduler:
+    """下载槽位分配。客户端之间按虚拟完成时间（已分配的预计时长 / 权重）公平轮转，
+    同一客户端内预计时长短的先得（排队越久折减越多）；每次分配同时取得所属平台的限流配额，
+    被限流平台的任务不占槽位，让给其他平台。"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, slots: int):
+        self.loop = loop
+        self.free = slots
+        self.waiting: Dict[str, List[Dict[str, Any]]] = {}
+        self.running: Dict[str, int] = {}
+        self.finish: Dict[str, float] = {}
+        self.vclock = 0.0
+        self.seq = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.probes = asyncio.Semaphore(SCHED_PROBE_CONCURRENCY)
+
+    def busy(self) -> bool:
+        return self.free <= 0 or any(self.waiting.values())
+
+    @contextlib.asynccontextmanager
+    async def slot(self, client: str, limiter: Optional[_HostLimiter], cost: Callable[[], float]):
+        """占用一个下载槽位；yield 的 done() 可提前归还平台配额（同 _HostLimiter.slot_async）。"""
+        self.seq += 1
+        waiter = {'client': client, 'limiter': limiter, 'cost': cost, 'seq': self.seq,
+                  'since': time.monotonic(), 'fut': self.loop.create_future()}
+        if not any(not w['fut'].done() for w in self.waiting.get(client, ())) and not self.running.get(client):
+            # 空闲后重新排队的客户端从当前虚拟时间起算，不能把空闲期攒成额度
+            self.finish[client] = max(self.finish.get(client, 0.0), self.vclock)
+        self.waiting.setdefault(client, []).append(waiter)
+        self._dispatch()
+        try:
+            await waiter['fut']
+        except asyncio.CancelledError:
+            if waiter['fut'].done() and not waiter['fut'].cancelled():
+                # 分配与取消同时发生：归还刚拿到的槽位
+                self._release(client, waiter['done'], None)
+            else:
+                waiter['fut'].cancel()
+                self._dispatch()
+            raise
+        _usage(client)['wait_seconds'] += time.monotonic() - waiter['since']
+        try:
+            yield waiter['done']
+        except BaseException as e:
+            self._release(client, waiter['done'], e)
+            raise
+        self._release(client, waiter['done'], None)
+
+    def _release(self, client: str, done: Callable[[Optional[BaseException]], None],
+                 exc: Optional[BaseException]) -> None:
+        done(exc)
+        self.free += 1
+        self.running[client] -= 1
+        self._dispatch()
+
+    def _priority(self, waiter: Dict[str, Any], now: float) -> Tuple[float, int]:
+        return waiter['cost']() - SCHED_AGING * (now - waiter['since']), waiter['seq']
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        retry = None
+        while self.free > 0:
+            candidates = []
+            for client, queue in list(self.waiting.items()):
+                queue[:] = [w for w in queue if not w['fut'].done()]
+                if not queue:
+                    del self.waiting[client]
+                    continue
+                cfg = _client_config(client)
+                if cfg['concurrency'] and self.running.get(client, 0) >= cfg['concurrency']:
+                    continue
+                ordered = sorted(queue, key=lambda w: self._priority(w, now))
+                tag = self.finish.get(client, 0.0) + ordered[0]['cost']() / cfg['weight']
+                candidates.append((tag, ordered[0]['seq'], client, ordered))
+            granted = None
+            for _, _, client, ordered in sorted(candidates):
+                for waiter in ordered:
+                    wait = waiter['limiter']._try_acquire() if waiter['limiter'] else 0.0
+                    if wait <= 0:
+                        granted = waiter
+                        break
+                    retry = wait if retry is None else min(retry, wait)
+                if granted:
+                    break
+            if granted is None:
+                break
+            self._grant(granted)
+        if retry is not None and self.waiting and self.timer is None:
+            # 候选任务的平台都在限流中：到最早可用时再分配
+            self.timer = self.loop.call_later(retry, self._wake)
+
+    def _wake(self) -> None:
+        self.timer = None
+        self._dispatch()
+
+    def _grant(self, waiter: Dict[str, Any]) -> None:
+        client = waiter['client']
+        start = self.finish.get(client, 0.0)
+        self.finish[client] = start + waiter['cost']() / _client_config(client)['weight']
+        # 虚拟时间取最近一次分配的起始标记
+        self.vclock = max(self.vclock, start)
+        self.free -= 1
+        self.running[client] = self.running.get(client, 0) + 1
+        self.waiting[client].remove(waiter)
+        waiter['done'] = waiter['limiter']._once() if waiter['limiter'] else (lambda exc=None: None)
+        waiter['fut'].set_result(None)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        clients = set(self.waiting) | {c for c, n in self.running.items() if n}
+        return {c: {'waiting': sum(not w['fut'].done() for w in self.waiting.get(c, ())),
+                    'downloading': self.running.get(c, 0)} for c in sorted(clients)}
+
+
+# ===== 两阶段流水线 =====
+# 下载槽位按网络并发设置，转码池按 CPU 核数设置；两者之间用有界队列做背压：
+# 队列满时下载 worker 持有槽位等待，不再继续拉取新任务。
+
+class _Pipeline:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.scheduler = _FairScheduler(loop, DOWNLOAD_WORKERS)
+        self.download_executor = ThreadPoolExecutor(DOWNLOAD_WORKERS, thread_name_prefix='download')
+        self.transcode_queue: asyncio.Queue = asyncio.Queue(maxsize=TRANSCODE_QUEUE_SIZE)
+        self.transcode_executor = ThreadPoolExecutor(TRANSCODE_WORKERS, thread_name_prefix='transcode')
+        self.transcoders = [loop.create_task(self._transcode_worker()) for _ in range(TRANSCODE_WORKERS)]
+        self.sources = _SourceCache(loop)
+
+    async def _transcode_worker(self) -> None:
+        while True:
+            source, audio_format, quality, out_name, fut, on_progress = await self.transcode_queue.get()
+            if fut.done():
+                # 任务在排队期间已被取消
+                self.transcode_queue.task_done()
+                continue
+            stop = threading.Event()
+            fut.add_done_callback(lambda f, stop=stop: stop.set())
+            try:
+                on_progress(85, 'converting')
+                result = await self.loop.run_in_executor(
+                    self.transcode_executor, _transcode_blocking, source, audio_format, quality, out_name,
+                    stop.is_set,
+                )
+                if not fut.done():
+                    fut.set_result(result)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                self.transcode_queue.task_done()
+
+    def close(self) -> None:
+        for t in self.transcoders:
+            t.cancel()
+        self.download_executor.shutdown(wait=False, cancel_futures=True)
+        self.transcode_executor.shutdown(wait=False, cancel_futures=True)
+
+
+_PIPELINE: Optional[_Pipeline] = None
+
+
+def _pipeline() -> _Pipeline:
+    global _PIPELINE
+    loop = asyncio.get_running_loop()
+    if _PIPELINE is None or _PIPELINE.loop is not loop:
+        _PIPELINE = _Pipeline(loop)
+    return _PIPELINE
+
+
+def _output_names(basename: str, outputs: List[Tuple[str, str]]) -> List[str]:
+    """同一格式多种音质时在文件名里带上音质，避免互相覆盖。"""
+    formats = [fmt for fmt, _ in outputs]
+    return [
+        f"{basename}.{fmt}" if formats.count(fmt) == 1 else f"{basename}_{quality}.{fmt}"
+        for fmt, quality in outputs
+    ]
+
+
+async def _run_extract(url: str, outputs: List[Tuple[str, str]],
+                       task_id: Optional[str] = None,
+                       clip: Optional[Tuple[float, Optional[float]]] = None,
+                       trim_silence: bool = False,
+                       segment: Optional[Dict[str, Any]] = None,
+                       client: Optional[str] = None) -> List[Dict[str, Any]]:
+    """下载阶段 → 有界队列 → 转码阶段（每个输出格式一个转码任务，并行执行）。
+
+    outputs 为 [(audio_format, quality), ...]，结果按相同顺序返回。
+    segment 为 {seconds, overlap, at_silence} 时分段输出，每段写完即追加到 TASKS[task_id]['segments']。
+    client 为下载槽位调度所属的客户端，默认取 TASKS[task_id]['client']。
+    """
+    pipeline = _pipeline()
+    sources = pipeline.sources
+    canonical_id, url = await _canonicalize_async(url)
+    # 重启后恢复的任务沿用原来的 basename，yt-dlp 才能找到已下载的部分
+    basename = (TASKS[task_id].get('basename') if task_id in TASKS else None) or _new_basename(canonical_id)
+    if task_id in TASKS:
+        TASKS[task_id].update(canonical_id=canonical_id, basename=basename)
+    futs = [pipeline.loop.create_future() for _ in outputs]
+
+    def on_progress(progress: int, message: str) -> None:
+        if task_id in TASKS:
+            TASKS[task_id].update(progress=progress, message=message)
+
+    def on_estimate(estimate: Dict[str, Any]) -> None:
+        if task_id in TASKS:
+            TASKS[task_id]['estimate'] = estimate
+
+    def add_segment(segment: Dict[str, Any]) -> None:
+        if task_id in TASKS:
+            t = TASKS[task_id]
+            t['segments'] = (t.get('segments') or []) + [segment]
+            _presign_outputs(t)
+            if t.get('duration'):
+                t['progress'] = max(t.get('progress', 0), min(99, 85 + int(14 * segment['end'] / t['duration'])))
+
+    def on_segment(segment: Dict[str, Any]) -> None:
+        # 在转码线程中调用
+        pipeline.loop.call_soon_threadsafe(add_segment, segment)
+
+    async def enqueue(source: Dict[str, Any]) -> None:
+        # 指纹按请求的来源（含片段区间）登记，复用的完整音源也一样
+        source = dict(source, source_key=source_key, trim_silence=trim_silence)
+        if segment:
+            source.update(segment=segment, on_segment=on_segment)
+        for (fmt, quality), name, fut in zip(outputs, _output_names(basename, outputs), futs):
+            await pipeline.transcode_queue.put((source, fmt, quality, name, fut, on_progress))
+
+    source_key = _source_key(canonical_id, clip)
+    if FINGERPRINT_ENABLED and not trim_silence and not segment:
+        known = await asyncio.to_thread(_known_outputs, source_key, outputs)
+        if known is not None:
+            on_progress(90, 'reusing existing artifact')
+            return known
+
+    key, source = await sources.acquire(canonical_id, clip)
+    probe = None
+    try:
+        if source is None:
+            scheduler = pipeline.scheduler
+            t = TASKS[task_id] if task_id in TASKS else {}
+            if SCHED_PROBE and t and not t.get('expected_duration') and scheduler.busy():
+                # 需要排队且时长未知：先解析时长，排序时短任务不会被长视频挡住
+                probe = asyncio.ensure_future(_probe_duration(task_id, url, canonical_id, scheduler.probes))
+            # 调度器分配下载槽位时一并取得平台配额，被限流的平台不会堵住其他平台的下载
+            async with scheduler.slot(client or t.get('client') or _ANONYMOUS, _host_limiter(url),
+                                      lambda: _expected_cost(t, clip)) as host_done:
+                if probe is not None:
+                    probe.cancel()
+                source = await sources.fill(key, _run_download(url, basename, on_progress, clip,
+                                                               outputs, on_estimate))
+                host_done()
+                # 队列满时在此阻塞，下载槽位不释放，形成背压
+                await enqueue(source)
+        else:
+            on_progress(80, 'reusing downloaded source')
+            if source.get('estimate'):
+                on_estimate(dict(source['estimate'], download_bytes=0))
+            await enqueue(source)
+        results = list(await asyncio.gather(*futs))
+        await asyncio.to_thread(_index_video, canonical_id, url, source.get('title'), source.get('full_duration'))
+        return results
+    except asyncio.CancelledError:
+        # 多格式任务中已经转好的文件也一并删除
+        for fut in futs:
+            if fut.done() and not fut.cancelled() and fut.exception() is None and not fut.result().get('deduplicated'):
+                for r in fut.result().get('segments') or [fut.result()]:
+                    (TEMP_DIR / r['filename']).unlink(missing_ok=True)
+                    _peaks_path(r['filename']).unlink(missing_ok=True)
+        raise
+    finally:
+        if probe is not None:
+            probe.cancel()
+        if source is not None:
+            sources.release(key)
+
+
+@app.on_event("startup")
+async def _resume_webhooks():
+    # 继续投递上次退出前未送达的回调
+    _webhooks().start()
+
+
+# 关停中：不再接收新任务，被中断的任务保留断点而不是按取消处理
+_SHUTTING_DOWN = False
+
+
+@app.on_event("shutdown")
+async def _drain_tasks():
+    """等进行中的任务最多 SHUTDOWN_GRACE_SECONDS 秒；仍未完成的中断并保留断点，下次启动后继续。"""
+    global _SHUTTING_DOWN
+    _SHUTTING_DOWN = True
+    runners = list(_TASK_RUNNERS.values())
+    if runners:
+        print(f"[shutdown] waiting up to {SHUTDOWN_GRACE_SECONDS:g}s for {len(runners)} task(s)", file=sys.stderr)
+        _, pending = await asyncio.wait(runners, timeout=SHUTDOWN_GRACE_SECONDS)
+        for runner in pending:
+            runner.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            print(f"[shutdown] checkpointed {len(pending)} unfinished task(s)", file=sys.stderr)
+    if _TASK_JOURNAL is not None:
+        # 断点（含刚被中断的任务）写完再退出
+        await asyncio.to_thread(_TASK_JOURNAL.flush)
+
+
+@app.on_event("shutdown")
+async def _shutdown_workers():
+    global _PROCESS_POOL, _PIPELINE
+    if _WEBHOOKS is not None:
+        await _WEBHOOKS.close()
+    if _PREFETCHER is not None:
+        for worker in _PREFETCHER.workers:
+            worker.cancel()
+    if _NATIVE_SESSION is not None and _NATIVE_SESSION[0] is asyncio.get_running_loop():
+        await _NATIVE_SESSION[1].close()
+    if _PIPELINE is not None:
+        _PIPELINE.close()
+        _PIPELINE = None
+    if _PROCESS_POOL is not None:
+        _PROCESS_POOL.shutdown(wait=False, cancel_futures=True)
+        _PROCESS_POOL = None
+    if _PROGRESS_QUEUE is not None:
+        _PROGRESS_QUEUE.put(None)
+
+
+# ===== 作业队列（分布式 worker 模式） =====
+# JOB_QUEUE 未设置时 API 进程自己执行任务；设置后 API 只入队，由 worker.py 领取执行。
+# worker 通过租约 + 心跳持有任务，心跳同时把进度/结果写回队列；
+# 租约过期（worker 崩溃）的任务会被重新投递，超过 JOB_MAX_ATTEMPTS 次则判定失败。
+
+class JobQueue:
+    """作业队列接口。网络化 broker（Redis、SQS 等）实现同样的方法即可通过
+    JOB_QUEUE=模块:类名 接入。task 为与 TASKS 条目同结构的状态字典。"""
+
+    def enqueue(self, task_id: str, payload: Dict[str, Any], task: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        """领取一个待执行或租约已过期的任务，返回 {task_id, payload, task, attempts}。"""
+        raise NotImplementedError
+
+    def heartbeat(self, task_id: str, worker_id: str, task: Dict[str, Any], lease_seconds: float) -> bool:
+        """续租并同步状态；租约已被他人接管时返回 False。"""
+        raise NotImplementedError
+
+    def finish(self, task_id: str, worker_id: str, task: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def get_many(self, task_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """批量查询（批量状态接口用），只返回存在的任务；默认逐个 get。"""
+        found = {}
+        for task_id in task_ids:
+            t = self.get(task_id)
+            if t is not None:
+                found[task_id] = t
+        return found
+
+    def cancel(self, task_id: str) -> bool:
+        """把未结束的任务标记为已取消；执行中的 worker 下次心跳失败后自行中止。"""
+        raise NotImplementedError
+
+    def release(self, task_id: str, worker_id: str, task: Dict[str, Any]) -> None:
+        """worker 关停时交还未完成的任务，立即可被重新领取，不计入重投次数。
+        未实现时任务在租约过期后重新投递。"""
+        raise NotImplementedError
+
+    def retry(self, task_id: str, worker_id: str, task: Dict[str, Any], run_at: float) -> None:
+        """任务失败但仍有重试次数：交还队列，run_at 之后才能被领取，不计入重投次数。
+        未实现时任务按失败结束。"""
+        raise NotImplementedError
+
+
+def _claim_pick(rows: List[tuple], running: Dict[str, int], now: float) -> Optional[tuple]:
+    """分布式模式的领取顺序：跳过已达并发上限的客户端，按 运行中任务数/权重、预计时长（排队折减）、提交时间 挑选。
+
+    rows 为 (task_id, payload, task, attempts, created_at)，running 为各客户端运行中的任务数。
+    """
+    best = None
+    for row in rows:
+        payload, t = json.loads(row[1]), json.loads(row[2])
+        client = t.get('client') or _ANONYMOUS
+        cfg = _client_config(client)
+        if cfg['concurrency'] and running.get(client, 0) >= cfg['concurrency']:
+            continue
+        clip = (payload.get('start') or 0, payload.get('end')) if payload.get('start') or payload.get('end') else None
+        rank = (running.get(client, 0) / cfg['weight'], _expected_cost(t, clip) - SCHED_AGING * (now - row[4]), row[4])
+        if best is None or rank < best[0]:
+            best = (rank, row)
+    return best[1] if best else None
+
+
+class SQLiteJobQueue(JobQueue):
+    """单机多进程使用的 SQLite 队列（WAL 模式，领取时用 BEGIN IMMEDIATE 加写锁）。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    task_id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    task TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    worker_id TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )''')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def enqueue(self, task_id, payload, task):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                'INSERT INTO jobs (task_id, payload, task, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (task_id, json.dumps(payload), json.dumps(task), 'queued', now, now),
+            )
+
+    def claim(self, worker_id, lease_seconds):
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            # 重投次数用尽的过期任务直接判失败
+            for task_id, task in db.execute(
+                "SELECT task_id, task FROM jobs WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, JOB_MAX_ATTEMPTS),
+            ).fetchall():
+                t = json.loads(task)
+                t.update(status='failed', progress=0, message='failed', error_detail='worker lost')
+                db.execute("UPDATE jobs SET state = 'done', task = ?, updated_at = ? WHERE task_id = ?",
+                           (json.dumps(t), now, task_id))
+            # 排队中的任务 lease_until 表示最早可领取时间（等待重试），为空则立即可领取
+            rows = db.execute(
+                "SELECT task_id, payload, task, attempts, created_at FROM jobs "
+                "WHERE (state = 'queued' AND (lease_until IS NULL OR lease_until <= ?)) "
+                "OR (state = 'running' AND lease_until < ?) "
+                "ORDER BY created_at LIMIT ?",
+                (now, now, SCHED_CLAIM_WINDOW),
+            ).fetchall()
+            running: Dict[str, int] = {}
+            for (task,) in db.execute("SELECT task FROM jobs WHERE state = 'running' AND lease_until >= ?", (now,)):
+                client = json.loads(task).get('client') or _ANONYMOUS
+                running[client] = running.get(client, 0) + 1
+            row = _claim_pick(rows, running, now)
+            if row is None:
+                db.execute('COMMIT')
+                return None
+            task_id, payload, task, attempts, _ = row
+            db.execute(
+                "UPDATE jobs SET state = 'running', worker_id = ?, lease_until = ?, attempts = ?, updated_at = ? "
+                "WHERE task_id = ?",
+                (worker_id, now + lease_seconds, attempts + 1, now, task_id),
+            )
+            db.execute('COMMIT')
+            return {'task_id': task_id, 'payload': json.loads(payload), 'task': json.loads(task),
+                    'attempts': attempts + 1}
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.close()
+
+    def heartbeat(self, task_id, worker_id, task, lease_seconds):
+        now = time.time()
+        with self._connect() as db:
+            cur = db.execute(
+                "UPDATE jobs SET task = ?, lease_until = ?, updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND state = 'running'",
+                (json.dumps(task), now + lease_seconds, now, task_id, worker_id),
+            )
+            return cur.rowcount == 1
+
+    def finish(self, task_id, worker_id, task):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET state = 'done', task = ?, lease_until = NULL, updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ?",
+                (json.dumps(task), time.time(), task_id, worker_id),
+            )
+
+    def get(self, task_id):
+        with self._connect() as db:
+            row = db.execute('SELECT task FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, task_ids):
+        if not task_ids:
+            return {}
+        with self._connect() as db:
+            rows = db.execute(f"SELECT task_id, task FROM jobs WHERE task_id IN ({','.join('?' * len(task_ids))})",
+                              list(task_ids)).fetchall()
+        return {task_id: json.loads(task) for task_id, task in rows}
+
+    def release(self, task_id, worker_id, task):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET state = 'queued', task = ?, worker_id = NULL, lease_until = NULL, "
+                "attempts = MAX(attempts - 1, 0), updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND state = 'running'",
+                (json.dumps(task), time.time(), task_id, worker_id),
+            )
+
+    def retry(self, task_id, worker_id, task, run_at):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET state = 'queued', task = ?, worker_id = NULL, lease_until = ?, "
+                "attempts = MAX(attempts - 1, 0), updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND state = 'running'",
+                (json.dumps(task), run_at, time.time(), task_id, worker_id),
+            )
+
+    def cancel(self, task_id):
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute("SELECT task FROM jobs WHERE task_id = ? AND state != 'done'", (task_id,)).fetchone()
+            if row is None:
+                db.execute('COMMIT')
+                return False
+            t = json.loads(row[0])
+            t.update(status='cancelled', progress=0, message='cancelled')
+            db.execute("UPDATE jobs SET state = 'done', task = ?, lease_until = NULL, updated_at = ? WHERE task_id = ?",
+                       (json.dumps(t), time.time(), task_id))
+            db.execute('COMMIT')
+            return True
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.close()
+
+
+_JOB_QUEUE: Optional[JobQueue] = None
+
+
+def _job_queue() -> Optional[JobQueue]:
+    """按 JOB_QUEUE 配置返回作业队列；local（默认）返回 None，表示 API 进程内执行。"""
+    global _JOB_QUEUE
+    if _JOB_QUEUE is None and JOB_QUEUE not in ('', 'local'):
+        if JOB_QUEUE == 'sqlite':
+            _JOB_QUEUE = SQLiteJobQueue(JOB_QUEUE_PATH)
+        else:
+            import importlib
+            module_name, _, class_name = JOB_QUEUE.partition(':')
+            _JOB_QUEUE = getattr(importlib.import_module(module_name), class_name)()
+    return _JOB_QUEUE
+
+
+def _lookup_tasks_blocking(task_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """不在本进程内存里的任务：查共享作业队列，本地模式下查持久化的历史任务（重启前已结束的）。读 SQLite，在线程中调用。"""
+    found: Dict[str, Dict[str, Any]] = {}
+    queue = _job_queue()
+    if queue is not None:
+        found.update(queue.get_many(task_ids))
+    missing = [i for i in task_ids if i not in found]
+    if missing and _TASK_JOURNAL is not None:
+        found.update(_TASK_JOURNAL.get_many(missing))
+    return found
+
+
+async def _get_tasks(task_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """任务状态：先查本进程的 TASKS，其余的一次性放到线程里查，不阻塞事件循环。"""
+    found = {i: TASKS[i] for i in task_ids if i in TASKS}
+    missing = [i for i in task_ids if i not in found]
+    if missing and (_job_queue() is not None or _TASK_JOURNAL is not None):
+        found.update(await asyncio.to_thread(_lookup_tasks_blocking, missing))
+    return found
+
+
+async def _get_task_async(task_id: str) -> Optional[Dict[str, Any]]:
+    t = TASKS.get(task_id)
+    if t is None and (_job_queue() is not None or _TASK_JOURNAL is not None):
+        t = (await asyncio.to_thread(_lookup_tasks_blocking, [task_id])).get(task_id)
+    return t
+
+
+# ===== 任务持久化（本地模式） =====
+# 任务在提交时与每次阶段（status/message）变化时写入 SQLite，下载进度的刻度变化不写；
+# 阶段变化由后台线程批量写入，事件循环与下载线程不等磁盘 I/O，关停时先写完再退出；
+# 启动时把未结束的任务重新排队，沿用原 basename 从已下载的部分续传。
+
+class _TaskJournal:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS tasks (
+                    task_id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    task TEXT NOT NULL,
+                    finished INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS tasks_finished ON tasks (finished, updated_at)')
+        # 本进程执行中的任务 -> 上次写入时的阶段
+        self.stages: Dict[str, Tuple[Any, Any]] = {}
+        # 待写入的检查点：task_id -> (任务 JSON, finished, updated_at)，同一任务只保留最新一次
+        self.pending: Dict[str, Tuple[str, int, float]] = {}
+        # 正在写入的一批
+        self.batch: Dict[str, Tuple[str, int, float]] = {}
+        self.cond = threading.Condition()
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_loop, name='task-journal', daemon=True)
+        self.writer.start()
+
+    def add(self, task_id: str, payload: Dict[str, Any], task: Dict[str, Any]) -> None:
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO tasks (task_id, payload, task, finished, updated_at) VALUES (?, ?, ?, 0, ?)',
+                (task_id, json.dumps(payload, ensure_ascii=False), json.dumps(task, ensure_ascii=False), time.time()),
+            )
+        self.stages[task_id] = self._stage(task)
+
+    @staticmethod
+    def _stage(task: Dict[str, Any]) -> Tuple[Any, Any, bool]:
+        return task.get('status'), task.get('message'), 'finished_at' in task
+
+    def checkpoint(self, task_id: str, task: Dict[str, Any]) -> None:
+        stage = self._stage(task)
+        if self.stages.get(task_id, stage) == stage:
+            return
+        finished = task.get('status') in ('completed', 'failed', 'cancelled')
+        # 调用方只做序列化（任务之后还会被修改），写入交给 _write_loop
+        row = (json.dumps(task, ensure_ascii=False), int(finished), time.time())
+        with self.cond:
+            self.pending[task_id] = row
+            self.cond.notify_all()
+        if stage[2]:
+            # finished_at 是任务的最后一次写入（含下载地址）
+            self.stages.pop(task_id, None)
+        else:
+            self.stages[task_id] = stage
+
+    def _write_loop(self) -> None:
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                batch = self.batch = self.pending
+                self.pending = {}
+            try:
+                with self.lock:
+                    self.db.execute('BEGIN')
+                    try:
+                        self.db.executemany(
+                            'UPDATE tasks SET task = ?, finished = ?, updated_at = ? WHERE task_id = ?',
+                            [(task, finished, updated_at, task_id)
+                             for task_id, (task, finished, updated_at) in batch.items()])
+                        self.db.execute('COMMIT')
+                    except BaseException:
+                        self.db.execute('ROLLBACK')
+                        raise
+            except Exception as e:
+                print(f"[journal] checkpoint of {len(batch)} task(s) failed: {e}", file=sys.stderr)
+            finally:
+                with self.cond:
+                    self.batch = {}
+                    self.cond.notify_all()
+
+    def flush(self) -> None:
+        """等待已提交的检查点全部写入（阻塞，事件循环中用 asyncio.to_thread 调用）。"""
+        with self.cond:
+            while self.pending or self.batch:
+                self.cond.wait()
+
+    def close(self) -> None:
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join()
+        self.db.close()
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self.cond:
+            pending = self.pending.get(task_id) or self.batch.get(task_id)
+        if pending:
+            return json.loads(pending[0])
+        with self.lock:
+            row = self.db.execute('SELECT task FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, task_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        found = {}
+        with self.cond:
+            for task_id in task_ids:
+                pending = self.pending.get(task_id) or self.batch.get(task_id)
+                if pending:
+                    found[task_id] = json.loads(pending[0])
+        missing = [i for i in task_ids if i not in found]
+        if missing:
+            with self.lock:
+                rows = self.db.execute(
+                    f"SELECT task_id, task FROM tasks WHERE task_id IN ({','.join('?' * len(missing))})",
+                    missing).fetchall()
+            found.update((task_id, json.loads(task)) for task_id, task in rows)
+        return found
+
+    def unfinished(self) -> List[Tuple[str, Dict[str, Any], Dict[str, Any]]]:
+        """上次退出时未结束的任务（按最近写入顺序），并清理过期的已结束任务。"""
+        with self.lock:
+            self.db.execute('DELETE FROM tasks WHERE finished = 1 AND updated_at < ?',
+                            (time.time() - TASK_JOURNAL_RETENTION,))
+            rows = self.db.execute(
+                'SELECT task_id, payload, task FROM tasks WHERE finished = 0 ORDER BY updated_at').fetchall()
+        return [(task_id, json.loads(payload), json.loads(task)) for task_id, payload, task in rows]
+
+
+_TASK_JOURNAL: Optional[_TaskJournal] = None
+
+
+@app.on_event("startup")
+async def _resume_tasks():
+    """本地模式启动时打开任务持久化，并把上次未完成（含关停时中断）的任务重新排队。"""
+    global _TASK_JOURNAL, _SHUTTING_DOWN
+    _SHUTTING_DOWN = False
+    # 队列在这里先打开（建表 / 连接 broker 都是阻塞 I/O），之后请求里取到的都是现成的对象
+    if await asyncio.to_thread(_job_queue) is not None or not TASK_JOURNAL_PATH or _TASK_JOURNAL is not None:
+        return
+    _TASK_JOURNAL = _TaskJournal(TASK_JOURNAL_PATH)
+    for task_id, payload, task in await asyncio.to_thread(_TASK_JOURNAL.unfinished):
+        try:
+            req = ProcessRequest(**payload)
+        except Exception as e:
+            print(f"[journal] cannot resume {task_id}: {e}", file=sys.stderr)
+            continue
+        task.update(status='pending', progress=0, message='resuming')
+        _TASK_JOURNAL.stages[task_id] = _TaskJournal._stage(task)
+        TASKS[task_id] = task
+        if task.get('retry_at'):
+            # 关停前正在等待重试的任务按原定时间重试
+            _schedule_retry(task_id, req)
+        else:
+            _start_task(task_id, req)
+        print(f"[journal] resumed {task_id}" + (f" ({task['basename']})" if task.get('basename') else ''),
+              file=sys.stderr)
+
+
+# ===== 完成回调（webhook） =====
+# 任务完成/失败时把回调写入 SQLite 持久化队列，由后台投递协程发送：
+# 共享 aiohttp 连接池、最多 WEBHOOK_CONCURRENCY 个并发请求、失败按指数退避重试，
+# 进程重启后未送达的回调会继续投递。API 进程与 worker 共用同一个队列文件。
+
+def _file_url(filename: str) -> str:
+    return f"{PUBLIC_BASE_URL}/api/download/{filename}"
+
+
+def _webhook_payload(task_id: str, t: Dict[str, Any]) -> Dict[str, Any]:
+    created, started, finished = t.get('created_at'), t.get('started_at'), t.get('finished_at')
+    files = [dict(f, url=f.get('url') or _file_url(f['filename'])) for f in t.get('audio_files') or []]
+    return {
+        'event': f"task.{t.get('status')}",
+        'task_id': task_id,
+        'status': t.get('status'),
+        'title': t.get('video_title'),
+        'duration': t.get('duration'),
+        'canonical_id': t.get('canonical_id'),
+        'file_url': files[0]['url'] if files else None,
+        'files': files,
+        'stream': t.get('stream'),
+        'segments': t.get('segments'),
+        'error_detail': t.get('error_detail'),
+        'error_class': t.get('error_class'),
+        'timings': {
+            'created_at': created,
+            'started_at': started,
+            'finished_at': finished,
+            'queued_seconds': round(started - created, 3) if started and created else None,
+            'processing_seconds': round(finished - started, 3) if finished and started else None,
+        },
+    }
+
+
+def _webhook_signature(body: bytes, timestamp: int) -> str:
+    """X-Webhook-Signature: t=时间戳,v1=HMAC-SHA256(密钥, "时间戳." + 请求体)。"""
+    import hmac
+    digest = hmac.new(WEBHOOK_SECRET.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+class _WebhookDispatcher:
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS webhooks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    task_id TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )''')
+            db.execute('CREATE INDEX IF NOT EXISTS webhooks_due ON webhooks (state, next_at)')
+        self.wake: Optional[asyncio.Event] = None
+        self.runner: Optional[asyncio.Task] = None
+        self.inflight: set = set()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def add(self, task_id: str, url: str, payload: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO webhooks (task_id, url, payload, state, next_at, created_at) VALUES (?, ?, ?, 'pending', ?, ?)",
+                (task_id, url, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+
+    def _claim(self, limit: int) -> List[Tuple[int, str, str, str, int]]:
+        """取出到期的回调，并把 next_at 推后作为租约，避免多个进程重复投递。"""
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute(
+                "SELECT id, task_id, url, payload, attempts FROM webhooks "
+                "WHERE state = 'pending' AND next_at <= ? ORDER BY next_at LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            for row in rows:
+                db.execute("UPDATE webhooks SET attempts = attempts + 1, next_at = ? WHERE id = ?",
+                           (now + WEBHOOK_TIMEOUT * 3, row[0]))
+            db.execute('COMMIT')
+            return [(i, task_id, url, payload, attempts + 1) for i, task_id, url, payload, attempts in rows]
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.close()
+
+    def _next_due(self) -> Optional[float]:
+        with self._connect() as db:
+            return db.execute("SELECT MIN(next_at) FROM webhooks WHERE state = 'pending'").fetchone()[0]
+
+    def _record(self, webhook_id: int, attempts: int, error: Optional[str], retry: bool) -> None:
+        with self._connect() as db:
+            if error is None:
+                db.execute('DELETE FROM webhooks WHERE id = ?', (webhook_id,))
+            elif retry and attempts < WEBHOOK_MAX_ATTEMPTS:
+                import random
+                delay = min(WEBHOOK_BACKOFF_MAX, WEBHOOK_BACKOFF_BASE * 2 ** (attempts - 1))
+                db.execute("UPDATE webhooks SET next_at = ?, last_error = ? WHERE id = ?",
+                           (time.time() + delay * random.uniform(0.8, 1.2), error, webhook_id))
+            else:
+                db.execute("UPDATE webhooks SET state = 'failed', last_error = ? WHERE id = ?",
+                           (error, webhook_id))
+
+    def stats(self) -> Dict[str, int]:
+        with self._connect() as db:
+            return dict(db.execute('SELECT state, COUNT(*) FROM webhooks GROUP BY state').fetchall())
+
+    async def enqueue(self, task_id: str, url: str, payload: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self.add, task_id, url, payload)
+        self.start()
+        self.wake.set()
+
+    def start(self) -> None:
+        if self.runner is not None and self.runner.get_loop() is not asyncio.get_running_loop():
+            # 服务在同一进程内换了事件循环重新启动：旧循环上的协程不会再运行
+            self.runner, self.inflight = None, set()
+        if self.runner is None or self.runner.done():
+            self.wake = asyncio.Event()
+            self.runner = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=WEBHOOK_CONCURRENCY, ttl_dns_cache=300)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=WEBHOOK_TIMEOUT)) as session:
+            while True:
+                free = WEBHOOK_CONCURRENCY - len(self.inflight)
+                rows = await asyncio.to_thread(self._claim, free) if free > 0 else []
+                for row in rows:
+                    t = asyncio.create_task(self._deliver(session, *row))
+                    self.inflight.add(t)
+                    t.add_done_callback(self._delivered)
+                if len(self.inflight) >= WEBHOOK_CONCURRENCY:
+                    # 并发已满，等某个投递结束（_delivered 会唤醒）
+                    timeout = None
+                else:
+                    next_due = await asyncio.to_thread(self._next_due)
+                    # 其他进程写入的回调没有本地唤醒信号，最多 30 秒检查一次
+                    timeout = 30.0 if next_due is None else min(30.0, max(0.0, next_due - time.time()))
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.wake.clear()
+
+    def _delivered(self, task: asyncio.Task) -> None:
+        self.inflight.discard(task)
+        self.wake.set()
+
+    async def _deliver(self, session, webhook_id: int, task_id: str, url: str, payload: str, attempts: int) -> None:
+        body = payload.encode()
+        headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'audio-extractor-webhook/1.0',
+            'X-Webhook-Id': task_id,
+            'X-Webhook-Attempt': str(attempts),
+        }
+        if WEBHOOK_SECRET:
+            headers['X-Webhook-Signature'] = _webhook_signature(body, int(time.time()))
+        error, retry = None, True
+        try:
+            async with session.post(url, data=body, headers=headers) as r:
+                await r.read()
+                if r.status >= 300:
+                    error = f"HTTP {r.status}"
+                    # 接收方明确拒绝（除超时/限流外的 4xx）不再重试
+                    retry = r.status >= 500 or r.status in (408, 429)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:200]
+        if error:
+            print(f"[webhook] {task_id} -> {url} attempt {attempts} failed: {error}", file=sys.stderr)
+        await asyncio.to_thread(self._record, webhook_id, attempts, error, retry)
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            self.runner.cancel()
+            await asyncio.gather(self.runner, *self.inflight, return_exceptions=True)
+            self.runner = None
+
+
+_WEBHOOKS: Optional[_WebhookDispatcher] = None
+
+
+def _webhooks() -> _WebhookDispatcher:
+    global _WEBHOOKS
+    if _WEBHOOKS is None:
+        _WEBHOOKS = _WebhookDispatcher(WEBHOOK_QUEUE_PATH)
+    return _WEBHOOKS
+
+
+def _request_outputs(req: ProcessRequest) -> List[Tuple[str, str]]:
+    if req.outputs:
+        return list(dict.fromkeys((o.format, o.quality) for o in req.outputs))
+    return [(req.audio_format, req.audio_quality)]
+
+
+# ===== 错误分类与重试 =====
+# 失败按类别决定是否重试，每类有自己的重试次数与退避（RETRY_POLICY）。重试不在 worker 里等待：
+# 任务改回 pending、记下 retry_at 后交还调度（本地模式定时重新启动，分布式模式延迟重新入队），
+# 等待期间不占下载槽位。类别写入 error_class / error_detail，累计次数见 /api/diag 的 errors。
+
+# 按顺序匹配，先命中的类别生效（“…you're not a bot. Use --cookies… for the authentication” 归 rate_limit，
+# “Sign in to confirm your age” 归 auth）。标记按整词匹配，消息里的视频 ID 不会误中；
+# HTTP 状态码只从异常对象或 “HTTP Error 429” 这类完整短语读取，见 _http_status
+_ERROR_MARKERS = (
+    ('geo', ('available in your country', 'available in your region', 'from your location',
+             'geo restricted', 'geo-restricted', 'geo restriction', 'blocked it in your country')),
+    ('rate_limit', ('too many requests', 'rate limit', 'rate-limit', 'rate limited', 'rate-limited',
+                    'not a bot', 'forbidden')),
+    ('auth', ('confirm your age', 'age-restricted', 'private video', 'members-only', 'members only',
+              'login required', 'log in', 'sign in', 'authentication', 'premium', 'unauthorized')),
+    ('unavailable', ('video unavailable', 'is unavailable', 'is not available', 'has been removed', 'was removed',
+                     'does not exist', 'not found', 'deleted', 'terminated', 'copyright',
+                     'unsupported url', 'no video formats', 'is offline', 'not currently live')),
+    ('network', ('timed out', 'timeout', 'connection reset', 'connection refused', 'connection aborted',
+                 'remote end closed', 'incomplete read', 'cannot connect', 'disconnected',
+                 'temporary failure in name resolution', 'name or service not known', 'network is unreachable',
+                 '[ssl', 'ssl error', 'sslerror', 'eof occurred', 'bad gateway', 'service unavailable',
+                 'gateway timeout', 'gateway time-out', 'worker crashed')),
+)
+_ERROR_PATTERNS = tuple(
+    (cls, re.compile(r'(?<![a-z0-9])(?:' + '|'.join(map(re.escape, markers)) + r')(?![a-z0-9])'))
+    for cls, markers in _ERROR_MARKERS
+)
+
+# 消息里的 HTTP 状态只认完整短语（“HTTP Error 429” / “status code 503” / “HTTP 403”）
+_HTTP_STATUS_RE = re.compile(r'\b(?:http error|http status|status code|http)\s*:?\s*([1-5]\d\d)\b')
+
+
+def _exc_chain(exc: BaseException) -> List[BaseException]:
+    """exc 及其原始异常：yt-dlp DownloadError 的 exc_info，以及 __cause__ / __context__。"""
+    chain, e = [], exc
+    while e is not None and e not in chain and len(chain) < 5:
+        chain.append(e)
+        e = (getattr(e, 'exc_info', None) or (None, None))[1] or e.__cause__ or e.__context__
+    return chain
+
+
+def _http_status(exc: BaseException) -> Optional[int]:
+    """异常链上的 HTTP 状态码。
+
+    先读异常对象本身（urllib / yt-dlp 的 HTTPError、aiohttp 的 ClientResponseError、HTTPException），
+    读不到再匹配消息中的完整短语；消息里单独出现的数字（视频 ID 等）不算。
+    """
+    chain = _exc_chain(exc)
+    for e in chain:
+        for attr in ('status_code', 'status', 'code'):
+            value = getattr(e, attr, None)
+            if isinstance(value, int) and not isinstance(value, bool) and 100 <= value <= 599:
+                return value
+    for e in chain:
+        m = _HTTP_STATUS_RE.search(str(e).lower())
+        if m:
+            return int(m.group(1))
+    return None
+
+
+def _status_class(status: Optional[int]) -> Optional[str]:
+    if status in (403, 429):
+        return 'rate_limit'
+    if status == 401:
+        return 'auth'
+    if status in (404, 410):
+        return 'unavailable'
+    if status is not None and (status == 408 or status >= 500):
+        return 'network'
+    return None
+
 
+def _classify_error(exc: BaseException) -> str:
+    """把失败归类为 network / rate_limit / geo / auth / unavailable / permanent。
 
-def _is_youtube_url(url: str) -> bool:
-    try:
-        host = (urlparse(url).netloc or '').lower()
-        return 'youtube.com' in host or 'youtu.be' in host
-    except Exception:
-        return False
+    yt-dlp 的 DownloadError 把原始异常放在 exc_info 里，沿异常链一起检查；无法识别的按 permanent 处理。
+    """
+    if isinstance(exc, HTTPException):
+        # 本服务自己抛出的：预检超限（413）、磁盘不足（507）等不重试
+        return {404: 'unavailable', 429: 'rate_limit', 503: 'network', 504: 'network'}.get(exc.status_code,
+                                                                                           'permanent')
+    chain = _exc_chain(exc)
+    if any(type(e).__name__ == 'GeoRestrictedError' for e in chain):
+        return 'geo'
+    msg = ' '.join(str(e) for e in chain).lower()
+    by_status = _status_class(_http_status(exc))
+    for cls, pattern in _ERROR_PATTERNS:
+        if cls == by_status or pattern.search(msg):
+            return cls
+    if any(isinstance(e, (ConnectionError, TimeoutError, socket.gaierror)) for e in chain):
+        return 'network'
+    return 'permanent'
 
 
-def _is_douyin_url(url: str) -> bool:
-    try:
-        host = (urlparse(url).netloc or '').lower()
-        return 'douyin.com' in host or 'iesdouyin.com' in host
-    except Exception:
-        return False
+def _retry_delay(t: Dict[str, Any], cls: str) -> Optional[float]:
+    """该类别的重试次数未用完时返回本次退避秒数，否则返回 None。"""
+    budget, base = RETRY_POLICY.get(cls, (0, 0))
+    done = (t.get('retries') or {}).get(cls, 0)
+    if done >= budget:
+        return None
+    return min(RETRY_MAX_DELAY, base * 2 ** done)
 
 
-def _extract_audio_blocking(url: str, audio_format: str, quality: str) -> Dict[str, Any]:
-    """阻塞式提取，适合放入线程池执行。"""
-    url_hash = hashlib.md5(url.encode()).hexdigest()[:8]
-    ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-    basename = f"audio_{url_hash}_{ts}"
-    outtmpl = str(TEMP_DIR / basename)
+# 错误类别 -> {'retried': 重新排队次数, 'failed': 最终失败次数}（本进程累计）
+_ERROR_COUNTS: Dict[str, Dict[str, int]] = {}
 
-    opts = _ydl_opts(outtmpl, audio_format, quality, url)
 
-    # 云端 YouTube 适配（地区/反爬 + cookies 客户端选择）
-    if _is_youtube_url(url):
-        geo_country = os.environ.get('GEO_BYPASS_COUNTRY', 'US')
-        cookies_in_use = bool(opts.get('cookiefile'))
-        if cookies_in_use:
-            # 强制 cookies 模式走 web_safari/web，避免 android 客户端与 cookies 不兼容
-            yt_clients = ['web_safari', 'web']
-            ua = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 13_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.5 Safari/605.1.15'
-        else:
-            yt_clients = os.environ.get('YT_CLIENTS', 'android,web').split(',')
-            ua = 'com.google.android.youtube/17.36.4 (Linux; U; Android 11) gzip'
-        opts.update({
-            'geo_bypass': True,
-            'geo_bypass_country': geo_country,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': yt_clients,
-                }
-            },
-            'http_headers': {
-                'User-Agent': ua,
-                'Accept-Language': 'en-US,en;q=0.9'
-            }
-        })
+def _count_error(cls: str, outcome: str) -> None:
+    _ERROR_COUNTS.setdefault(cls, {'retried': 0, 'failed': 0})[outcome] += 1
 
-    # Douyin specific handling
-    if _is_douyin_url(url):
-        douyin_cookies_in_use = bool(opts.get('cookiefile'))
-        if douyin_cookies_in_use:
-            # Use desktop user agent when cookies are available
-            ua = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 13_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.5 Safari/605.1.15'
-        else:
-            ua = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
 
-        opts.update({
-            'http_headers': {
-                'User-Agent': ua,
-                'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-                'Referer': 'https://www.douyin.com/',
-            }
-        })
+# task_id -> 执行中的 asyncio 任务，用于 DELETE /api/tasks/{task_id}
+_TASK_RUNNERS: Dict[str, asyncio.Task] = {}
+# task_id -> 等待重试的定时器（本地模式）
+_RETRY_TIMERS: Dict[str, asyncio.TimerHandle] = {}
 
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        if not info:
-            raise HTTPException(status_code=404, detail="Cannot fetch video info")
-        title = (info.get('title') or 'Unknown')
-        duration = info.get('duration', 0)
+
+def _start_task(task_id: str, req: ProcessRequest) -> asyncio.Task:
+    _RETRY_TIMERS.pop(task_id, None)
+    runner = asyncio.create_task(_process_task(task_id, req))
+    _TASK_RUNNERS[task_id] = runner
+    runner.add_done_callback(lambda r: _task_done(task_id, req, r))
+    return runner
+
+
+def _schedule_retry(task_id: str, req: ProcessRequest) -> None:
+    """到 TASKS[task_id]['retry_at'] 时重新启动任务（已过期则立即启动）。"""
+    delay = max(0.0, TASKS[task_id]['retry_at'] - time.time())
+    _RETRY_TIMERS[task_id] = asyncio.get_running_loop().call_later(delay, _start_task, task_id, req)
+
+
+def _task_done(task_id: str, req: ProcessRequest, runner: asyncio.Task) -> None:
+    _TASK_RUNNERS.pop(task_id, None)
+    t = TASKS.get(task_id)
+    if not runner.cancelled() and t is not None and t.get('status') == 'pending' and t.get('retry_at'):
+        _schedule_retry(task_id, req)
+
+
+async def _process_task(task_id: str, req: ProcessRequest) -> None:
+    """执行一个 /api/process 任务，状态写入 TASKS[task_id]。API 进程与 worker 共用。
+
+    超过时限或被取消时，asyncio 取消会一路传到下载线程/ffmpeg，释放 worker 槽位。
+    """
+    timeout = req.timeout or TASK_TIMEOUT or None
+    TASKS[task_id].pop('retry_at', None)
+    try:
+        await asyncio.wait_for(_execute_task(task_id, req), timeout)
+    except asyncio.TimeoutError:
+        TASKS[task_id].update(status='failed', progress=0, message='timeout', error_class='timeout',
+                              error_detail=f'timed out after {timeout:g}s')
+        _count_error('timeout', 'failed')
+    except asyncio.CancelledError:
+        if _SHUTTING_DOWN and TASKS[task_id].get('status') != 'cancelled':
+            # 关停中断：保持未结束状态，重启后重新排队
+            TASKS[task_id].update(status='pending', progress=0, message='interrupted by shutdown')
+        else:
+            TASKS[task_id].update(status='cancelled', progress=0, message='cancelled', finished_at=time.time())
+            _record_usage(TASKS[task_id])
+        raise
+    except Exception as e:
+        t = TASKS[task_id]
+        cls = _classify_error(e)
+        detail = f"{cls}: {e}"[:200]
+        delay = None if _SHUTTING_DOWN else _retry_delay(t, cls)
+        if delay is not None:
+            # 交还调度，退避期间不占 worker；由 _task_done（本地）或 worker（分布式）按 retry_at 重新排队
+            retries = dict(t.get('retries') or {})
+            retries[cls] = retries.get(cls, 0) + 1
+            t.update(status='pending', progress=0, message=f'retrying in {delay:g}s', error_class=cls,
+                     error_detail=detail, retries=retries, retry_at=time.time() + delay)
+            _count_error(cls, 'retried')
+            print(f"[retry] {task_id} {cls} attempt {retries[cls]}, retrying in {delay:g}s: {e}", file=sys.stderr)
+            return
+        t.update(status='failed', progress=0, message='failed', error_class=cls, error_detail=detail)
+        _count_error(cls, 'failed')
+    TASKS[task_id]['finished_at'] = time.time()
+    _record_usage(TASKS[task_id])
+    if req.callback_url:
         try:
-            ydl.download([url])
+            await _webhooks().enqueue(task_id, req.callback_url, _webhook_payload(task_id, TASKS[task_id]))
         except Exception as e:
-            if _is_youtube_url(url):
-                # 尝试备用客户端组合
-                fallback = opts.copy()
-                cookies_in_use = bool(opts.get('cookiefile'))
-                if cookies_in_use:
-                    fallback.setdefault('extractor_args', {}).setdefault('youtube', {})['player_client'] = ['web_safari', 'web']
-                else:
-                    fallback.setdefault('extractor_args', {}).setdefault('youtube', {})['player_client'] = ['ios', 'android_creator']
-                with yt_dlp.YoutubeDL(fallback) as y2:
-                    y2.download([url])
-            else:
-                raise
+            print(f"[webhook] failed to queue callback for {task_id}: {e}", file=sys.stderr)
 
-    files = list(TEMP_DIR.glob(f"{basename}.*"))
-    if not files:
-        raise HTTPException(status_code=500, detail="Audio file not generated")
-    f = files[0]
 
-    return {
-        'filename': f.name,
-        'file_path': str(f),
-        'title': title,
-        'duration': duration,
-    }
+async def _execute_task(task_id: str, req: ProcessRequest) -> None:
+    TASKS[task_id].update(status='processing', progress=10, message='fetching video info', started_at=time.time())
+    if req.mode == 'url':
+        TASKS[task_id]['canonical_id'] = (await _canonicalize_async(req.url))[0]
+        stream = await asyncio.to_thread(_resolve_stream_blocking, req.url)
+        TASKS[task_id].update({
+            'status': 'completed',
+            'progress': 100,
+            'message': 'done',
+            'stream': stream,
+            'video_title': stream['title'],
+            'duration': stream['duration'],
+        })
+        return
+    segment = None
+    if req.segment_seconds:
+        segment = {'seconds': req.segment_seconds, 'overlap': req.segment_overlap,
+                   'at_silence': req.segment_at_silence}
+        TASKS[task_id]['segment_spec'] = segment
+    # 在线程池/进程池中执行阻塞下载
+    results = await _run_extract(req.url, _request_outputs(req), task_id, _clip_range(req.start, req.end),
+                                 req.trim_silence, segment)
+    result = results[0]
+    if segment:
+        # 分段输出没有单个成品文件，下载地址在 segments 与 /api/manifest 里
+        files = []
+        TASKS[task_id]['segments'] = [s for r in results for s in r['segments']]
+    else:
+        files = [{'format': r['format'], 'quality': r['quality'], 'filename': r['filename']} for r in results]
+    TASKS[task_id].update({
+        'status': 'completed',
+        'progress': 100,
+        'message': 'done',
+        'audio_file': files[0]['filename'] if files else None,
+        'audio_files': files,
+        'video_title': result['title'],
+        'duration': result['duration'],
+    })
+    if any(r.get('deduplicated') for r in results):
+        TASKS[task_id]['deduplicated'] = True
+    _presign_outputs(TASKS[task_id])
 
 
 def _cleanup_old_files(max_age_hours: int = 6) -> None:
@@ -306,7 +4055,8 @@ async def diag():
         "cookiefile_path": cookies_file,
         "douyin_cookiefile_exist": bool(douyin_cookies_file),
         "douyin_cookiefile_path": douyin_cookies_file,
-        "YDL_PROXY": os.environ.get("YDL_PROXY"),
+        "YDL_PROXY": _redact_proxy(os.environ.get("YDL_PROXY")) if os.environ.get("YDL_PROXY") else None,
+        "proxy_pool": _PROXY_POOL.snapshot() if _PROXY_POOL else None,
         "YT_COOKIES_FILE": os.environ.get("YT_COOKIES_FILE"),
         "YT_COOKIES_URL": bool(os.environ.get("YT_COOKIES_URL")),
         "YT_COOKIES_B64": bool(os.environ.get("YT_COOKIES_B64")),
@@ -314,64 +4064,289 @@ async def diag():
         "DY_COOKIES_URL": bool(os.environ.get("DY_COOKIES_URL")),
         "DY_COOKIES_B64": bool(os.environ.get("DY_COOKIES_B64")),
         "GEO_BYPASS_COUNTRY": os.environ.get("GEO_BYPASS_COUNTRY", "US"),
+        "JOB_QUEUE": JOB_QUEUE,
+        "STORAGE_BACKEND": STORAGE_BACKEND,
+        "throttle": {name: limiter.snapshot() for name, limiter in list(_HOST_LIMITERS.items())},
+        "short_link_aliases": len(_ALIAS_CACHE),
+        "search_index": _search_index().count(),
+        "fingerprints": _fingerprints().count() if FINGERPRINT_ENABLED else None,
+        "prefetch": _prefetcher().snapshot(),
+        "webhooks": _webhooks().stats(),
+        "errors": _ERROR_COUNTS,
+        "clients": _client_usage_report(),
+        "retry_waiting": len(_RETRY_TIMERS),
+        "stream_cache": len(_STREAM_CACHE),
+        "EXTRACT_BACKEND": EXTRACT_BACKEND,
+        "EXTRACT_WORKERS": EXTRACT_WORKERS,
+        "DOWNLOAD_WORKERS": DOWNLOAD_WORKERS,
+        "TRANSCODE_WORKERS": TRANSCODE_WORKERS,
+        "TRANSCODE_QUEUE_SIZE": TRANSCODE_QUEUE_SIZE,
+        "FFMPEG_THREADS": FFMPEG_THREADS,
+        "FFMPEG_NICE": FFMPEG_NICE,
     }
 
 
+def _client_usage_report(name: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """各客户端的配额、累计用量与当前排队/下载中的任务数；name 指定时只返回该客户端。"""
+    live = _PIPELINE.scheduler.snapshot() if _PIPELINE is not None else {}
+    names = [name] if name else sorted(set(_CLIENT_USAGE) | set(live))
+    report = {}
+    for n in names:
+        cfg = _client_config(n)
+        report[n] = dict(_usage(n), weight=cfg['weight'], concurrency=cfg['concurrency'],
+                         rate_per_minute=cfg['rate'], **live.get(n, {'waiting': 0, 'downloading': 0}))
+    return report
+
+
+@app.get("/api/usage")
+async def client_usage(request: Request):
+    """调用方（按 API Key 识别）的配额与用量。"""
+    name = _client_of(request)
+    return {"client": name, **_client_usage_report(name)[name]}
+
+
 @app.post("/api/process", response_model=ProcessResponse)
-async def create_task(req: ProcessRequest, background_tasks: BackgroundTasks):
+async def create_task(req: ProcessRequest, background_tasks: BackgroundTasks, request: Request):
+    client = _client_of(request)
     if not req.url.startswith(("http://", "https://")):
         raise HTTPException(status_code=400, detail="Invalid URL")
+    if req.mode not in ('file', 'url'):
+        raise HTTPException(status_code=400, detail="mode must be file or url")
+    # 提前校验片段参数，非法时直接返回 400
+    _clip_range(req.start, req.end)
+    if req.callback_url and not req.callback_url.startswith(('http://', 'https://')):
+        raise HTTPException(status_code=400, detail="callback_url must be an http(s) URL")
+    if req.segment_seconds:
+        if req.mode != 'file':
+            raise HTTPException(status_code=400, detail="segmented output requires mode=file")
+        if req.segment_overlap >= req.segment_seconds:
+            raise HTTPException(status_code=400, detail="segment_overlap must be less than segment_seconds")
+
+    if _SHUTTING_DOWN:
+        raise HTTPException(status_code=503, detail="server is shutting down")
+    _admit_submission(client)
 
     import uuid
     task_id = str(uuid.uuid4())
-    TASKS[task_id] = {
+    task = {
         'status': 'pending',
         'progress': 0,
         'message': 'queued',
         'created_at': time.time(),
+        'client': client,
+    }
+    if req.mode == 'file':
+        # 之前处理/解析过的视频直接带上时长，调度时不必再解析
+        offline = _canonical_offline(req.url)
+        if offline:
+            task['expected_duration'] = await asyncio.to_thread(_known_duration, offline[0])
+
+    queue = _job_queue()
+    if queue is not None:
+        # 分布式模式：只入队，由 worker 进程领取执行
+        await asyncio.to_thread(queue.enqueue, task_id, req.model_dump(), task)
+    else:
+        if _TASK_JOURNAL is not None:
+            await asyncio.to_thread(_TASK_JOURNAL.add, task_id, req.model_dump(), task)
+        TASKS[task_id] = task
+        # 在当前事件循环中调度任务，避免在后台线程中创建协程导致的无事件循环错误
+        _start_task(task_id, req)
+    return ProcessResponse(task_id=task_id, message="accepted")
+
+
+_STATUS_NOT_FOUND = {
+    "status": "failed",
+    "progress": 0,
+    "message": "task not found",
+    "error_detail": "not_found"
+}
+# 批量查询一次最多的任务数
+STATUS_BULK_LIMIT = 500
+
+
+def _status_payload(t: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "status": str(t.get('status', 'pending')),
+        "progress": int(t.get('progress', 0) or 0),
+        "message": str(t.get('message', '')),
+        "video_title": t.get('video_title'),
+        "audio_file": t.get('audio_file'),
+        "audio_files": t.get('audio_files'),
+        "download_url": t.get('download_url'),
+        "stream": t.get('stream'),
+        "duration": int(t.get('duration', 0) or 0) if t.get('duration') is not None else None,
+        "canonical_id": t.get('canonical_id'),
+        "deduplicated": bool(t.get('deduplicated')),
+        "estimate": t.get('estimate'),
+        "segments": t.get('segments'),
+        "error_detail": t.get('error_detail'),
+        "error_class": t.get('error_class'),
+        "retries": t.get('retries'),
+        "retry_at": t.get('retry_at'),
     }
 
-    async def run():
-        try:
-            TASKS[task_id].update(status='processing', progress=10, message='fetching video info')
-            # 在线程池中执行阻塞下载
-            result = await asyncio.to_thread(_extract_audio_blocking, req.url, req.audio_format, req.audio_quality)
-            TASKS[task_id].update({
-                'status': 'completed',
-                'progress': 100,
-                'message': 'done',
-                'audio_file': result['filename'],
-                'video_title': result['title'],
-                'duration': result['duration'],
-            })
+
+def _json_bytes(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def _etag_of(body: bytes) -> str:
+    return '"' + hashlib.md5(body).hexdigest()[:16] + '"'
+
+
+_STATUS_NOT_FOUND_BODY = _json_bytes(_STATUS_NOT_FOUND)
+_STATUS_NOT_FOUND_ETAG = _etag_of(_STATUS_NOT_FOUND_BODY)
+
+
+def _status_body_of(t: Optional[Dict[str, Any]]) -> Tuple[bytes, str]:
+    """返回 (序列化好的状态 JSON, ETag)。本进程任务的结果缓存在 _TaskState 上，任务变化时才重建。"""
+    if t is None:
+        return _STATUS_NOT_FOUND_BODY, _STATUS_NOT_FOUND_ETAG
+    if t.get('urls_expire_at') and t['urls_expire_at'] - 300 < time.time():
+        # 预签名地址快过期时重新签名（修改任务会使缓存的响应失效）
+        _presign_outputs(t)
+    cached = getattr(t, '_status_body', None)
+    if cached is not None:
+        return cached
+    body = _json_bytes(_status_payload(t))
+    result = (body, _etag_of(body))
+    if isinstance(t, _TaskState):
+        t._status_body = result
+    return result
+
+
+async def _status_body(task_id: str) -> Tuple[bytes, str]:
+    return _status_body_of(await _get_task_async(task_id))
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    tags = request.headers.get('if-none-match')
+    if not tags:
+        return False
+    return any(tag.strip().removeprefix('W/') in (etag, '*') for tag in tags.split(','))
+
+
+def _status_response(request: Request, body: bytes, etag: str) -> Response:
+    # no-cache：允许缓存但每次都要用 If-None-Match 重新验证
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='application/json', headers=headers)
+
+
+async def _bulk_status_response(request: Request, ids: List[str]) -> Response:
+    ids = list(dict.fromkeys(i.strip() for i in ids if i and i.strip()))
+    if not ids:
+        raise HTTPException(status_code=400, detail="ids is required")
+    if len(ids) > STATUS_BULK_LIMIT:
+        raise HTTPException(status_code=400, detail=f"at most {STATUS_BULK_LIMIT} ids per request")
+    tasks = await _get_tasks(ids)
+    parts, etags = [], []
+    for task_id in ids:
+        try:
+            body, etag = _status_body_of(tasks.get(task_id))
         except Exception as e:
-            TASKS[task_id].update(status='failed', progress=0, message='failed', error_detail=str(e)[:200])
+            body = _json_bytes({"status": "failed", "progress": 0, "message": "internal error",
+                                "error_detail": str(e)[:200]})
+            etag = _etag_of(body)
+        parts.append(_json_bytes(task_id) + b':' + body)
+        etags.append(etag)
+    body = b'{"tasks":{' + b','.join(parts) + b'}}'
+    etag = _etag_of('\n'.join(f"{i}={e}" for i, e in zip(ids, etags)).encode())
+    return _status_response(request, body, etag)
 
-    # 在当前事件循环中调度任务，避免在后台线程中创建协程导致的无事件循环错误
-    asyncio.create_task(run())
-    return ProcessResponse(task_id=task_id, message="accepted")
+
+_TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def _task_finished(t: Optional[Dict[str, Any]]) -> bool:
+    return t is None or t.get('status') in _TERMINAL_STATUSES
+
+
+class _TaskWatcher:
+    """订阅一组任务的变化。任务写入 TASKS 时由 _notify_task 唤醒，不靠定时轮询；
+    只有分布式模式下（任务在 worker 进程里）才退化为按 STATUS_QUEUE_POLL 检查共享队列。"""
+
+    def __init__(self, task_ids=()):
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        self.event = asyncio.Event()
+        self.task_ids: set = set()
+        self.add(task_ids)
+
+    def add(self, task_ids) -> None:
+        for task_id in task_ids:
+            _TASK_WATCHERS.setdefault(task_id, set()).add(self)
+            self.task_ids.add(task_id)
+
+    def remove(self, task_ids) -> None:
+        for task_id in list(task_ids):
+            watchers = _TASK_WATCHERS.get(task_id)
+            if watchers is not None:
+                watchers.discard(self)
+                if not watchers:
+                    del _TASK_WATCHERS[task_id]
+            self.task_ids.discard(task_id)
+
+    def notify(self) -> None:
+        if threading.get_ident() == self.thread:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout: Optional[float] = None) -> None:
+        """等到任一订阅任务变化或超时。"""
+        if _job_queue() is not None and any(i not in TASKS for i in self.task_ids):
+            timeout = STATUS_QUEUE_POLL if timeout is None else min(timeout, STATUS_QUEUE_POLL)
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+    def __enter__(self) -> "_TaskWatcher":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.remove(self.task_ids)
+
+
+async def _wait_for_change(task_id: str, etag: str, timeout: float) -> Tuple[bytes, str]:
+    """长轮询：等到任务状态的 ETag 与客户端持有的不同、任务结束或超时。"""
+    deadline = asyncio.get_running_loop().time() + min(timeout, STATUS_MAX_WAIT)
+    with _TaskWatcher([task_id]) as watcher:
+        while True:
+            t = await _get_task_async(task_id)
+            body, current = _status_body_of(t)
+            remaining = deadline - asyncio.get_running_loop().time()
+            if current != etag or remaining <= 0 or _task_finished(t):
+                return body, current
+            await watcher.wait(remaining)
+
+
+class BulkStatusRequest(BaseModel):
+    ids: List[str]
+
+
+@app.get("/api/status")
+async def bulk_status(request: Request, ids: str = ""):
+    """批量查询：/api/status?ids=a,b,c，返回 {"tasks": {task_id: 状态}}。"""
+    return await _bulk_status_response(request, ids.split(','))
+
+
+@app.post("/api/status")
+async def bulk_status_post(request: Request, req: BulkStatusRequest):
+    return await _bulk_status_response(request, req.ids)
 
 
 @app.get("/api/status/{task_id}")
-async def status(task_id: str):
+async def status(task_id: str, request: Request, wait: float = 0):
+    """wait>0 且 If-None-Match 与当前状态一致时挂起，直到任务变化或等满 wait 秒（长轮询）。"""
     try:
-        if task_id not in TASKS:
-            return JSONResponse({
-                "status": "failed",
-                "progress": 0,
-                "message": "task not found",
-                "error_detail": "not_found"
-            }, status_code=200)
-        t = TASKS[task_id]
-        return {
-            "status": str(t.get('status', 'pending')),
-            "progress": int(t.get('progress', 0) or 0),
-            "message": str(t.get('message', '')),
-            "video_title": t.get('video_title'),
-            "audio_file": t.get('audio_file'),
-            "duration": int(t.get('duration', 0) or 0) if t.get('duration') is not None else None,
-            "error_detail": t.get('error_detail'),
-        }
+        body, etag = await _status_body(task_id)
+        if wait > 0 and _not_modified(request, etag):
+            body, etag = await _wait_for_change(task_id, etag, wait)
+        return _status_response(request, body, etag)
     except Exception as e:
         # 永远返回200+JSON，避免前端解析失败导致一直卡住
         return JSONResponse({
@@ -382,13 +4357,244 @@ async def status(task_id: str):
         }, status_code=200)
 
 
+@app.get("/api/status/{task_id}/events")
+async def status_events(task_id: str, request: Request):
+    """Server-Sent Events：连接时推送当前状态，之后每次变化推送一次，任务结束后关闭。"""
+
+    async def events():
+        loop = asyncio.get_running_loop()
+        # 断线重连时 Last-Event-ID 即上次收到的 ETag，状态没变就不重复推送
+        last = request.headers.get('last-event-id')
+        last_sent = loop.time()
+        with _TaskWatcher([task_id]) as watcher:
+            while True:
+                t = await _get_task_async(task_id)
+                body, etag = _status_body_of(t)
+                if etag != last:
+                    last, last_sent = etag, loop.time()
+                    yield b'id: ' + etag.encode() + b'\nevent: status\ndata: ' + body + b'\n\n'
+                if _task_finished(t):
+                    return
+                if loop.time() - last_sent >= SSE_KEEPALIVE:
+                    last_sent = loop.time()
+                    yield b': keepalive\n\n'
+                await watcher.wait(SSE_KEEPALIVE)
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.websocket("/ws/status")
+async def status_ws(websocket: WebSocket):
+    """一个连接订阅多个任务：客户端发送 {"subscribe": [...]} / {"unsubscribe": [...]}，
+    服务端在任务变化时推送 {"tasks": {task_id: 状态}}；任务结束推送最终状态后自动退订。"""
+    await websocket.accept()
+    sent: Dict[str, str] = {}
+    with _TaskWatcher() as watcher:
+
+        async def reader() -> None:
+            try:
+                while True:
+                    try:
+                        msg = await websocket.receive_json()
+                    except ValueError:
+                        continue
+                    if not isinstance(msg, dict):
+                        continue
+                    remove = [str(i) for i in msg.get('unsubscribe') or []]
+                    watcher.remove(remove)
+                    for task_id in remove:
+                        sent.pop(task_id, None)
+                    room = STATUS_BULK_LIMIT - len(watcher.task_ids)
+                    watcher.add([str(i) for i in msg.get('subscribe') or []][:max(room, 0)])
+                    watcher.event.set()
+            finally:
+                watcher.event.set()
+
+        read_task = asyncio.create_task(reader())
+        try:
+            while not read_task.done():
+                parts = []
+                task_ids = list(watcher.task_ids)
+                tasks = await _get_tasks(task_ids)
+                for task_id in task_ids:
+                    t = tasks.get(task_id)
+                    body, etag = _status_body_of(t)
+                    if sent.get(task_id) != etag:
+                        sent[task_id] = etag
+                        parts.append(_json_bytes(task_id) + b':' + body)
+                    if _task_finished(t):
+                        watcher.remove([task_id])
+                        sent.pop(task_id, None)
+                if parts:
+                    await websocket.send_text((b'{"tasks":{' + b','.join(parts) + b'}}').decode())
+                await watcher.wait()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            read_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, WebSocketDisconnect):
+                await read_task
+
+
+@app.delete("/api/tasks/{task_id}")
+async def cancel_task(task_id: str):
+    """取消任务：中断下载、结束 ffmpeg、删除部分文件并释放 worker 槽位。"""
+    runner = _TASK_RUNNERS.get(task_id)
+    if runner is not None:
+        runner.cancel()
+        TASKS[task_id].update(status='cancelled', progress=0, message='cancelled')
+        return {"task_id": task_id, "status": "cancelled"}
+    timer = _RETRY_TIMERS.pop(task_id, None)
+    if timer is not None:
+        # 正在等待重试：取消定时器即可，没有进行中的下载
+        timer.cancel()
+        TASKS[task_id].update(status='cancelled', progress=0, message='cancelled', finished_at=time.time())
+        _record_usage(TASKS[task_id])
+        return {"task_id": task_id, "status": "cancelled"}
+    queue = _job_queue()
+    if queue is not None and await asyncio.to_thread(queue.cancel, task_id):
+        return {"task_id": task_id, "status": "cancelled"}
+    t = await _get_task_async(task_id)
+    if t is None:
+        raise HTTPException(status_code=404, detail="task not found")
+    # 已结束的任务原样返回其状态
+    return {"task_id": task_id, "status": t.get('status')}
+
+
 @app.get("/api/download/{filename}")
 async def download(filename: str):
     p = TEMP_DIR / filename
     if not p.exists():
+        storage = _storage()
+        if storage.remote and '/' not in filename:
+            # 本地缓存已淘汰（或由其他节点生成），重定向到对象存储
+            return RedirectResponse(storage.presign(filename, STORAGE_URL_EXPIRES), status_code=302)
         raise HTTPException(status_code=404, detail="file not found")
-    media_type = 'audio/mpeg' if p.suffix.lower() == '.mp3' else 'audio/mp4'
-    return FileResponse(str(p), media_type=media_type, filename=p.name)
+    return FileResponse(str(p), media_type=_media_type(p.name), filename=p.name)
+
+
+@app.get("/api/manifest/{task_id}")
+async def segment_manifest(task_id: str):
+    """分段清单：已写完的分段的起止时间（秒，相对输出音频）与下载地址。
+
+    任务进行中即可获取；complete 为 false 时之后还会有新的分段。
+    """
+    t = await _get_task_async(task_id)
+    if t is None:
+        raise HTTPException(status_code=404, detail="task not found")
+    spec = t.get('segment_spec')
+    if not spec:
+        raise HTTPException(status_code=404, detail="task has no segmented output")
+    if t.get('urls_expire_at') and t['urls_expire_at'] - 300 < time.time():
+        _presign_outputs(t)
+    return {
+        'task_id': task_id,
+        'status': t.get('status'),
+        'complete': t.get('status') == 'completed',
+        'segment_seconds': spec['seconds'],
+        'overlap': spec['overlap'],
+        'at_silence': spec['at_silence'],
+        'duration': t.get('duration'),
+        'segments': t.get('segments') or [],
+        'urls_expire_at': t.get('urls_expire_at'),
+    }
+
+
+@app.get("/api/peaks/{filename}")
+async def get_peaks(filename: str, request: Request, level: Optional[int] = None):
+    """波形峰值；level 为缩放级别下标，不传则返回全部级别。成品不可变，可长期缓存。"""
+    p = _peaks_path(filename)
+    if not p.exists() and _storage().remote and '/' not in filename:
+        await asyncio.to_thread(_storage().fetch, p.name, p)
+    if not p.exists():
+        raise HTTPException(status_code=404, detail="peaks not found")
+    st = p.stat()
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}' + (f'-{level}"' if level is not None else '"')
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=86400, immutable'}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    if level is None:
+        return FileResponse(str(p), media_type='application/json', headers=headers)
+    data = json.loads(p.read_text())
+    if not 0 <= level < len(data['levels']):
+        raise HTTPException(status_code=404, detail="level not found")
+    data['levels'] = [data['levels'][level]]
+    return JSONResponse(data, headers=headers)
+
+
+def _fingerprint_audio_blocking(data: bytes) -> 'np.ndarray':
+    """对上传的音频计算指纹（与转码时相同的 PCM 参数）。"""
+    with tempfile.NamedTemporaryFile(dir=TEMP_DIR, prefix='lookup_') as f:
+        f.write(data)
+        f.flush()
+        proc = subprocess.run(
+            ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', f.name, '-map', '0:a:0',
+             '-ac', '1', '-ar', str(PEAKS_SAMPLE_RATE), '-f', 's16le', 'pipe:1'],
+            capture_output=True,
+        )
+    if proc.returncode != 0:
+        raise HTTPException(status_code=400, detail=f"cannot decode audio: {proc.stderr.decode(errors='replace').strip()[-200:]}")
+    builder = _FingerprintBuilder(PEAKS_SAMPLE_RATE)
+    builder.feed(proc.stdout)
+    return builder.finish()
+
+
+def _fingerprint_match(fp_id: int) -> Optional[Dict[str, Any]]:
+    info = _fingerprints().info(fp_id)
+    if info is None:
+        return None
+    t = {'audio_files': [a for a in info.pop('artifacts') if _artifact_alive(a['filename'])]}
+    _presign_outputs(t)
+    return dict(info, match=True, audio_files=t['audio_files'])
+
+
+@app.get("/api/fingerprint/lookup")
+async def fingerprint_lookup(url: str, start: Optional[float] = None, end: Optional[float] = None):
+    """提交任务前查询：这个链接（或其他平台上的同一段音频）是否已有成品。只查索引，不下载。"""
+    if not FINGERPRINT_ENABLED:
+        raise HTTPException(status_code=503, detail="fingerprinting disabled")
+    canonical_id, _ = await _canonicalize_async(url)
+    fp_id = await asyncio.to_thread(_fingerprints().lookup_source, _source_key(canonical_id, _clip_range(start, end)))
+    result = await asyncio.to_thread(_fingerprint_match, fp_id) if fp_id is not None else None
+    return dict(result or {'match': False}, canonical_id=canonical_id)
+
+
+@app.post("/api/fingerprint/lookup")
+async def fingerprint_lookup_audio(request: Request):
+    """请求体为一段音频文件，按指纹查找近似重复的已有成品。"""
+    if not FINGERPRINT_ENABLED:
+        raise HTTPException(status_code=503, detail="fingerprinting disabled")
+    limit = FINGERPRINT_LOOKUP_MAX_MB << 20
+    if int(request.headers.get('content-length') or 0) > limit:
+        raise HTTPException(status_code=413, detail="audio too large")
+    data = await request.body()
+    if not data:
+        raise HTTPException(status_code=400, detail="empty body")
+    if len(data) > limit:
+        raise HTTPException(status_code=413, detail="audio too large")
+    hashes = await asyncio.to_thread(_fingerprint_audio_blocking, data)
+    found = await asyncio.to_thread(_fingerprints().match, hashes)
+    if found is None:
+        return {'match': False}
+    result = await asyncio.to_thread(_fingerprint_match, found[0])
+    return dict(result, ber=round(found[1], 4)) if result else {'match': False}
+
+
+async def _cancel_on_disconnect(request: Request, coro):
+    """等待 coro 完成；期间客户端断开连接则取消它，不再为无人接收的请求占用 worker。"""
+    work = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({work}, timeout=1.0)
+            if done:
+                return work.result()
+            if await request.is_disconnected():
+                work.cancel()
+                raise HTTPException(status_code=499, detail="client disconnected")
+    except asyncio.CancelledError:
+        work.cancel()
+        raise
 
 
 # Simple sync endpoint for compatibility with existing iOS code
@@ -397,21 +4603,223 @@ class ExtractRequest(BaseModel):
     format: str = 'm4a'
     mode: str = 'stream'
     quality: str = 'good'
+    start: Optional[float] = Field(None, ge=0)
+    end: Optional[float] = Field(None, gt=0)
+    timeout: Optional[float] = Field(None, gt=0)
+    trim_silence: bool = False
 
 @app.post("/extract")
-async def simple_extract(req: ExtractRequest):
-    result = await asyncio.to_thread(_extract_audio_blocking, req.url, req.format, req.quality)
-    media_type = 'audio/mpeg' if req.format == 'mp3' else 'audio/mp4'
-    return FileResponse(result['file_path'], media_type=media_type, filename=result['filename'])
+async def simple_extract(req: ExtractRequest, request: Request):
+    client = _client_of(request)
+    _admit_submission(client)
+    if req.mode == 'url':
+        return await asyncio.to_thread(_resolve_stream_blocking, req.url)
+    clip = _clip_range(req.start, req.end)
+    timeout = req.timeout or TASK_TIMEOUT or None
+    work = _run_extract(req.url, [(req.format, req.quality)], clip=clip, trim_silence=req.trim_silence,
+                        client=client)
+    try:
+        result = (await _cancel_on_disconnect(request, asyncio.wait_for(work, timeout)))[0]
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"timed out after {timeout:g}s")
+    path = Path(result['file_path'])
+    if not path.exists() and _storage().remote:
+        # 复用的已有成品可能已从本地缓存淘汰
+        await asyncio.to_thread(_storage().fetch, result['filename'], path)
+    return FileResponse(result['file_path'], media_type=_media_type(result['filename']), filename=result['filename'])
 
 
 # ===== 音乐搜索相关API =====
 
+class _SearchIndex:
+    """本地全文索引：上游搜索返回过的歌曲（kind=song）和解析过的视频标题（kind=video）。
+
+    使用 FTS5 trigram 分词，中文也能按子串匹配；不足 3 个字的词 trigram 无法匹配，退回 LIKE 扫描。
+    SQLite 不支持 FTS5 时全部走 LIKE。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS songs (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                artist TEXT NOT NULL DEFAULT '',
+                album TEXT NOT NULL DEFAULT '',
+                data TEXT NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 1,
+                updated_at REAL NOT NULL
+            )''')
+        try:
+            self.db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5("
+                "name, artist, album, content='songs', content_rowid='rowid', tokenize='trigram')"
+            )
+            self.db.executescript('''
+                CREATE TRIGGER IF NOT EXISTS songs_ai AFTER INSERT ON songs BEGIN
+                    INSERT INTO songs_fts (rowid, name, artist, album) VALUES (new.rowid, new.name, new.artist, new.album);
+                END;
+                CREATE TRIGGER IF NOT EXISTS songs_ad AFTER DELETE ON songs BEGIN
+                    INSERT INTO songs_fts (songs_fts, rowid, name, artist, album)
+                    VALUES ('delete', old.rowid, old.name, old.artist, old.album);
+                END;
+                CREATE TRIGGER IF NOT EXISTS songs_au AFTER UPDATE OF name, artist, album ON songs BEGIN
+                    INSERT INTO songs_fts (songs_fts, rowid, name, artist, album)
+                    VALUES ('delete', old.rowid, old.name, old.artist, old.album);
+                    INSERT INTO songs_fts (rowid, name, artist, album) VALUES (new.rowid, new.name, new.artist, new.album);
+                END;
+            ''')
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"[search] FTS5 unavailable, falling back to LIKE: {e}", file=sys.stderr)
+            self.fts = False
+
+    def add(self, entries: List[Tuple[str, str, str, str, str, Dict[str, Any]]]) -> None:
+        """entries 为 [(key, kind, name, artist, album, data), ...]；已有条目刷新内容并累加命中次数。"""
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany(
+                    "INSERT INTO songs (key, kind, name, artist, album, data, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET name = excluded.name, artist = excluded.artist, "
+                    "album = excluded.album, data = excluded.data, hits = hits + 1, updated_at = excluded.updated_at",
+                    [(key, kind, name or '', artist or '', album or '', json.dumps(data, ensure_ascii=False), now)
+                     for key, kind, name, artist, album, data in entries],
+                )
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def search(self, query: str, limit: int = 10, kind: Optional[str] = None,
+               fresh_after: float = 0) -> List[Dict[str, Any]]:
+        terms = query.split()
+        if not terms:
+            return []
+        long_terms = [t for t in terms if len(t) >= 3] if self.fts else []
+        where, params = ['s.updated_at >= ?'], [fresh_after]
+        if kind:
+            where.append('s.kind = ?')
+            params.append(kind)
+        for t in terms:
+            if t not in long_terms:
+                where.append("(s.name || ' ' || s.artist || ' ' || s.album) LIKE ? ESCAPE '\\'")
+                params.append('%' + t.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if long_terms:
+            match = ' '.join('"' + t.replace('"', '""') + '"' for t in long_terms)
+            sql = ("SELECT s.kind, s.data FROM songs_fts f JOIN songs s ON s.rowid = f.rowid "
+                   f"WHERE songs_fts MATCH ? AND {' AND '.join(where)} "
+                   "ORDER BY bm25(songs_fts) - s.hits * 0.1 LIMIT ?")
+            params = [match] + params
+        else:
+            sql = (f"SELECT s.kind, s.data FROM songs s WHERE {' AND '.join(where)} "
+                   "ORDER BY s.hits DESC, s.updated_at DESC LIMIT ?")
+        with self.lock:
+            rows = self.db.execute(sql, params + [limit]).fetchall()
+        return [dict(json.loads(data), kind=k) for k, data in rows]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.db.execute('SELECT data FROM songs WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+
+
+_SEARCH_INDEX: Optional[_SearchIndex] = None
+
+
+def _search_index() -> _SearchIndex:
+    global _SEARCH_INDEX
+    if _SEARCH_INDEX is None:
+        _SEARCH_INDEX = _SearchIndex(SEARCH_INDEX_PATH)
+    return _SEARCH_INDEX
+
+
+def _index_songs(songs: List[Dict[str, Any]]) -> None:
+    try:
+        _search_index().add([
+            (f"netease:{song['id']}", 'song', song.get('name'), song.get('artist'), song.get('album'), song)
+            for song in songs if song.get('id') is not None
+        ])
+    except Exception as e:
+        print(f"[search] index failed: {e}", file=sys.stderr)
+
+
+def _index_video(canonical_id: str, url: str, title: Optional[str], duration: Optional[float]) -> None:
+    """把解析过的视频标题加入索引（搜索伪 URL 如 ytsearch1: 不收录）。duration 须为整个视频的时长。"""
+    if not title or not url.startswith(('http://', 'https://')):
+        return
+    try:
+        # full_duration 标明时长来自完整信息；旧记录的 duration 可能是片段长度，调度不采信
+        _search_index().add([(canonical_id, 'video', title, '', '',
+                              {'id': canonical_id, 'name': title, 'url': url, 'duration': duration,
+                               'full_duration': duration})])
+    except Exception as e:
+        print(f"[search] index failed: {e}", file=sys.stderr)
+
+
+# 后台刷新中的 (keyword, limit)，避免同一查询并发刷新；任务引用保存在集合里防止被回收
+_SEARCH_REFRESHING: set = set()
+_BACKGROUND_TASKS: set = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+
+async def _refresh_search(keyword: str, limit: int) -> None:
+    key = (keyword, limit)
+    if key in _SEARCH_REFRESHING:
+        return
+    _SEARCH_REFRESHING.add(key)
+    try:
+        await _search_upstream(keyword, limit)
+    except Exception as e:
+        print(f"[search] background refresh failed for {keyword!r}: {e}", file=sys.stderr)
+    finally:
+        _SEARCH_REFRESHING.discard(key)
+
+
+@app.get("/api/music/suggest")
+async def suggest_music(q: str, limit: int = 10):
+    """搜索框自动补全：只查本地索引，不访问上游。"""
+    limit = max(1, min(limit, 50))
+    items = await asyncio.to_thread(_search_index().search, q, limit)
+    return {'suggestions': items}
+
+
 @app.get("/api/music/search")
-async def search_music(keyword: str, limit: int = 30):
+async def search_music(keyword: str, limit: int = 30, mode: Optional[str] = None):
     """
     搜索音乐 - 使用网易云音乐API
+    mode=local_first 时本地索引里有足够的新鲜结果就直接返回，并在后台向上游刷新
     """
+    if (mode or SEARCH_MODE) == 'local_first':
+        local = await asyncio.to_thread(
+            _search_index().search, keyword, limit, 'song', time.time() - SEARCH_FRESH_SECONDS
+        )
+        if local and len(local) >= min(limit, SEARCH_LOCAL_MIN_HITS):
+            _spawn(_refresh_search(keyword, limit))
+            songs = [{k: v for k, v in song.items() if k != 'kind'} for song in local]
+            _prefetcher().submit(songs)
+            return {'songs': songs, 'source': 'local'}
+    songs = await _search_upstream(keyword, limit)
+    _prefetcher().submit(songs)
+    return {'songs': songs}
+
+
+async def _search_upstream(keyword: str, limit: int) -> List[Dict[str, Any]]:
     try:
         import aiohttp
         
@@ -451,21 +4859,203 @@ async def search_music(keyword: str, limit: int = 30):
                             'audioURL': None  # 需要单独请求
                         })
                 
-                return {'songs': songs}
+                await asyncio.to_thread(_index_songs, songs)
+                return songs
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
 
 
+# ===== 搜索结果预取 =====
+# 搜索返回后，客户端几乎总会对前几条调用 /api/music/url 和 /api/music/lyric。
+# 预取器用少量后台 worker 提前解析并缓存，有用户请求在处理时让路，并遵守上游限流。
+
+MUSIC_API_BASE = "https://netease-cloud-music-api.vercel.app"
+
+_MUSIC_URL_CACHE: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+_LYRIC_CACHE: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+# (kind, id) -> (进行中的解析, 是否由预取发起)，用户请求与预取共用，避免重复请求上游
+_MUSIC_INFLIGHT: Dict[Tuple[str, int], Tuple[asyncio.Future, bool]] = {}
+
+
+def _cache_get(cache: OrderedDict, key: int) -> Optional[Dict[str, Any]]:
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry['expires_at'] <= time.time():
+        del cache[key]
+        if entry['prefetched'] and not entry['used']:
+            _prefetcher().stats['expired_unused'] += 1
+        return None
+    cache.move_to_end(key)
+    return entry
+
+
+def _cache_put(cache: OrderedDict, key: int, value: Any, ttl: float, prefetched: bool) -> None:
+    cache[key] = {'value': value, 'expires_at': time.time() + ttl, 'prefetched': prefetched, 'used': False}
+    cache.move_to_end(key)
+    while len(cache) > STREAM_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+async def _cached_music(kind: str, song_id: int, fetch: Callable[[int], Any], prefetch: bool = False) -> Any:
+    """带缓存的播放地址/歌词解析。prefetch=False 为用户请求，计入预取命中统计。"""
+    cache = _MUSIC_URL_CACHE if kind == 'url' else _LYRIC_CACHE
+    stats = _prefetcher().stats
+    if not prefetch:
+        stats['user_requests'] += 1
+    entry = _cache_get(cache, song_id)
+    if entry is not None:
+        if not prefetch:
+            if entry['prefetched'] and not entry['used']:
+                stats['hits'] += 1
+            entry['used'] = True
+        return entry['value']
+    if prefetch:
+        stats[f'prefetched_{kind}s'] += 1
+    key = (kind, song_id)
+    pending, by_prefetch = _MUSIC_INFLIGHT.get(key, (None, False))
+    if pending is not None:
+        try:
+            value = await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            # 被取消的是对方（如关停时的预取 worker）时自己重新解析
+            if not pending.cancelled():
+                raise
+        else:
+            # 预取进行中：用户请求直接等它，同样算命中
+            if not prefetch:
+                stats['hits' if by_prefetch else 'misses'] += 1
+                entry = _cache_get(cache, song_id)
+                if entry is not None:
+                    entry['used'] = True
+            return value
+    if not prefetch:
+        stats['misses'] += 1
+    fut = asyncio.get_running_loop().create_future()
+    _MUSIC_INFLIGHT[key] = (fut, prefetch)
+    try:
+        value = await fetch(song_id)
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # 没有其他等待者时避免 "exception was never retrieved"
+        raise
+    finally:
+        _MUSIC_INFLIGHT.pop(key, None)
+    if kind == 'url' and value.get('url'):
+        ttl = min(MUSIC_URL_TTL, _stream_expiry(value['url']) - time.time())
+        _cache_put(cache, song_id, value, ttl, prefetch)
+    elif kind == 'lyric' and value.get('lyric'):
+        _cache_put(cache, song_id, value, 86400, prefetch)
+    fut.set_result(value)
+    return value
+
+
+class _Prefetcher:
+    def __init__(self):
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.user_active = 0
+        self.idle: Optional[asyncio.Event] = None
+        self.stats = {'submitted': 0, 'dropped': 0, 'skipped_throttled': 0, 'errors': 0,
+                      'prefetched_urls': 0, 'prefetched_lyrics': 0,
+                      'user_requests': 0, 'hits': 0, 'misses': 0, 'expired_unused': 0}
+
+    def _start(self) -> None:
+        if self.queue is None:
+            self.queue = asyncio.Queue(PREFETCH_QUEUE_SIZE)
+            self.idle = asyncio.Event()
+            if self.user_active == 0:
+                self.idle.set()
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(PREFETCH_WORKERS)]
+
+    def submit(self, songs: List[Dict[str, Any]]) -> None:
+        if PREFETCH_TOP_N <= 0 or PREFETCH_WORKERS <= 0:
+            return
+        self._start()
+        for song in songs[:PREFETCH_TOP_N]:
+            song_id = song.get('id')
+            if not isinstance(song_id, int) or _cache_get(_MUSIC_URL_CACHE, song_id) is not None \
+                    or ('url', song_id) in _MUSIC_INFLIGHT:
+                continue
+            try:
+                self.queue.put_nowait(song_id)
+                self.stats['submitted'] += 1
+            except asyncio.QueueFull:
+                # 队列满说明预取跟不上，丢弃而不是堆积
+                self.stats['dropped'] += 1
+
+    @contextlib.asynccontextmanager
+    async def user_request(self):
+        """包住用户发起的请求；期间预取 worker 暂停领取新任务。"""
+        self.user_active += 1
+        if self.idle is not None:
+            self.idle.clear()
+        try:
+            yield
+        finally:
+            self.user_active -= 1
+            if self.user_active == 0 and self.idle is not None:
+                self.idle.set()
+
+    async def _worker(self) -> None:
+        limiter = _host_limiter(MUSIC_API_BASE)
+        while True:
+            song_id = await self.queue.get()
+            try:
+                await self.idle.wait()
+                if limiter.snapshot()['cooldown_remaining'] > 0:
+                    # 上游正在限流，预取直接放弃
+                    self.stats['skipped_throttled'] += 1
+                    continue
+                async with limiter.slot_async():
+                    await _cached_music('url', song_id, _resolve_music_url, prefetch=True)
+                    await _cached_music('lyric', song_id, _fetch_lyric, prefetch=True)
+            except Exception as e:
+                self.stats['errors'] += 1
+                print(f"[prefetch] {song_id}: {e}", file=sys.stderr)
+            finally:
+                self.queue.task_done()
+
+    def snapshot(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        prefetched = stats['prefetched_urls'] + stats['prefetched_lyrics']
+        requests = stats['user_requests']
+        # hit_rate：用户请求中由预取满足的比例；precision：预取结果被用上的比例
+        stats['hit_rate'] = round(stats['hits'] / requests, 3) if requests else None
+        stats['precision'] = round(stats['hits'] / prefetched, 3) if prefetched else None
+        stats['queued'] = self.queue.qsize() if self.queue is not None else 0
+        stats['top_n'] = PREFETCH_TOP_N
+        return stats
+
+
+_PREFETCHER: Optional[_Prefetcher] = None
+
+
+def _prefetcher() -> _Prefetcher:
+    global _PREFETCHER
+    if _PREFETCHER is None:
+        _PREFETCHER = _Prefetcher()
+    return _PREFETCHER
+
+
 @app.get("/api/music/url")
 async def get_music_url(id: int):
     """
     获取音乐播放URL - 支持多音源解锁（网易云/QQ音乐/酷狗/咪咕）
     """
+    async with _prefetcher().user_request():
+        return await _cached_music('url', id, _resolve_music_url)
+
+
+async def _resolve_music_url(id: int) -> Dict[str, Any]:
     try:
         import aiohttp
         
         # 1. 首先尝试网易云官方API
-        api_base = "https://netease-cloud-music-api.vercel.app"
+        api_base = MUSIC_API_BASE
         bitrates = [320000, 192000, 128000]
         
         async with aiohttp.ClientSession() as session:
@@ -535,25 +5125,9 @@ async def get_music_url(id: int):
 
 
 def _get_ytdlp_audio_url(search_url: str) -> Optional[str]:
-    """使用yt-dlp获取音频URL"""
+    """使用yt-dlp获取音频URL（与 mode='url' 共用解析缓存）"""
     try:
-        opts = {
-            'format': 'bestaudio/best',
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'nocheckcertificate': True,
-        }
-        
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(search_url, download=False)
-            if info and info.get('url'):
-                return info['url']
-            elif info and info.get('entries') and len(info['entries']) > 0:
-                entry = info['entries'][0]
-                if entry.get('url'):
-                    return entry['url']
-        return None
+        return _resolve_stream_blocking(search_url)['url']
     except Exception as e:
         print(f"yt-dlp提取失败: {str(e)}")
         return None
@@ -645,10 +5219,15 @@ async def get_music_lyric(id: int):
     """
     获取歌词
     """
+    async with _prefetcher().user_request():
+        return await _cached_music('lyric', id, _fetch_lyric)
+
+
+async def _fetch_lyric(id: int) -> Dict[str, Any]:
     try:
         import aiohttp
         
-        api_base = "https://netease-cloud-music-api.vercel.app"
+        api_base = MUSIC_API_BASE
         
         async with aiohttp.ClientSession() as session:
             async with session.get(
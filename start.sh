@@ -44,6 +44,10 @@ JSON
   # start xray in background
   /usr/bin/xray -c /etc/xray/config.json &
   export YDL_PROXY="socks5h://127.0.0.1:${XRAY_SOCKS_PORT}"
+  # 已配置代理池时把 Xray 出口加入池中，而不是覆盖
+  if [ -n "$YDL_PROXIES" ]; then
+    export YDL_PROXIES="${YDL_PROXIES},${YDL_PROXY}"
+  fi
   echo "[xray] started, YDL_PROXY=$YDL_PROXY"
 fi
 
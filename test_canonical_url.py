@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Test script for URL canonicalization and the short-link alias cache
+"""
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import _canonicalize, _canonical_offline
+
+
+def test_offline_shapes():
+    """Test that known URL shapes collapse to one canonical ID"""
+    print("Testing offline canonicalization...")
+    cases = {
+        "https://youtu.be/dQw4w9WgXcQ?si=abcdef": "youtube:dQw4w9WgXcQ",
+        "https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=xyz&t=42": "youtube:dQw4w9WgXcQ",
+        "https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ": "youtube:dQw4w9WgXcQ",
+        "https://music.youtube.com/watch?v=dQw4w9WgXcQ&list=RD": "youtube:dQw4w9WgXcQ",
+        "https://www.youtube.com/shorts/dQw4w9WgXcQ": "youtube:dQw4w9WgXcQ",
+        "https://www.bilibili.com/video/BV1xx411c7mD/?spm_id_from=333.1007": "bilibili:BV1xx411c7mD",
+        "https://m.bilibili.com/video/BV1xx411c7mD?p=3": "bilibili:BV1xx411c7mD:p3",
+        "https://www.douyin.com/video/7301234567890123456": "douyin:7301234567890123456",
+        "https://www.iesdouyin.com/share/video/7301234567890123456/?region=CN": "douyin:7301234567890123456",
+        "https://www.douyin.com/discover?modal_id=7301234567890123456": "douyin:7301234567890123456",
+        "ytsearch1:some song audio": "ytsearch1:some song audio",
+    }
+    for url, expected in cases.items():
+        canonical_id, _ = _canonical_offline(url)
+        assert canonical_id == expected, (url, canonical_id)
+        print(f"✓ {url} -> {expected}")
+
+    assert _canonical_offline("https://youtu.be/dQw4w9WgXcQ")[1] == "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+    assert _canonical_offline("https://b23.tv/abc123") is None
+    assert _canonical_offline("https://v.douyin.com/iRNBho6u/") is None
+    print("✓ canonical fetch URL built, short links deferred")
+
+    a = _canonical_offline("https://Example.com/a?b=2&a=1&utm_source=x#frag")[0]
+    b = _canonical_offline("https://example.com/a?a=1&b=2")[0]
+    assert a == b == "https://example.com/a?a=1&b=2", (a, b)
+    print("✓ generic URLs normalized (host case, param order, tracking params)")
+
+
+class _RedirectHandler(BaseHTTPRequestHandler):
+    hits = 0
+
+    def do_GET(self):
+        _RedirectHandler.hits += 1
+        self.send_response(302)
+        self.send_header('Location', 'https://www.bilibili.com/video/BV1xx411c7mD?share_source=copy_web')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_short_link_cache():
+    """Test that a short link is resolved once and then served from the alias cache"""
+    print("\nTesting short-link resolution...")
+    server = HTTPServer(('127.0.0.1', 0), _RedirectHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = "127.0.0.1"
+    short = f"http://{host}:{server.server_port}/abc123"
+
+    main._SHORT_LINK_HOSTS.add(host)
+    try:
+        for _ in range(3):
+            canonical_id, fetch_url = _canonicalize(short)
+            assert canonical_id == "bilibili:BV1xx411c7mD", canonical_id
+            assert fetch_url == "https://www.bilibili.com/video/BV1xx411c7mD"
+        assert _RedirectHandler.hits == 1, _RedirectHandler.hits
+        print("✓ b23-style short link resolved once, cached afterwards")
+
+        # 跳转失败时退回原始链接且不缓存
+        dead = "http://127.0.0.1:9/dead"
+        assert _canonicalize(dead) == (dead, dead)
+        assert dead not in main._ALIAS_CACHE
+        print("✓ failed resolution falls back to the raw URL")
+    finally:
+        main._SHORT_LINK_HOSTS.discard(host)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    test_offline_shapes()
+    test_short_link_cache()
+    print("\nAll tests completed!")
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Test script for per-client API keys, quotas and fair-share / shortest-job-first scheduling
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi.testclient import TestClient
+
+import main
+from main import SQLiteJobQueue, _FairScheduler, _HostLimiter
+
+_KEYS = {
+    'k_app': {'name': 'app', 'weight': 1.0, 'concurrency': 0, 'rate': 0.0},
+    'k_batch': {'name': 'batch', 'weight': 1.0, 'concurrency': 0, 'rate': 0.0},
+}
+
+
+class _Config:
+    def __init__(self, **values):
+        self.values = values
+
+    def __enter__(self):
+        self.saved = {k: getattr(main, k) for k in self.values}
+        for k, v in self.values.items():
+            setattr(main, k, v)
+
+    def __exit__(self, *exc):
+        for k, v in self.saved.items():
+            setattr(main, k, v)
+
+
+def _headers(key=None, bearer=False):
+    if not key:
+        return {}
+    return {'Authorization': f"Bearer {key}"} if bearer else {'X-API-Key': key}
+
+
+async def _grant_order(scheduler, jobs, hold=None):
+    """Queue jobs behind a held slot, release it, and record the order slots are granted in"""
+    order = []
+    blocker = asyncio.Event()
+
+    async def holder():
+        async with scheduler.slot('holder', None, lambda: 0):
+            await blocker.wait()
+
+    async def job(client, name, cost, limiter=None):
+        async with scheduler.slot(client, limiter, lambda: cost):
+            order.append(name)
+            await asyncio.sleep(hold(name) if hold else 0)
+
+    first = asyncio.create_task(holder())
+    await asyncio.sleep(0)
+    tasks = []
+    for spec in jobs:
+        tasks.append(asyncio.create_task(job(*spec)))
+        await asyncio.sleep(0)
+    blocker.set()
+    await asyncio.gather(first, *tasks)
+    return order
+
+
+def test_fair_share_and_sjf():
+    """Test that a light client is interleaved with a heavy backlog and its short jobs go first"""
+    print("Testing weighted fair queuing with shortest-job-first...")
+    with _Config(API_KEYS=dict(_KEYS), SCHED_AGING=0):
+        async def run():
+            heavy = [('batch', f"batch{i}", 1800) for i in range(4)]
+            light = [('app', 'app-long', 3600), ('app', 'app-short1', 60), ('app', 'app-short2', 120)]
+            return await _grant_order(_FairScheduler(asyncio.get_running_loop(), 1), heavy + light)
+
+        order = asyncio.run(run())
+        # batch 先提交了 4 个长任务；app 的短任务先得，app 的长任务与 batch 按虚拟完成时间交替
+        assert order == ['app-short1', 'app-short2', 'batch0', 'batch1', 'app-long', 'batch2', 'batch3'], order
+        print(f"✓ grant order: {order}")
+
+        async def weighted():
+            main.API_KEYS['k_app'] = dict(_KEYS['k_app'], weight=3.0)
+            jobs = [('batch', f"b{i}", 600) for i in range(6)] + [('app', f"a{i}", 600) for i in range(6)]
+            return await _grant_order(_FairScheduler(asyncio.get_running_loop(), 1), jobs)
+
+        order = ''.join(n[0] for n in asyncio.run(weighted()))
+        assert order == 'aabaaababbbb', order
+        print(f"✓ weight 3 vs 1 with equal costs: {order}")
+
+
+def test_aging():
+    """Test that a long job is not starved forever by a stream of short ones"""
+    print("\nTesting aging...")
+
+    async def run():
+        scheduler = _FairScheduler(asyncio.get_running_loop(), 1)
+        order = []
+
+        async def job(name, cost):
+            async with scheduler.slot('app', None, lambda: cost):
+                order.append(name)
+                await asyncio.sleep(0.05)
+
+        tasks = [asyncio.create_task(job('first', 10))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(job('long', 3600)))
+        for i in range(12):
+            tasks.append(asyncio.create_task(job(f"short{i}", 10)))
+            await asyncio.sleep(0.02)
+        await asyncio.gather(*tasks)
+        return order.index('long')
+
+    with _Config(API_KEYS=dict(_KEYS), SCHED_AGING=0):
+        assert asyncio.run(run()) == 13
+    with _Config(API_KEYS=dict(_KEYS), SCHED_AGING=100000):
+        position = asyncio.run(run())
+        assert position < 5, position
+    print(f"✓ without aging the long job runs last; with aging it runs at position {position}")
+
+
+def test_concurrency_cap_and_throttled_host():
+    """Test per-key concurrency and that a throttled platform does not hold a slot"""
+    print("\nTesting per-key concurrency and host throttling...")
+    keys = dict(_KEYS, k_batch=dict(_KEYS['k_batch'], concurrency=1))
+    with _Config(API_KEYS=keys, SCHED_AGING=0):
+        async def run():
+            scheduler = _FairScheduler(asyncio.get_running_loop(), 3)
+            peak = {'batch': 0}
+            active = {'batch': 0}
+
+            async def job(client, cost):
+                async with scheduler.slot(client, None, lambda: cost):
+                    active[client] = active.get(client, 0) + 1
+                    peak[client] = max(peak.get(client, 0), active[client])
+                    await asyncio.sleep(0.05)
+                    active[client] -= 1
+
+            await asyncio.gather(*[job('batch', 60) for _ in range(4)], *[job('app', 60) for _ in range(4)])
+            assert peak['batch'] == 1 and peak['app'] == 2, peak
+            print("✓ batch capped at 1 concurrent download, app used the remaining slots")
+
+            throttled = _HostLimiter('blocked.example', 1, 1, 1)
+            throttled.cooldown_until = time.monotonic() + 0.5
+            order = await _grant_order(scheduler, [('app', 'blocked', 10, throttled), ('app', 'other', 600)])
+            assert order == ['other', 'blocked'], order
+            print("✓ job on a cooling-down platform waited without blocking another platform")
+
+        asyncio.run(run())
+
+
+def test_keys_quota_and_usage():
+    """Test key identification, 401/429 responses and per-key usage reporting"""
+    print("\nTesting API keys, rate quota and usage...")
+    keys = dict(_KEYS, k_app=dict(_KEYS['k_app'], rate=2.0))
+    with _Config(API_KEYS=keys, API_KEY_REQUIRED=False, JOB_QUEUE='sqlite'), tempfile.TemporaryDirectory() as tmp:
+        main._CLIENT_USAGE.clear()
+        main._SUBMIT_BUCKETS.clear()
+        saved_queue, main._JOB_QUEUE = main._JOB_QUEUE, SQLiteJobQueue(os.path.join(tmp, 'jobs.db'))
+        try:
+            client = TestClient(main.app)
+            body = {'url': 'https://www.youtube.com/watch?v=aaaaaaaaaaa'}
+            ids = [client.post('/api/process', json=body, headers=_headers('k_app')).json()['task_id'],
+                   client.post('/api/process', json=body, headers=_headers('k_app', bearer=True)).json()['task_id']]
+            r = client.post('/api/process', json=body, headers=_headers('k_app'))
+            assert r.status_code == 429 and int(r.headers['Retry-After']) >= 1
+            anon = client.post('/api/process', json=body).json()['task_id']
+            for bad in ('nope', None):
+                main.API_KEY_REQUIRED = bad is None
+                assert client.post('/api/process', json=body, headers=_headers(bad)).status_code == 401
+            main.API_KEY_REQUIRED = False
+            usage = client.get('/api/usage', headers=_headers('k_app')).json()
+            assert main._JOB_QUEUE.get(ids[0])['client'] == 'app' and main._JOB_QUEUE.get(anon)['client'] == 'anonymous'
+            assert usage['client'] == 'app' and usage['submitted'] == 2 and usage['rejected'] == 1
+            assert usage['rate_per_minute'] == 2.0
+            print("✓ X-API-Key and Bearer identify the client, 3rd submission in a minute -> 429, bad key -> 401")
+
+            main._record_usage({'client': 'app', 'status': 'completed', 'duration': 300,
+                                'estimate': {'duration': 120, 'download_bytes': 4096}})
+            report = main._client_usage_report()
+            assert report['app']['completed'] == 1 and report['app']['media_seconds'] == 120
+            assert report['app']['download_bytes'] == 4096 and report['anonymous']['submitted'] == 1
+            print("✓ per-key usage: submissions, rejections, completions, media seconds, bytes")
+        finally:
+            main._JOB_QUEUE = saved_queue
+
+
+def test_distributed_claim_order():
+    """Test that queue claims skip capped clients and prefer the least-served client and shorter jobs"""
+    print("\nTesting fair claim order in the shared queue...")
+    keys = dict(_KEYS, k_batch=dict(_KEYS['k_batch'], concurrency=2))
+    with _Config(API_KEYS=keys, SCHED_AGING=0), tempfile.TemporaryDirectory() as tmp:
+        q = SQLiteJobQueue(str(Path(tmp) / 'jobs.db'))
+        for i in range(4):
+            q.enqueue(f"b{i}", {'url': 'https://example.com/b'}, {'status': 'pending', 'client': 'batch',
+                                                                    'expected_duration': 3600})
+        q.enqueue('a_long', {'url': 'https://example.com/a'}, {'status': 'pending', 'client': 'app',
+                                                                'expected_duration': 5400})
+        q.enqueue('a_clip', {'url': 'https://example.com/a', 'start': 0, 'end': 30},
+                  {'status': 'pending', 'client': 'app', 'expected_duration': 5400})
+        claimed = [q.claim('w', 30)['task_id'] for _ in range(4)]
+        # 30 秒的片段最先；之后按各客户端运行中的任务数轮转；batch 到达 2 个并发后不再领取
+        assert claimed == ['a_clip', 'b0', 'b1', 'a_long'], claimed
+        assert q.claim('w', 30) is None
+        print(f"✓ claims {claimed}; batch held at 2 running, remaining batch jobs wait")
+
+
+def test_duration_probe():
+    """Test that a queued job's duration is probed once and then served from the local index"""
+    print("\nTesting duration probe...")
+    calls = []
+
+    def fake_probe(url, proxy=None):
+        calls.append(url)
+        return {'duration': 42, 'title': 'Probe Song'}
+
+    canonical_id = f"example.com/probe/{time.time_ns()}"
+    url = f"https://{canonical_id}"
+    with _Config(_probe_info_blocking=fake_probe, NATIVE_RESOLVERS=set()):
+        async def run(task_id):
+            main.TASKS[task_id] = {'status': 'pending'}
+            await main._probe_duration(task_id, url, canonical_id, asyncio.Semaphore(1))
+            return main.TASKS[task_id].get('expected_duration')
+
+        assert asyncio.run(run('probe1')) == 42 and asyncio.run(run('probe2')) == 42
+    assert calls == [url] and main._known_duration(canonical_id) == 42
+    assert main._expected_cost({'expected_duration': 42}, (30, None)) == 12
+    assert main._expected_cost({}, (0, 90)) == 90 and main._expected_cost({}) == main.SCHED_DEFAULT_COST
+    print("✓ probed once, second task used the indexed duration; clip ranges scale the cost")
+
+
+def test_duration_probe_native_fallback():
+    """Test that a failing native resolve falls back to the yt-dlp probe"""
+    print("\nTesting duration probe fallback...")
+    calls = []
+
+    async def broken_native(canonical_id, proxy=None):
+        calls.append('native')
+        raise ValueError('page layout changed')
+
+    def fake_probe(url, proxy=None):
+        calls.append('yt-dlp')
+        return {'duration': 77, 'title': 'Fallback Song'}
+
+    canonical_id = f"bilibili:BV{time.time_ns()}"
+    url = f"https://www.bilibili.com/video/{canonical_id.partition(':')[2]}"
+    with _Config(_probe_info_blocking=fake_probe, _native_resolve=broken_native, NATIVE_RESOLVERS={'bilibili'}):
+        async def run():
+            main.TASKS['probe-fallback'] = {'status': 'pending'}
+            await main._probe_duration('probe-fallback', url, canonical_id, asyncio.Semaphore(1))
+            return main.TASKS.pop('probe-fallback').get('expected_duration')
+
+        assert asyncio.run(run()) == 77
+    assert calls == ['native', 'yt-dlp'] and main._known_duration(canonical_id) == 77
+    print("✓ native resolve error fell through to yt-dlp")
+
+
+def test_clip_does_not_shorten_full_jobs():
+    """Test that a clip of a long video doesn't make later full-length requests look short"""
+    print("\nTesting clip then full request...")
+    video = f"{time.time_ns() % 10 ** 11:011d}"
+    url = f"https://www.youtube.com/watch?v={video}"
+    canonical_id = main._canonical_offline(url)[0]
+    # 修复前的记录：duration 是 30 秒片段的长度
+    main._search_index().add([(canonical_id, 'video', 'Long Talk', '', '',
+                               {'id': canonical_id, 'name': 'Long Talk', 'url': url, 'duration': 30})])
+    assert main._known_duration(canonical_id) is None
+
+    with _Config(API_KEYS={}, API_KEY_REQUIRED=False, JOB_QUEUE='sqlite', SCHED_AGING=0), \
+            tempfile.TemporaryDirectory() as tmp:
+        saved_queue, main._JOB_QUEUE = main._JOB_QUEUE, SQLiteJobQueue(os.path.join(tmp, 'jobs.db'))
+        try:
+            client = TestClient(main.app)
+
+            def submit(**fields):
+                return client.post('/api/process', json=dict(url=url, **fields)).json()['task_id']
+
+            legacy = submit()
+            assert main._JOB_QUEUE.get(legacy).get('expected_duration') is None
+            main._JOB_QUEUE.cancel(legacy)
+            # 片段任务下载完成后按整段时长收录
+            source = {'title': 'Long Talk', 'duration': 30, 'full_duration': 10800}
+            main._index_video(canonical_id, url, source['title'], source['full_duration'])
+            clip = submit(start=0, end=30)
+            full = submit()
+            main._JOB_QUEUE.enqueue('medium', {'url': 'https://example.com/m'},
+                                    {'status': 'pending', 'client': 'anonymous', 'expected_duration': 600})
+            assert main._JOB_QUEUE.get(full)['expected_duration'] == 10800
+            claimed = [main._JOB_QUEUE.claim('w', 30)['task_id'] for _ in range(3)]
+            assert claimed == [clip, 'medium', full], claimed
+        finally:
+            main._JOB_QUEUE = saved_queue
+    print("✓ clip-length index entries ignored; full request ranked by the full duration")
+
+
+if __name__ == "__main__":
+    test_fair_share_and_sjf()
+    test_aging()
+    test_concurrency_cap_and_throttled_host()
+    test_keys_quota_and_usage()
+    test_distributed_claim_order()
+    test_duration_probe()
+    test_duration_probe_native_fallback()
+    test_clip_does_not_shorten_full_jobs()
+    print("\nAll tests completed!")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Test script for audio fingerprint deduplication across sources
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import Request
+
+import main
+from main import _FingerprintBuilder, _FingerprintIndex, _fp_compare
+
+
+def _ffmpeg(*args):
+    subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', *args], check=True)
+
+
+def _song(path, seed, duration=30):
+    """Pink noise over a tone; different seeds stand in for different songs"""
+    _ffmpeg('-f', 'lavfi', '-i', f'anoisesrc=seed={seed}:color=pink:d={duration}',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+            '-filter_complex', '[0][1]amix,volume=3', '-ar', '44100', '-ac', '2', str(path))
+    return path
+
+
+def _fingerprint(path):
+    pcm = subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', str(path), '-ac', '1',
+                          '-ar', str(main.PEAKS_SAMPLE_RATE), '-f', 's16le', 'pipe:1'],
+                         capture_output=True, check=True).stdout
+    builder = _FingerprintBuilder(main.PEAKS_SAMPLE_RATE)
+    # 分小块喂入，覆盖跨块的帧拼接
+    for i in range(0, len(pcm), 7777):
+        builder.feed(pcm[i:i + 7777])
+    return builder.finish()
+
+
+def test_reencode_matches():
+    """Test that a shifted low-bitrate re-encode matches and a different song does not"""
+    print("Testing fingerprint robustness...")
+    with tempfile.TemporaryDirectory() as tmp:
+        a = _song(Path(tmp) / 'a.wav', 1)
+        b = Path(tmp) / 'b.m4a'
+        _ffmpeg('-i', str(a), '-af', 'adelay=137:all=1,volume=0.6', '-c:a', 'aac', '-b:a', '64k', str(b))
+        c = _song(Path(tmp) / 'c.wav', 2)
+        fa, fb, fc = _fingerprint(a), _fingerprint(b), _fingerprint(c)
+
+    assert fa.dtype == '<u4' and abs(len(fa) - 30 / main._FP_HOP_SECONDS) < 10, len(fa)
+    ber, overlap = _fp_compare(fa, fb)
+    assert ber < main.FINGERPRINT_MAX_BER and overlap > 0.9 * len(fa), (ber, overlap)
+    print(f"✓ delayed 64k AAC re-encode: ber={ber:.3f}")
+    ber, _ = _fp_compare(fa, fc)
+    assert ber > 0.4, ber
+    print(f"✓ different audio: ber={ber:.3f}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = _FingerprintIndex(os.path.join(tmp, 'fp.db'))
+        fp_id = index.add(fa, 'A', 30)
+        assert index.match(fb)[0] == fp_id
+        assert index.match(fc) is None
+        assert index.match(fa[:len(fa) // 3]) is None
+        print("✓ index matches the re-encode, rejects other audio and a short clip of the same audio")
+
+
+def test_transcode_dedupe():
+    """Test that a cross-platform duplicate reuses the existing artifact instead of storing a copy"""
+    print("\nTesting dedupe during transcode...")
+    saved = main._FINGERPRINTS, main.PEAKS_ENABLED
+    with tempfile.TemporaryDirectory() as tmp:
+        main._FINGERPRINTS, main.PEAKS_ENABLED = _FingerprintIndex(os.path.join(tmp, 'fp.db')), False
+        try:
+            yt_src = _song(main.TEMP_DIR / 'audio_fptest_yt.source.wav', 3)
+            bili_src = main.TEMP_DIR / 'audio_fptest_bili.source.m4a'
+            _ffmpeg('-i', str(yt_src), '-af', 'adelay=80:all=1', '-c:a', 'aac', '-b:a', '96k', str(bili_src))
+
+            def source(basename, path, key):
+                return {'basename': basename, 'source_path': str(path), 'acodec': None, 'title': 'Song',
+                        'duration': 30, 'clip': None, 'source_key': key}
+
+            first = main._transcode_blocking(source('audio_fptest_yt', yt_src, 'youtube:aaaaaaaaaaa'), 'm4a', 'good')
+            assert not first.get('deduplicated') and Path(first['file_path']).exists()
+            second = main._transcode_blocking(source('audio_fptest_bili', bili_src, 'bilibili:BV1xx411c7mD'),
+                                              'm4a', 'good')
+            assert second['deduplicated'] and second['filename'] == first['filename']
+            assert not (main.TEMP_DIR / 'audio_fptest_bili.m4a').exists()
+            print("✓ Bilibili re-upload served the YouTube artifact, no second file stored")
+
+            mp3 = main._transcode_blocking(source('audio_fptest_bili', bili_src, 'bilibili:BV1xx411c7mD'),
+                                           'mp3', 'good')
+            assert not mp3.get('deduplicated') and Path(mp3['file_path']).exists()
+            print("✓ a format with no existing artifact is transcoded and recorded")
+
+            known = main._known_outputs('bilibili:BV1xx411c7mD', [('m4a', 'good'), ('mp3', 'good')])
+            assert [r['filename'] for r in known] == [first['filename'], mp3['filename']]
+            assert main._known_outputs('bilibili:BV1xx411c7mD', [('wav', 'best')]) is None
+            print("✓ later requests for either source skip the download")
+
+            r = asyncio.run(main.fingerprint_lookup('https://www.bilibili.com/video/BV1xx411c7mD?spm_id_from=x'))
+            assert r['match'] and {f['filename'] for f in r['audio_files']} == {first['filename'], mp3['filename']}
+            assert set(r['sources']) == {'youtube:aaaaaaaaaaa', 'bilibili:BV1xx411c7mD'}
+            print("✓ GET lookup by URL returns existing files")
+
+            data = bili_src.read_bytes()
+
+            async def receive():
+                return {'type': 'http.request', 'body': data, 'more_body': False}
+
+            request = Request({'type': 'http', 'method': 'POST', 'path': '/', 'headers': [], 'query_string': b''},
+                              receive)
+            r = asyncio.run(main.fingerprint_lookup_audio(request))
+            assert r['match'] and r['ber'] < main.FINGERPRINT_MAX_BER
+            print(f"✓ POST lookup by audio matched (ber={r['ber']})")
+
+            for p in (yt_src, bili_src, Path(first['file_path']), Path(mp3['file_path'])):
+                p.unlink(missing_ok=True)
+        finally:
+            main._FINGERPRINTS.db.close()
+            main._FINGERPRINTS, main.PEAKS_ENABLED = saved
+
+
+if __name__ == "__main__":
+    test_reencode_matches()
+    test_transcode_dedupe()
+    print("\nAll tests completed!")
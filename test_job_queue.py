@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Test script for the SQLite job queue (distributed worker mode)
+"""
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import SQLiteJobQueue
+
+
+def _queue(tmp_dir: str) -> SQLiteJobQueue:
+    return SQLiteJobQueue(str(Path(tmp_dir) / 'jobs.db'))
+
+
+def test_claim_and_finish():
+    """Test that a job is claimed once and its final state is shared"""
+    print("Testing claim/finish...")
+    with tempfile.TemporaryDirectory() as tmp:
+        q = _queue(tmp)
+        q.enqueue('t1', {'url': 'https://example.com/v'}, {'status': 'pending', 'progress': 0})
+
+        job = q.claim('w1', 30)
+        assert job and job['task_id'] == 't1' and job['attempts'] == 1
+        assert q.claim('w2', 30) is None
+        print("✓ job claimed by exactly one worker")
+
+        assert q.heartbeat('t1', 'w1', {'status': 'processing', 'progress': 40}, 30)
+        assert q.get('t1')['progress'] == 40
+        print("✓ heartbeat shares progress")
+
+        q.finish('t1', 'w1', {'status': 'completed', 'progress': 100})
+        assert q.get('t1')['status'] == 'completed'
+        assert q.claim('w2', 30) is None
+        print("✓ finished job is not redelivered")
+
+
+def test_redelivery_after_lease_expiry():
+    """Test that a job whose worker stopped heartbeating is redelivered, then failed"""
+    print("\nTesting lease expiry/redelivery...")
+    with tempfile.TemporaryDirectory() as tmp:
+        q = _queue(tmp)
+        q.enqueue('t1', {'url': 'https://example.com/v'}, {'status': 'pending', 'progress': 0})
+
+        q.claim('w1', 0.1)
+        time.sleep(0.2)
+        job = q.claim('w2', 0.1)
+        assert job and job['attempts'] == 2
+        assert not q.heartbeat('t1', 'w1', {}, 30)
+        print("✓ expired job redelivered, stale worker loses its lease")
+
+        time.sleep(0.2)
+        attempts, main.JOB_MAX_ATTEMPTS = main.JOB_MAX_ATTEMPTS, 2
+        try:
+            assert q.claim('w3', 0.1) is None
+        finally:
+            main.JOB_MAX_ATTEMPTS = attempts
+        assert q.get('t1')['status'] == 'failed'
+        print("✓ job failed after exhausting attempts")
+
+
+def test_release_on_shutdown():
+    """Test that a job handed back at shutdown is claimable at once without using up an attempt"""
+    print("\nTesting release...")
+    with tempfile.TemporaryDirectory() as tmp:
+        q = _queue(tmp)
+        q.enqueue('t1', {'url': 'https://example.com/v'}, {'status': 'pending', 'progress': 0})
+        q.claim('w1', 30)
+        q.release('t1', 'w1', {'status': 'pending', 'basename': 'audio_x'})
+        job = q.claim('w2', 30)
+        assert job and job['attempts'] == 1 and job['task']['basename'] == 'audio_x'
+        print("✓ released job redelivered immediately with its checkpoint")
+
+
+def test_delayed_retry():
+    """Test that a retried job is not claimable before its retry time and keeps its attempt budget"""
+    print("\nTesting delayed retry...")
+    with tempfile.TemporaryDirectory() as tmp:
+        q = _queue(tmp)
+        q.enqueue('t1', {'url': 'https://example.com/v'}, {'status': 'pending', 'progress': 0})
+        q.enqueue('t2', {'url': 'https://example.com/w'}, {'status': 'pending', 'progress': 0})
+        q.claim('w1', 30)
+        q.retry('t1', 'w1', {'status': 'pending', 'error_class': 'network', 'retries': {'network': 1}},
+                time.time() + 0.3)
+        assert q.get('t1')['error_class'] == 'network'
+        assert q.claim('w1', 30)['task_id'] == 't2'
+        assert q.claim('w2', 30) is None
+        print("✓ worker moves on to other jobs while the retry waits")
+
+        time.sleep(0.4)
+        job = q.claim('w2', 30)
+        assert job and job['task_id'] == 't1' and job['attempts'] == 1
+        print("✓ retried job claimable after its delay without using up an attempt")
+
+
+if __name__ == "__main__":
+    test_claim_and_finish()
+    test_redelivery_after_lease_expiry()
+    test_release_on_shutdown()
+    test_delayed_retry()
+    print("\nAll tests completed!")
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Test script for the native Bilibili / Douyin fast-path resolvers against recorded responses served locally
+"""
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import yt_dlp
+
+import main
+from main import _parse_bilibili_page, _parse_douyin_page
+
+# 录制的页面响应（删去了与解析无关的大段脚本和字段），媒体地址替换为 {base}
+_BILIBILI_HTML = '''<!DOCTYPE html><html><head><meta charset="utf-8">
+<title data-vue-meta="true">【4K】城市夜景 Lo-fi 合集_哔哩哔哩_bilibili</title></head><body>
+<script>window.__playinfo__={"code":0,"message":"0","ttl":1,"data":{"from":"local","result":"suee","quality":32,
+"format":"flv480","timelength":12021,"accept_format":"flv480,mp4","video_codecid":7,"dash":{"duration":12,
+"minBufferTime":1.5,"video":[{"id":32,"baseUrl":"{base}/upos/video-30032.m4s","bandwidth":440000,
+"mimeType":"video/mp4","codecs":"avc1.64001F","width":852,"height":480}],
+"audio":[{"id":30216,"baseUrl":"{base}/upos/audio-30216.m4s","backupUrl":["{base}/upos-bak/audio-30216.m4s"],
+"bandwidth":67125,"mimeType":"audio/mp4","codecs":"mp4a.40.2","segment_base":{"initialization":"0-817","index_range":"818-901"}},
+{"id":30280,"baseUrl":"{base}/upos/gone-30280.m4s","base_url":"{base}/upos/gone-30280.m4s",
+"backupUrl":["{base}/upos-bak/audio-30280.m4s"],"bandwidth":191000,"mimeType":"audio/mp4","codecs":"mp4a.40.2"}],
+"dolby":{"type":0,"audio":null},"flac":null}}}</script>
+<script>window.__INITIAL_STATE__={"aid":1234567,"bvid":"BV1xx411c7mD","p":1,"videoData":{"bvid":"BV1xx411c7mD",
+"aid":1234567,"title":"【4K】城市夜景 Lo-fi 合集","duration":12,"pages":[{"cid":98765,"page":1,"part":"P1","duration":12}]}};
+(function(){var s;(s=document.currentScript||document.scripts[document.scripts.length-1]).parentNode.removeChild(s);}());
+</script></body></html>'''
+
+_DOUYIN_HTML = '''<!DOCTYPE html><html><head><meta charset="utf-8"><title>抖音</title></head><body>
+<script>window._ROUTER_DATA = {"loaderData":{"video_layout":null,"video_(id)/page":{"videoInfoRes":{"status_code":0,
+"item_list":[{"aweme_id":"7300000000000000000","desc":"海边日落 #旅行","create_time":1700000000,
+"author":{"nickname":"someone"},"music":{"title":"@someone创作的原声","play_url":{"uri":"{base}/music.mp3",
+"url_list":["{base}/music.mp3"]}},"video":{"play_addr":{"uri":"v0200fg10000abc",
+"url_list":["{base}/aweme/v1/playwm/?video_id=v0200fg10000abc&ratio=720p&line=0"]},
+"cover":{"url_list":["{base}/cover.jpeg"]},"duration":8000,"width":720,"height":1280}}],"filter_list":[]}}}}</script>
+</body></html>'''
+
+
+class _Fixtures(BaseHTTPRequestHandler):
+    """Serves the recorded pages and media; honours Range; logs each request"""
+    files = {}
+    log = []
+
+    def do_GET(self):
+        _Fixtures.log.append((self.path, dict(self.headers)))
+        body = _Fixtures.files.get(self.path.split('?')[0] if '/aweme/' not in self.path else self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        start = 0
+        m = re.match(r'bytes=(\d+)-', self.headers.get('Range') or '')
+        if m:
+            start = int(m.group(1))
+        self.send_response(206 if m else 200)
+        self.send_header('Content-Length', str(len(body) - start))
+        if m:
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(tmp):
+    subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=duration=12',
+                    '-c:a', 'aac', '-b:a', '64k', '-movflags', '+frag_keyframe+empty_moov', '-f', 'mp4',
+                    os.path.join(tmp, 'audio.m4s')], check=True)
+    subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc=size=160x120:duration=8',
+                    '-f', 'lavfi', '-i', 'sine=duration=8', '-c:v', 'mpeg4', '-c:a', 'aac', '-shortest',
+                    os.path.join(tmp, 'video.mp4')], check=True)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Fixtures)
+    base = f"http://127.0.0.1:{server.server_port}"
+    audio, video = Path(tmp, 'audio.m4s').read_bytes(), Path(tmp, 'video.mp4').read_bytes()
+    _Fixtures.files = {
+        '/video/BV1xx411c7mD': _BILIBILI_HTML.replace('{base}', base).encode(),
+        '/upos-bak/audio-30280.m4s': audio,
+        '/share/video/7300000000000000000/': _DOUYIN_HTML.replace('{base}', base).encode(),
+        '/aweme/v1/play/?video_id=v0200fg10000abc&ratio=720p&line=0': video,
+    }
+    _Fixtures.log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    main._BILIBILI_PAGE = base + "/video/{bvid}{query}"
+    main._DOUYIN_SHARE_PAGE = base + "/share/video/{aweme_id}/"
+    return server, base, audio, video
+
+
+async def _closing(coro):
+    """Each asyncio.run gets a fresh loop; close the pooled session before it goes away"""
+    try:
+        return await coro
+    finally:
+        if main._NATIVE_SESSION is not None:
+            await main._NATIVE_SESSION[1].close()
+
+
+def test_parse_recorded_pages():
+    """Test parsing of the recorded Bilibili and Douyin pages"""
+    print("Testing page parsers...")
+    bili = _parse_bilibili_page(_BILIBILI_HTML)
+    assert bili['urls'][0].endswith('/upos/gone-30280.m4s') and bili['urls'][1].endswith('/upos-bak/audio-30280.m4s')
+    assert bili['acodec'] == 'mp4a.40.2' and bili['abr'] == 191 and bili['duration'] == 12
+    assert bili['title'] == '【4K】城市夜景 Lo-fi 合集'
+    print("✓ Bilibili: highest-bandwidth DASH audio with backup URLs, title and duration")
+
+    douyin = _parse_douyin_page(_DOUYIN_HTML)
+    assert douyin['urls'] == ['{base}/aweme/v1/play/?video_id=v0200fg10000abc&ratio=720p&line=0']
+    assert douyin['duration'] == 8 and douyin['title'] == '海边日落 #旅行'
+    print("✓ Douyin: watermark-free play address, not the background music")
+
+    for broken in ('<html></html>', _BILIBILI_HTML.replace('"audio":[', '"audio_":[')):
+        try:
+            _parse_bilibili_page(broken)
+            assert False, "expected a parse error"
+        except (ValueError, KeyError):
+            pass
+    print("✓ pages without playinfo/audio raise")
+
+
+def test_native_pipeline():
+    """Test the fast path end to end without yt-dlp, backup URL failover, Range resume and fallback"""
+    print("\nTesting native downloads...")
+    saved = main._BILIBILI_PAGE, main._DOUYIN_SHARE_PAGE, main.FINGERPRINT_ENABLED
+    original = yt_dlp.YoutubeDL.extract_info
+    calls = []
+
+    def no_ytdlp(self, *args, **kwargs):
+        calls.append(args[0])
+        raise yt_dlp.utils.DownloadError("yt-dlp should not be used")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server, base, audio, video = _serve(tmp)
+        main.FINGERPRINT_ENABLED = False
+        yt_dlp.YoutubeDL.extract_info = no_ytdlp
+        try:
+            async def bilibili():
+                return await _closing(main._run_extract('https://www.bilibili.com/video/BV1xx411c7mD?spm_id_from=333',
+                                               [('m4a', 'good')]))
+
+            result = asyncio.run(bilibili())[0]
+            assert not calls and result['title'] == '【4K】城市夜景 Lo-fi 合集'
+            pages = [(p, h) for p, h in _Fixtures.log if p.startswith('/video/')]
+            assert len(pages) == 1 and pages[0][1]['Referer'] == 'https://www.bilibili.com/'
+            assert [p for p, _ in _Fixtures.log if 'm4s' in p] == ['/upos/gone-30280.m4s', '/upos-bak/audio-30280.m4s']
+            out = Path(result['file_path'])
+            probe = subprocess.run(['ffmpeg', '-nostdin', '-i', str(out)], capture_output=True, text=True).stderr
+            assert 'Audio: aac' in probe and 'Duration: 00:00:1' in probe
+            out.unlink()
+            main._peaks_path(out.name).unlink(missing_ok=True)
+            print("✓ Bilibili: one page request, backup URL after a 404, AAC remuxed without yt-dlp")
+
+            dest = main.TEMP_DIR / 'audio_nativetest.source.mp4'
+            dest.with_name(dest.name + '.part').write_bytes(video[:5000])
+            progress = []
+
+            async def douyin():
+                return await _closing(main._native_download('https://www.douyin.com/video/7300000000000000000',
+                                                   'audio_nativetest', lambda p, m: progress.append(p),
+                                                   [('mp3', 'good')]))
+
+            _Fixtures.log = []
+            source = asyncio.run(douyin())
+            assert source and Path(source['source_path']).read_bytes() == video
+            play = [h for p, h in _Fixtures.log if p.startswith('/aweme/')]
+            assert play[0]['Range'] == 'bytes=5000-' and 'iPhone' in play[0]['User-Agent']
+            assert progress[-1] == 80 and source['duration'] == 8
+            Path(source['source_path']).unlink()
+            print("✓ Douyin: play address downloaded, resumed from an existing .part with Range")
+
+            _Fixtures.files['/share/video/7300000000000000000/'] = b'<html>captcha</html>'
+            assert asyncio.run(douyin()) is None
+            assert not list(main.TEMP_DIR.glob('audio_nativetest.*'))
+            print("✓ unparseable page returns None so the caller falls back to yt-dlp")
+        finally:
+            yt_dlp.YoutubeDL.extract_info = original
+            main._BILIBILI_PAGE, main._DOUYIN_SHARE_PAGE, main.FINGERPRINT_ENABLED = saved
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    test_parse_recorded_pages()
+    test_native_pipeline()
+    print("\nAll tests completed!")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Test script for speculative prefetch of music URLs and lyrics
+"""
+import asyncio
+import os
+import sys
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+CALLS = []
+
+
+async def fake_url(song_id):
+    CALLS.append(('url', song_id))
+    await asyncio.sleep(0.05)
+    return {'url': f"https://cdn.example/{song_id}.mp3", 'source': 'netease', 'bitrate': 320000}
+
+
+async def fake_lyric(song_id):
+    CALLS.append(('lyric', song_id))
+    return {'lyric': f"[00:00.00] song {song_id}"}
+
+
+def _fresh():
+    CALLS.clear()
+    main._MUSIC_URL_CACHE.clear()
+    main._LYRIC_CACHE.clear()
+    main._PREFETCHER = None
+
+
+def test_prefetch_hits():
+    """Test that top-N results are prefetched and later requests hit the cache"""
+    print("Testing prefetch hits...")
+    saved = main.PREFETCH_TOP_N, main._resolve_music_url, main._fetch_lyric
+    main.PREFETCH_TOP_N, main._resolve_music_url, main._fetch_lyric = 3, fake_url, fake_lyric
+    _fresh()
+    try:
+        async def run():
+            songs = [{'id': i, 'name': f"s{i}"} for i in range(1, 11)]
+            main._prefetcher().submit(songs)
+            await main._prefetcher().queue.join()
+            assert sorted(c for c in CALLS if c[0] == 'url') == [('url', 1), ('url', 2), ('url', 3)]
+            print("✓ only the top 3 results prefetched")
+
+            CALLS.clear()
+            r = await main.get_music_url(1)
+            assert r['url'].endswith('/1.mp3') and CALLS == []
+            assert (await main.get_music_lyric(2))['lyric'] and CALLS == []
+            await main.get_music_url(7)
+            assert CALLS == [('url', 7)]
+            snap = main._prefetcher().snapshot()
+            assert snap['hits'] == 2 and snap['user_requests'] == 3 and snap['hit_rate'] == 0.667
+            print(f"✓ prefetched entries served without upstream calls, hit_rate={snap['hit_rate']}")
+            for w in main._prefetcher().workers:
+                w.cancel()
+        asyncio.run(run())
+    finally:
+        main.PREFETCH_TOP_N, main._resolve_music_url, main._fetch_lyric = saved
+
+
+def test_yields_to_users():
+    """Test that prefetch waits while a user request is in flight"""
+    print("\nTesting prefetch yields to user requests...")
+    saved = main.PREFETCH_TOP_N, main._resolve_music_url, main._fetch_lyric
+    main.PREFETCH_TOP_N, main._resolve_music_url, main._fetch_lyric = 2, fake_url, fake_lyric
+    _fresh()
+    try:
+        async def run():
+            prefetcher = main._prefetcher()
+            async with prefetcher.user_request():
+                prefetcher.submit([{'id': 1}, {'id': 2}])
+                await asyncio.sleep(0.2)
+                assert CALLS == []
+            await prefetcher.queue.join()
+            assert ('url', 1) in CALLS and ('url', 2) in CALLS
+            print("✓ prefetch paused during user request, resumed afterwards")
+            for w in prefetcher.workers:
+                w.cancel()
+        asyncio.run(run())
+    finally:
+        main.PREFETCH_TOP_N, main._resolve_music_url, main._fetch_lyric = saved
+
+
+if __name__ == "__main__":
+    test_prefetch_hits()
+    test_yields_to_users()
+    print("\nAll tests completed!")
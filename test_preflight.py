@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Test script for the preflight cost estimate and duration/size guards
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import yt_dlp
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+from main import _estimate_cost, _preflight
+
+_INFO = {
+    'duration': 36000,
+    'format_id': '140', 'acodec': 'mp4a.40.2', 'abr': 128,
+    'formats': [
+        {'format_id': '139', 'vcodec': 'none', 'acodec': 'mp4a.40.5', 'abr': 48},
+        {'format_id': '140', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'abr': 128},
+        {'format_id': '251', 'vcodec': 'none', 'acodec': 'opus', 'filesize': 700 << 20},
+        {'format_id': '18', 'vcodec': 'avc1', 'acodec': 'mp4a.40.2', 'tbr': 500},
+    ],
+}
+
+
+class _Limits:
+    def __init__(self, **values):
+        self.values = values
+
+    def __enter__(self):
+        self.saved = {k: getattr(main, k) for k in self.values}
+        for k, v in self.values.items():
+            setattr(main, k, v)
+
+    def __exit__(self, *exc):
+        for k, v in self.saved.items():
+            setattr(main, k, v)
+
+
+def test_estimate():
+    """Test byte/time/output estimates from the selected format, scaled to a clip"""
+    print("Testing cost estimate...")
+    est = _estimate_cost(_INFO, None, [('m4a', 'good'), ('mp3', 'normal')])
+    assert est['download_bytes'] == 128 * 125 * 36000
+    assert est['output_bytes'] == (128 + 96) * 125 * 36000
+    assert est['transcode_seconds'] == round(36000 / main.TRANSCODE_SPEED, 1)
+    clip = _estimate_cost(_INFO, (0, 3600), [('m4a', 'good')])
+    assert clip['duration'] == 3600 and clip['download_bytes'] == est['download_bytes'] // 10
+    print(f"✓ 10h VOD: {est['download_bytes'] >> 20}MB download, {est['transcode_seconds']}s transcode")
+
+    unknown = _estimate_cost({'duration': None}, None, [('m4a', 'good')])
+    assert unknown == {'duration': None, 'download_bytes': None, 'transcode_seconds': None, 'output_bytes': None}
+    print("✓ unknown duration/size yields nulls")
+
+
+def test_limits():
+    """Test reject, clip and downgrade actions"""
+    print("\nTesting limit actions...")
+    with _Limits(MAX_DURATION=14400, MAX_DOWNLOAD_MB=0, PREFLIGHT_ACTION='reject'):
+        try:
+            _preflight(_INFO, None, [('m4a', 'good')])
+            assert False, "expected rejection"
+        except HTTPException as e:
+            assert e.status_code == 413 and 'MAX_DURATION' in e.detail
+        print("✓ reject: 10h over 4h limit -> 413")
+
+    with _Limits(MAX_DURATION=14400, MAX_DOWNLOAD_MB=0, PREFLIGHT_ACTION='clip'):
+        est, clip, fmt = _preflight(_INFO, (600, None), [('m4a', 'good')])
+        assert clip == (600, 600 + 14400) and fmt is None and est['action'] == 'clipped'
+        print("✓ clip: download range cut to the first 4h from the requested start")
+
+    with _Limits(MAX_DURATION=0, MAX_DOWNLOAD_MB=300, PREFLIGHT_ACTION='clip'):
+        est, clip, _ = _preflight(_INFO, None, [('m4a', 'good')])
+        assert est['download_bytes'] <= 300 << 20 and clip[1] > 0
+        print(f"✓ clip by size: {clip[1]:.0f}s fits under 300MB")
+
+    with _Limits(MAX_DURATION=2.5, MAX_DOWNLOAD_MB=0, PREFLIGHT_ACTION='clip'):
+        _, clip, _ = _preflight(_INFO, (10.5, None), [('m4a', 'good')])
+        assert clip == (10.5, 13.0), clip
+    # 20Mbps 的音轨在 1MB 上限下只能保留不到 1 秒：不截成空区间，直接拒绝
+    with _Limits(MAX_DURATION=0, MAX_DOWNLOAD_MB=1, PREFLIGHT_ACTION='clip'):
+        try:
+            _preflight({'duration': 3600, 'abr': 20000}, None, [('m4a', 'good')])
+            assert False, "expected rejection"
+        except HTTPException as e:
+            assert e.status_code == 413 and 'MAX_DOWNLOAD_MB' in e.detail
+        print("✓ clip keeps fractional lengths; under PREFLIGHT_MIN_CLIP -> 413")
+
+    with _Limits(MAX_DURATION=14400, MAX_DOWNLOAD_MB=300, PREFLIGHT_ACTION='downgrade'):
+        est, clip, fmt = _preflight(_INFO, None, [('m4a', 'good')])
+        assert fmt == '139' and clip is None and est['action'] == 'downgraded'
+        assert est['output_bytes'] == 96 * 125 * 36000
+        print("✓ downgrade: lowest-bitrate audio track, output at normal quality")
+
+    with _Limits(MAX_DURATION=0, MAX_DOWNLOAD_MB=100, PREFLIGHT_ACTION='downgrade'):
+        try:
+            _preflight(_INFO, None, [('m4a', 'good')])
+            assert False, "expected rejection"
+        except HTTPException as e:
+            assert e.status_code == 413
+        print("✓ downgrade still over the size limit -> 413")
+
+
+def test_single_extraction_and_clip():
+    """Test that the download reuses the preflight extraction and honours a preflight clip"""
+    print("\nTesting download with preflight...")
+    calls = []
+    original = yt_dlp.YoutubeDL.extract_info
+
+    def counting(self, *args, **kwargs):
+        calls.append(args[0])
+        info = original(self, *args, **kwargs)
+        # 直链没有时长信息，补上以触发预检
+        info.update(duration=5, abr=64)
+        return info
+
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=duration=5',
+                        '-b:a', '64k', os.path.join(tmp, 'talk.mp3')], check=True)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(_QuietHandler, directory=tmp))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/talk.mp3"
+        yt_dlp.YoutubeDL.extract_info = counting
+        try:
+            estimates = []
+            with _Limits(MAX_DURATION=0, MAX_DOWNLOAD_MB=0):
+                source = main._download_source_blocking(url, 'audio_preflight_a', outputs=[('m4a', 'good')],
+                                                        on_estimate=estimates.append)
+            assert len(calls) == 1, calls
+            assert estimates[0]['download_bytes'] == 64 * 125 * 5 and Path(source['source_path']).exists()
+            Path(source['source_path']).unlink()
+            print("✓ one extraction, estimate reported before download")
+
+            with _Limits(MAX_DURATION=2, MAX_DOWNLOAD_MB=0, PREFLIGHT_ACTION='reject'):
+                try:
+                    main._download_source_blocking(url, 'audio_preflight_b')
+                    assert False, "expected rejection"
+                except HTTPException as e:
+                    assert e.status_code == 413
+            assert not list(main.TEMP_DIR.glob('audio_preflight_b.*'))
+            print("✓ rejected before any bytes were written")
+
+            with _Limits(MAX_DURATION=2, MAX_DOWNLOAD_MB=0, PREFLIGHT_ACTION='clip'):
+                source = main._download_source_blocking(url, 'audio_preflight_c')
+            probe = subprocess.run(['ffmpeg', '-nostdin', '-i', source['source_path'], '-f', 'null', '-'],
+                                   capture_output=True, text=True).stderr
+            seconds = float(probe.rsplit('time=', 1)[1].split()[0].split(':')[-1])
+            assert source['duration'] == 2 and seconds < 3, (source['duration'], seconds)
+            assert source['full_duration'] == 5
+            Path(source['source_path']).unlink()
+            print(f"✓ clipped download is {seconds:.1f}s")
+
+            with _Limits(MAX_DURATION=0, MAX_DOWNLOAD_MB=0):
+                result = main._extract_audio_blocking(url, 'mp3', 'good', clip=(1.0, 3.0))
+            (main.TEMP_DIR / result['filename']).unlink(missing_ok=True)
+            indexed = main._search_index().get(main._canonicalize(url)[0])
+            assert result['duration'] == 2 and indexed['duration'] == 5, (result['duration'], indexed)
+            print("✓ clip result keeps the clip length, index keeps the full duration")
+        finally:
+            yt_dlp.YoutubeDL.extract_info = original
+            server.shutdown()
+
+
+def test_process_backend_keeps_status():
+    """Test that a preflight rejection inside the process pool still reaches /extract as 413"""
+    print("\nTesting preflight rejection with EXTRACT_BACKEND=process...")
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=duration=5',
+                        '-b:a', '64k', os.path.join(tmp, 'talk.mp3')], check=True)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(_QuietHandler, directory=tmp))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+        # 子进程重新导入 main、读不到这里改过的配置：页面自带 10 小时的时长，超过默认 MAX_DURATION
+        Path(tmp, 'page.html').write_text(
+            '<html><head><title>Long Talk</title><script type="application/ld+json">'
+            '{"@context": "https://schema.org", "@type": "VideoObject", "name": "Long Talk", '
+            f'"contentUrl": "{base}/talk.mp3", "duration": "PT10H", "uploadDate": "2024-01-01", '
+            f'"thumbnailUrl": "{base}/t.jpg"}}</script></head><body></body></html>')
+        assert main.MAX_DURATION < 36000 and main.PREFLIGHT_ACTION == 'reject'
+        try:
+            with _Limits(EXTRACT_BACKEND='process'), TestClient(main.app) as client:
+                r = client.post('/extract', json={'url': f"{base}/page.html"})
+            assert r.status_code == 413 and 'MAX_DURATION' in r.json()['detail'], (r.status_code, r.text)
+        finally:
+            main._SHUTTING_DOWN = False
+            server.shutdown()
+    print(f"✓ 413 from the worker process: {r.json()['detail']}")
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == "__main__":
+    test_estimate()
+    test_limits()
+    test_single_extraction_and_clip()
+    test_process_backend_keeps_status()
+    print("\nAll tests completed!")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Test script for the proxy pool, using a local stand-in HTTP proxy
+"""
+import os
+import sys
+import socket
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import _ProxyPool
+
+
+class _ForwardProxy(BaseHTTPRequestHandler):
+    """Minimal forward proxy: GET with an absolute URL is fetched and relayed"""
+    def do_GET(self):
+        with urllib.request.urlopen(self.path, timeout=5) as r:
+            body = r.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Origin(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _dead_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_health_check_and_quarantine():
+    """Test that a dead proxy is quarantined by health checks and a live one is kept"""
+    print("Testing proxy health checks...")
+    origin, proxy = _serve(_Origin), _serve(_ForwardProxy)
+    good = f"http://127.0.0.1:{proxy.server_address[1]}"
+    dead = f"http://127.0.0.1:{_dead_port()}"
+    saved = main.PROXY_CHECK_URL, main.PROXY_CHECK_INTERVAL, main.PROXY_MAX_FAILURES
+    main.PROXY_CHECK_URL = f"http://127.0.0.1:{origin.server_address[1]}/"
+    main.PROXY_CHECK_INTERVAL, main.PROXY_MAX_FAILURES = 0, 1
+    try:
+        pool = _ProxyPool([dead, good])
+        pool.check_all()
+        snap = pool.snapshot()['proxies']
+        assert snap[dead]['quarantined_for'] > 0
+        assert snap[good]['quarantined_for'] == 0 and snap[good]['latency_ms'] is not None
+        print("✓ dead proxy quarantined, live proxy measured")
+
+        for _ in range(3):
+            assert pool.pick("https://www.bilibili.com/video/BV1") == good
+        print("✓ quarantined proxy is skipped")
+    finally:
+        main.PROXY_CHECK_URL, main.PROXY_CHECK_INTERVAL, main.PROXY_MAX_FAILURES = saved
+        origin.shutdown()
+        proxy.shutdown()
+
+
+def test_least_loaded_and_ban():
+    """Test least-loaded selection and quarantine after a ban"""
+    print("\nTesting least-loaded selection...")
+    saved = main.PROXY_CHECK_INTERVAL
+    main.PROXY_CHECK_INTERVAL = 0
+    try:
+        pool = _ProxyPool(["http://p1:1", "http://p2:2"])
+        with pool.lease("https://www.bilibili.com/video/BV1") as first:
+            with pool.lease("https://www.bilibili.com/video/BV2") as second:
+                assert first['proxy'] != second['proxy']
+        print("✓ concurrent jobs spread across proxies")
+
+        try:
+            with pool.lease("https://www.bilibili.com/video/BV3") as lease:
+                banned = lease['proxy']
+                raise RuntimeError("HTTP Error 429: Too Many Requests")
+        except RuntimeError:
+            pass
+        assert pool.snapshot()['proxies'][banned]['quarantined_for'] > 0
+        assert pool.pick("https://www.bilibili.com/video/BV4") != banned
+        print("✓ banned proxy quarantined immediately")
+    finally:
+        main.PROXY_CHECK_INTERVAL = saved
+
+
+def test_sticky_with_cookies():
+    """Test that platforms using cookies stick to one proxy"""
+    print("\nTesting sticky assignment...")
+    saved = main.PROXY_CHECK_INTERVAL
+    main.PROXY_CHECK_INTERVAL = 0
+    os.environ['YT_COOKIES_B64'] = 'dGVzdA=='
+    try:
+        pool = _ProxyPool(["http://p1:1", "http://p2:2"])
+        with pool.lease("https://www.youtube.com/watch?v=a") as a:
+            with pool.lease("https://www.youtube.com/watch?v=b") as b:
+                assert a['proxy'] == b['proxy']
+        print("✓ cookie session pinned to one proxy")
+    finally:
+        main.PROXY_CHECK_INTERVAL = saved
+        del os.environ['YT_COOKIES_B64']
+
+
+if __name__ == "__main__":
+    test_health_check_and_quarantine()
+    test_least_loaded_and_ban()
+    test_sticky_with_cookies()
+    print("\nAll tests completed!")
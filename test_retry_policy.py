@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Test script for error-classified retries that re-queue instead of holding a worker
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import yt_dlp
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+from main import _classify_error, _retry_delay
+
+
+class _Flaky(SimpleHTTPRequestHandler):
+    """Serves files, answering the first `fail_first` requests with 503"""
+    fail_first = 0
+
+    def do_GET(self):
+        if _Flaky.fail_first > 0:
+            _Flaky.fail_first -= 1
+            self.send_error(503)
+            return
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_classification():
+    """Test that representative yt-dlp / network / service errors land in the right class"""
+    print("Testing error classification...")
+    cases = {
+        "ERROR: [youtube] abc: Sign in to confirm you’re not a bot. Use --cookies-from-browser or --cookies "
+        "for the authentication": 'rate_limit',
+        "ERROR: [youtube] abc: Sign in to confirm your age. This video may be inappropriate": 'auth',
+        "ERROR: unable to download video data: HTTP Error 429: Too Many Requests": 'rate_limit',
+        "ERROR: [youtube] abc: The uploader has not made this video available in your country": 'geo',
+        "ERROR: [BiliBili] BV1: This video is not available from your location due to geo restriction": 'geo',
+        "ERROR: [youtube] abc: Private video. Sign in if you've been granted access": 'auth',
+        "ERROR: [youtube] abc: Video unavailable. This video has been removed by the uploader": 'unavailable',
+        "ERROR: Unsupported URL: https://example.com/page": 'unavailable',
+        "ERROR: Unable to download webpage: HTTP Error 503: Service Unavailable": 'network',
+        "ERROR: Unable to download webpage: <urlopen error [Errno 111] Connection refused>": 'network',
+        "ERROR: [download] Got error: The read operation timed out": 'network',
+        "ffmpeg failed: Invalid data found when processing input": 'permanent',
+    }
+    for msg, expected in cases.items():
+        got = _classify_error(yt_dlp.utils.DownloadError(msg))
+        assert got == expected, (msg, got)
+    print(f"✓ {len(cases)} yt-dlp messages classified")
+
+    original = yt_dlp.utils.GeoRestrictedError('blocked')
+    wrapped = yt_dlp.utils.DownloadError('ERROR: blocked', exc_info=(type(original), original, None))
+    assert _classify_error(wrapped) == 'geo'
+    assert _classify_error(ConnectionResetError(104, 'reset by peer')) == 'network'
+    assert _classify_error(HTTPException(status_code=413, detail='duration over MAX_DURATION')) == 'permanent'
+    assert _classify_error(HTTPException(status_code=404, detail='Cannot fetch video info')) == 'unavailable'
+    print("✓ original exception types and service HTTP errors classified")
+
+    # 视频 ID 里的数字不是状态码
+    for msg, expected in {
+        "ERROR: [douyin] 7301234290123456789: Video unavailable": 'unavailable',
+        "ERROR: [douyin] 7294031234567890123: This video has been removed": 'unavailable',
+        "ERROR: [douyin] 7301429503504123456: Failed to parse JSON": 'permanent',
+        "ERROR: [youtube] aSSlPremium: Some unexpected failure": 'permanent',
+        "ERROR: [douyin] 7301234290123456789: Unable to download webpage: HTTP Error 404: Not Found": 'unavailable',
+    }.items():
+        got = _classify_error(yt_dlp.utils.DownloadError(msg))
+        assert got == expected, (msg, got)
+    print("✓ numeric video IDs do not look like HTTP statuses")
+
+    # 状态码从原始异常对象读取
+    import urllib.error
+    http_error = urllib.error.HTTPError('https://example.com/v', 429, 'slow down', {}, None)
+    wrapped = yt_dlp.utils.DownloadError('ERROR: Unable to download webpage',
+                                         exc_info=(type(http_error), http_error, None))
+    assert _classify_error(wrapped) == 'rate_limit'
+    try:
+        try:
+            raise urllib.error.HTTPError('https://example.com/v', 502, 'upstream', {}, None)
+        except urllib.error.HTTPError as e:
+            raise RuntimeError('fetch failed') from e
+    except RuntimeError as e:
+        assert _classify_error(e) == 'network'
+    print("✓ HTTP status read from the exception chain")
+
+
+def test_budget_and_backoff():
+    """Test per-class budgets and doubling backoff with a cap"""
+    print("\nTesting retry budget...")
+    saved = main.RETRY_POLICY, main.RETRY_MAX_DELAY
+    main.RETRY_POLICY = dict(saved[0], rate_limit=(3, 60), unavailable=(0, 0))
+    main.RETRY_MAX_DELAY = 100
+    try:
+        delays = [_retry_delay({'retries': {'rate_limit': n, 'network': 5}}, 'rate_limit') for n in range(4)]
+        assert delays == [60, 100, 100, None], delays
+        assert _retry_delay({}, 'unavailable') is None and _retry_delay({}, 'unknown') is None
+    finally:
+        main.RETRY_POLICY, main.RETRY_MAX_DELAY = saved
+    print("✓ 60s, doubled and capped at RETRY_MAX_DELAY, then out of budget; no retry for unavailable")
+
+
+def test_requeue_frees_worker():
+    """Test that transient failures are re-queued with backoff and the download slot is free meanwhile"""
+    print("\nTesting re-queue on transient failure...")
+    saved = main.RETRY_POLICY, main.FINGERPRINT_ENABLED, main.PEAKS_ENABLED
+    main.RETRY_POLICY = dict(saved[0], network=(3, 0.5))
+    main.FINGERPRINT_ENABLED = main.PEAKS_ENABLED = False
+    main._ERROR_COUNTS.clear()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=duration=2',
+                        '-b:a', '64k', os.path.join(tmp, 'clip.mp3')], check=True)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(_Flaky, directory=tmp))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        def wait_for(task_id, done):
+            while not done(main.TASKS[task_id]):
+                time.sleep(0.05)
+            return main.TASKS[task_id]
+
+        try:
+            with TestClient(main.app) as client:
+                def submit(path):
+                    return client.post('/api/process', json={'url': base + path}).json()['task_id']
+
+                # yt-dlp 解析与下载各请求一次；前两次 503 让任务失败两次
+                _Flaky.fail_first = 2
+                task_id = submit('/clip.mp3')
+                seen = []
+                while main.TASKS[task_id]['status'] not in ('completed', 'failed'):
+                    t = dict(main.TASKS[task_id])
+                    if t['status'] == 'pending' and t.get('retry_at') and t['message'] not in seen:
+                        seen.append(t['message'])
+                        # 退避期间任务不占下载槽位
+                        assert task_id not in main._TASK_RUNNERS and task_id in main._RETRY_TIMERS
+                        assert main._PIPELINE.scheduler.free == main.DOWNLOAD_WORKERS
+                    time.sleep(0.05)
+                t = main.TASKS[task_id]
+                assert t['status'] == 'completed', t.get('error_detail')
+                assert t['retries'] == {'network': 2} and seen == ['retrying in 0.5s', 'retrying in 1s'], (t, seen)
+                assert main._ERROR_COUNTS['network']['retried'] == 2
+                print("✓ two 503s re-queued after 0.5s and 1s, third attempt completed")
+
+                missing = submit('/missing.mp3')
+                t = wait_for(missing, lambda t: t['status'] in ('completed', 'failed'))
+                assert t['error_class'] == 'unavailable' and t['error_detail'].startswith('unavailable: ')
+                assert not t.get('retries') and main._ERROR_COUNTS['unavailable'] == {'retried': 0, 'failed': 1}
+                print(f"✓ 404 failed at once: {t['error_detail'][:60]}...")
+
+                # 换一个地址，避开刚才下载过的音源复用
+                _Flaky.fail_first = 100
+                waiting = submit('/another.mp3')
+                wait_for(waiting, lambda t: t.get('retry_at'))
+                assert client.delete(f"/api/tasks/{waiting}").json()['status'] == 'cancelled'
+                time.sleep(1)
+                assert main.TASKS[waiting]['status'] == 'cancelled' and waiting not in main._TASK_RUNNERS
+                print("✓ a task waiting to retry can be cancelled")
+        finally:
+            main.RETRY_POLICY, main.FINGERPRINT_ENABLED, main.PEAKS_ENABLED = saved
+            main._SHUTTING_DOWN = False
+            server.shutdown()
+            for p in main.TEMP_DIR.glob('audio_*clip*'):
+                p.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    test_classification()
+    test_budget_and_backoff()
+    test_requeue_frees_worker()
+    print("\nAll tests completed!")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Test script for the local search index, suggest and local-first search
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import _SearchIndex
+
+SONGS = [
+    {'id': 1, 'name': '晴天', 'artist': '周杰伦', 'album': '叶惠美', 'duration': 269},
+    {'id': 2, 'name': '七里香', 'artist': '周杰伦', 'album': '七里香', 'duration': 299},
+    {'id': 3, 'name': 'Shape of You', 'artist': 'Ed Sheeran', 'album': 'Divide', 'duration': 233},
+    {'id': 4, 'name': '100%_test', 'artist': 'Odd', 'album': '', 'duration': 10},
+]
+
+
+def _index(tmp):
+    index = _SearchIndex(os.path.join(tmp, 'search.db'))
+    index.add([(f"netease:{s['id']}", 'song', s['name'], s['artist'], s['album'], s) for s in SONGS])
+    index.add([('youtube:dQw4w9WgXcQ', 'video', 'Rick Astley - Never Gonna Give You Up', '', '',
+                {'id': 'youtube:dQw4w9WgXcQ', 'name': 'Rick Astley - Never Gonna Give You Up'})])
+    return index
+
+
+def test_search():
+    """Test substring matching for CJK and latin text, short terms and filters"""
+    print("Testing index search...")
+    with tempfile.TemporaryDirectory() as tmp:
+        index = _index(tmp)
+        assert {s['id'] for s in index.search('周杰伦')} == {1, 2}
+        assert [s['id'] for s in index.search('杰伦 晴天')] == [1]
+        print("✓ CJK substring and multi-term queries")
+        assert [s['id'] for s in index.search('sheer')] == [3]
+        assert [s['id'] for s in index.search('never gonna')] == ['youtube:dQw4w9WgXcQ']
+        assert index.search('never gonna', kind='song') == []
+        print("✓ case-insensitive latin match, kind filter")
+        assert [s['id'] for s in index.search('晴')] == [1]
+        assert [s['id'] for s in index.search('0%_')] == [4]
+        print("✓ short terms fall back to LIKE with escaping")
+        assert index.search('周杰伦', fresh_after=time.time() + 1) == []
+        print("✓ freshness cutoff")
+
+        # 被上游多次返回的歌曲排在前面
+        index.add([("netease:2", 'song', '七里香', '周杰伦', '七里香', SONGS[1])])
+        assert [s['id'] for s in index.search('周杰伦')][0] == 2
+        print("✓ frequently returned songs rank first")
+
+
+def test_local_first():
+    """Test local-first search answers from the index and refreshes in the background"""
+    print("\nTesting local-first search...")
+    calls = []
+
+    async def fake_upstream(keyword, limit):
+        calls.append(keyword)
+        return [SONGS[0]]
+
+    saved = main._SEARCH_INDEX, main._search_upstream
+    with tempfile.TemporaryDirectory() as tmp:
+        main._SEARCH_INDEX, main._search_upstream = _index(tmp), fake_upstream
+        try:
+            async def run():
+                r = await main.search_music('周杰伦', limit=2, mode='local_first')
+                assert r['source'] == 'local' and len(r['songs']) == 2 and 'kind' not in r['songs'][0]
+                await asyncio.sleep(0.05)
+                assert calls == ['周杰伦']
+                print("✓ answered locally, refreshed from upstream in background")
+
+                r = await main.search_music('Adele', limit=2, mode='local_first')
+                assert 'source' not in r and calls[-1] == 'Adele'
+                print("✓ not enough local hits -> upstream")
+
+                s = await main.suggest_music('七里')
+                assert s['suggestions'][0]['name'] == '七里香'
+                print("✓ suggest served from the index")
+            asyncio.run(run())
+        finally:
+            main._SEARCH_INDEX.db.close()
+            main._SEARCH_INDEX, main._search_upstream = saved
+
+
+if __name__ == "__main__":
+    test_search()
+    test_local_first()
+    print("\nAll tests completed!")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Test script for segmented output with overlap and the segment manifest
+"""
+import asyncio
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import _Segmenter
+
+
+def _cut(pcm, rate, seconds, overlap, at_silence, chunk=3001 * 2):
+    segments, data = [], {}
+
+    def open_segment(index):
+        data[index] = bytearray()
+        return data[index].extend
+
+    def close_segment(index, start, end):
+        segments.append((start, end, bytes(data.pop(index))))
+
+    segmenter = _Segmenter(rate, 1, seconds, overlap, at_silence, open_segment, close_segment)
+    peak = 0
+    for i in range(0, len(pcm), chunk):
+        segmenter.feed(pcm[i:i + chunk])
+        peak = max(peak, len(segmenter.buf))
+    segmenter.finish()
+    return segments, peak
+
+
+def test_overlap_windows():
+    """Test fixed-length windows with overlap, the short tail and a bounded buffer"""
+    print("Testing overlapping windows...")
+    rate = 1000
+    pcm = b''.join(i.to_bytes(2, 'little') for i in range(25 * rate))
+    segments, peak = _cut(pcm, rate, 10, 2, False)
+    assert [(s, e) for s, e, _ in segments] == [(0, 10000), (8000, 18000), (16000, 25000)]
+    for start, end, data in segments:
+        assert data == pcm[start * 2:end * 2]
+    # 无静音搜索时只需缓存重叠部分（加一个读取块）
+    assert peak <= (2 * rate + 3001) * 2, peak
+    print("✓ 25s in 10s windows with 2s overlap: 0-10, 8-18, 16-25; bytes match the input")
+
+    segments, _ = _cut(pcm[:20 * rate * 2], rate, 10, 0, False)
+    assert [(s, e) for s, e, _ in segments] == [(0, 10000), (10000, 20000)]
+    print("✓ input ending on a boundary does not leave an empty trailing segment")
+
+
+def test_cut_at_silence():
+    """Test that a cut moves back to the quietest point inside the search window"""
+    print("\nTesting silence-aware cuts...")
+    rate = 8000
+    loud = (8000).to_bytes(2, 'little', signed=True) + (-8000).to_bytes(2, 'little', signed=True)
+    # 0-57.2s 有声，57.2-57.6s 静音，之后继续有声
+    pcm = loud * (rate * 572 // 20) + b'\0\0' * (rate * 4 // 10) + loud * (rate * 30 // 2)
+    segments, _ = _cut(pcm, rate, 60, 1, True)
+    first_end = segments[0][1] / rate
+    assert 57.2 <= first_end <= 57.6, first_end
+    assert segments[1][0] == segments[0][1] - rate
+    print(f"✓ first cut at {first_end:.2f}s inside the pause instead of 60s")
+
+
+def _probe_seconds(path):
+    err = subprocess.run(['ffmpeg', '-nostdin', '-i', str(path), '-f', 'null', '-'],
+                         capture_output=True, text=True).stderr
+    h, m, s = re.findall(r'time=(\d+):(\d+):([\d.]+)', err)[-1]
+    return int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def test_transcode_segments():
+    """Test one decode pass into per-segment files that are reported as each one is written"""
+    print("\nTesting segmented transcode...")
+    src = main.TEMP_DIR / 'audio_segtest.source.wav'
+    subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 'lavfi',
+                    '-i', 'sine=frequency=440:duration=25', '-ac', '2', str(src)], check=True)
+    seen = []
+
+    def on_segment(segment):
+        # 回调时该段已可下载，后面的段还没写完
+        later = main.TEMP_DIR / f"audio_segtest_{segment['index'] + 2:04d}.m4a"
+        seen.append((segment, (main.TEMP_DIR / segment['filename']).exists(), later.exists()))
+
+    source = {'basename': 'audio_segtest', 'source_path': str(src), 'acodec': 'pcm_s16le', 'title': 'Talk',
+              'duration': 25, 'clip': None, 'segment': {'seconds': 10, 'overlap': 2, 'at_silence': False},
+              'on_segment': on_segment}
+    try:
+        result = main._transcode_blocking(source, 'm4a', 'good')
+        segments = result['segments']
+        assert [(s['start'], s['end']) for s in segments] == [(0, 10), (8, 18), (16, 25)]
+        assert [s['filename'] for s in segments] == [f"audio_segtest_000{i}.m4a" for i in (1, 2, 3)]
+        assert [(s, ready, later) for s, ready, later in seen] == [(s, True, False) for s in segments]
+        for s in segments:
+            seconds = _probe_seconds(main.TEMP_DIR / s['filename'])
+            assert abs(seconds - (s['end'] - s['start'])) < 0.1, (s, seconds)
+        print("✓ three m4a segments, each reported as soon as it was written")
+
+        main.TASKS['segtest'] = {'status': 'processing', 'duration': 25, 'segments': segments[:2],
+                                 'segment_spec': source['segment']}
+        main._presign_outputs(main.TASKS['segtest'])
+        manifest = asyncio.run(main.segment_manifest('segtest'))
+        assert not manifest['complete'] and manifest['overlap'] == 2
+        assert manifest['segments'][1]['url'].endswith('/api/download/audio_segtest_0002.m4a')
+        print("✓ manifest lists written segments with download URLs before the task completes")
+    finally:
+        main.TASKS.pop('segtest', None)
+        src.unlink(missing_ok=True)
+        for p in main.TEMP_DIR.glob('audio_segtest_*.m4a'):
+            p.unlink()
+
+
+if __name__ == "__main__":
+    test_overlap_windows()
+    test_cut_at_silence()
+    test_transcode_segments()
+    print("\nAll tests completed!")
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Test script for the speech / ASR output profiles and opus output
+"""
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+_SRC = main.TEMP_DIR / 'audio_speechtest.source.wav'
+
+
+def _make_source():
+    """30s stereo 44.1kHz: 2s noisy tone bursts separated by 3s of silence"""
+    if not _SRC.exists():
+        subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', "aevalsrc='(0.3*sin(2*PI*300*t)+0.2*(random(0)-0.5))*lt(mod(t,5),2)|"
+                              "(0.3*sin(2*PI*450*t)+0.2*(random(1)-0.5))*lt(mod(t,5),2)':s=44100:d=30",
+                        str(_SRC)], check=True)
+    return {'basename': 'audio_speechtest', 'source_path': str(_SRC), 'acodec': 'pcm_s16le',
+            'title': 'Talk', 'duration': 30, 'clip': None}
+
+
+def _probe(path):
+    err = subprocess.run(['ffmpeg', '-nostdin', '-i', str(path), '-f', 'null', '-'],
+                         capture_output=True, text=True).stderr
+    stream = re.search(r'Audio: (\w+).*?, (\d+) Hz, (mono|stereo)', err)
+    seconds = re.findall(r'time=(\d+):(\d+):([\d.]+)', err)[-1]
+    return stream.group(1), int(stream.group(2)), stream.group(3), int(seconds[1]) * 60 + float(seconds[2])
+
+
+def _transcode(fmt, quality, **extra):
+    result = main._transcode_blocking(dict(_make_source(), **extra), fmt, quality,
+                                      out_name=f"audio_speechtest_{quality}.{fmt}")
+    return Path(result['file_path'])
+
+
+def test_speech_profiles():
+    """Test that speech outputs are mono 16kHz and several times smaller than the default profile"""
+    print("Testing speech profiles...")
+    saved = main.FINGERPRINT_ENABLED
+    main.FINGERPRINT_ENABLED = False
+    try:
+        default = _transcode('m4a', 'good')
+        opus = _transcode('opus', 'speech')
+        aac = _transcode('m4a', 'speech')
+        codec, rate, layout, seconds = _probe(opus)
+        assert (codec, rate, layout) == ('opus', 48000, 'mono'), (codec, rate, layout)
+        # opus 解码固定输出 48kHz，编码端的 16kHz 体现在码率上
+        codec, rate, layout, _ = _probe(aac)
+        assert (codec, rate, layout) == ('aac', 16000, 'mono')
+        ratio_opus = default.stat().st_size / opus.stat().st_size
+        ratio_aac = default.stat().st_size / aac.stat().st_size
+        assert ratio_opus > 3 and ratio_aac > 2.5, (ratio_opus, ratio_aac)
+        print(f"✓ opus speech {ratio_opus:.1f}x, aac speech {ratio_aac:.1f}x smaller than m4a/good")
+
+        wav = _transcode('wav', 'speech')
+        header = wav.read_bytes()[:44]
+        channels, rate = int.from_bytes(header[22:24], 'little'), int.from_bytes(header[24:28], 'little')
+        bits = int.from_bytes(header[34:36], 'little')
+        assert (channels, rate, bits) == (1, 16000, 16), (channels, rate, bits)
+        assert abs(wav.stat().st_size - 30 * 16000 * 2) < 4096
+        print("✓ wav speech is 16-bit PCM, mono, 16kHz")
+        for p in (default, opus, aac, wav):
+            p.unlink()
+            main._peaks_path(p.name).unlink(missing_ok=True)
+    finally:
+        main.FINGERPRINT_ENABLED = saved
+
+
+def test_trim_silence():
+    """Test silence trimming in the same ffmpeg pass, with peaks following the trimmed timeline"""
+    print("\nTesting silence trimming...")
+    out = _transcode('opus', 'speech', trim_silence=True)
+    seconds = _probe(out)[3]
+    # 6 段 2 秒的有声部分；每段之后 3 秒的静音被压缩成不到 1 秒
+    assert 12 < seconds < 18, seconds
+    print(f"✓ 30s with long pauses trimmed to {seconds:.1f}s")
+    if main.PEAKS_ENABLED:
+        import json
+        peaks = json.loads(main._peaks_path(out.name).read_text())
+        level = peaks['levels'][0]
+        covered = level['length'] * level['samples_per_peak'] / peaks['sample_rate']
+        assert abs(covered - seconds) < 1, (covered, seconds)
+        print("✓ waveform peaks match the trimmed audio")
+        main._peaks_path(out.name).unlink()
+    out.unlink()
+    _SRC.unlink()
+
+
+if __name__ == "__main__":
+    test_speech_profiles()
+    test_trim_silence()
+    print("\nAll tests completed!")
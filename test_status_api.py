@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Test script for bulk status polling and ETag revalidation
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import Request
+
+import main
+from main import TASKS
+
+
+def _request(etag=None):
+    headers = [(b'if-none-match', etag.encode())] if etag else []
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': headers, 'query_string': b''})
+
+
+def test_single_status_etag():
+    """Test that unchanged polls get 304 and a change yields a new ETag"""
+    print("Testing single status ETag...")
+    TASKS['t1'] = {'status': 'processing', 'progress': 10, 'message': 'downloading'}
+    r = asyncio.run(main.status('t1', _request()))
+    etag = r.headers['etag']
+    assert r.status_code == 200 and json.loads(r.body)['progress'] == 10
+    assert asyncio.run(main.status('t1', _request(etag))).status_code == 304
+    print("✓ unchanged task returns 304")
+
+    cached = TASKS['t1']._status_body
+    assert cached is not None and asyncio.run(main._status_body('t1')) is cached
+    TASKS['t1'].update(progress=50)
+    assert TASKS['t1']._status_body is None
+    r = asyncio.run(main.status('t1', _request(etag)))
+    assert r.status_code == 200 and r.headers['etag'] != etag
+    assert json.loads(r.body)['progress'] == 50
+    print("✓ update invalidates the precomputed body")
+
+
+def test_bulk_status():
+    """Test GET/POST bulk status and combined ETag"""
+    print("\nTesting bulk status...")
+    TASKS['b1'] = {'status': 'completed', 'progress': 100, 'message': 'done', 'audio_file': 'x.mp3'}
+    TASKS['b2'] = {'status': 'pending', 'progress': 0, 'message': 'queued'}
+    r = asyncio.run(main.bulk_status(_request(), ids='b1,b2,missing,b1'))
+    data = json.loads(r.body)['tasks']
+    assert list(data) == ['b1', 'b2', 'missing']
+    assert data['b1']['audio_file'] == 'x.mp3' and data['missing']['error_detail'] == 'not_found'
+    print("✓ GET returns all requested tasks, duplicates collapsed")
+
+    etag = r.headers['etag']
+    r = asyncio.run(main.bulk_status_post(_request(etag), main.BulkStatusRequest(ids=['b1', 'b2', 'missing'])))
+    assert r.status_code == 304
+    TASKS['b2']['status'] = 'processing'
+    r = asyncio.run(main.bulk_status_post(_request(etag), main.BulkStatusRequest(ids=['b1', 'b2', 'missing'])))
+    assert r.status_code == 200 and json.loads(r.body)['tasks']['b2']['status'] == 'processing'
+    print("✓ POST variant shares the ETag; any task change invalidates it")
+
+
+def test_status_from_queue_off_loop():
+    """Test that tasks outside this process are read from the shared queue in one batch, off the event loop"""
+    print("\nTesting status lookups against the shared queue...")
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = main.SQLiteJobQueue(os.path.join(tmp, 'jobs.db'))
+        for i in range(3):
+            queue.enqueue(f"q{i}", {'url': 'https://example.com/v'}, {'status': 'pending', 'message': 'queued'})
+        calls = []
+        get_many = queue.get_many
+
+        def recording(task_ids):
+            calls.append((list(task_ids), threading.current_thread() is threading.main_thread()))
+            return get_many(task_ids)
+
+        def single(task_id):
+            raise AssertionError("per-id lookup")
+
+        queue.get_many, queue.get = recording, single
+        saved = main._JOB_QUEUE
+        main._JOB_QUEUE = queue
+        TASKS['local'] = {'status': 'processing', 'progress': 30, 'message': 'downloading'}
+        try:
+            r = asyncio.run(main.bulk_status(_request(), ids='q0,local,q1,q2,gone'))
+            data = json.loads(r.body)['tasks']
+            assert data['q1']['message'] == 'queued' and data['local']['progress'] == 30
+            assert data['gone']['error_detail'] == 'not_found'
+            assert calls == [(['q0', 'q1', 'q2', 'gone'], False)], calls
+            print("✓ bulk: one get_many for the ids not in memory, run in a worker thread")
+
+            calls.clear()
+            r = asyncio.run(main.status('q2', _request()))
+            assert json.loads(r.body)['status'] == 'pending' and calls == [(['q2'], False)], calls
+            asyncio.run(main.status('local', _request()))
+            assert len(calls) == 1
+            print("✓ single status: queue read off the loop, in-memory task not looked up")
+        finally:
+            main._JOB_QUEUE = saved
+
+
+if __name__ == "__main__":
+    test_single_status_etag()
+    test_bulk_status()
+    test_status_from_queue_off_loop()
+    print("\nAll tests completed!")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Test script for push-based task updates (long-poll, SSE, WebSocket)
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import requests
+import uvicorn
+from websockets.sync.client import connect
+
+import main
+from main import TASKS
+
+
+_BASE = None
+
+
+def _base():
+    """Start the app once on a random local port (daemon thread, exits with the process)"""
+    global _BASE
+    if _BASE is None:
+        server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=0, log_level='warning'))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        _BASE = f"http://127.0.0.1:{server.servers[0].sockets[0].getsockname()[1]}"
+    return _BASE
+
+
+def _later(delay, fn):
+    threading.Timer(delay, fn).start()
+
+
+def test_long_poll():
+    """Test that ?wait=N returns as soon as the task changes"""
+    print("Testing long-poll...")
+    base = _base()
+    TASKS['lp'] = {'status': 'processing', 'progress': 10, 'message': 'downloading'}
+    etag = requests.get(f"{base}/api/status/lp").headers['etag']
+
+    r = requests.get(f"{base}/api/status/lp?wait=0.5", headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    print("✓ no change within wait -> 304")
+
+    _later(0.3, lambda: TASKS['lp'].update(progress=60))
+    started = time.time()
+    r = requests.get(f"{base}/api/status/lp?wait=10", headers={'If-None-Match': etag})
+    assert r.status_code == 200 and r.json()['progress'] == 60
+    assert time.time() - started < 3
+    print(f"✓ change delivered after {time.time() - started:.2f}s")
+
+
+def test_sse():
+    """Test that the SSE stream pushes each change and closes on completion"""
+    print("\nTesting SSE...")
+    base = _base()
+    TASKS['sse'] = {'status': 'processing', 'progress': 10, 'message': 'downloading'}
+    _later(0.3, lambda: TASKS['sse'].update(progress=50, message='converting'))
+    _later(0.6, lambda: TASKS['sse'].update(status='completed', progress=100, message='done'))
+    events = []
+    with requests.get(f"{base}/api/status/sse/events", stream=True, timeout=10) as r:
+        assert r.headers['content-type'].startswith('text/event-stream')
+        for line in r.iter_lines():
+            if line.startswith(b'data: '):
+                events.append(json.loads(line[6:]))
+    assert [e['progress'] for e in events] == [10, 50, 100], events
+    print("✓ received initial state, update and final state; stream closed")
+
+
+def test_websocket():
+    """Test multi-task subscription over one WebSocket"""
+    print("\nTesting WebSocket...")
+    base = _base()
+    TASKS['w1'] = {'status': 'processing', 'progress': 10, 'message': 'downloading'}
+    TASKS['w2'] = {'status': 'pending', 'progress': 0, 'message': 'queued'}
+    with connect(base.replace('http', 'ws') + "/ws/status") as ws:
+        ws.send(json.dumps({'subscribe': ['w1', 'w2']}))
+        first = json.loads(ws.recv(timeout=5))['tasks']
+        assert set(first) == {'w1', 'w2'}
+        print("✓ initial state for both subscribed tasks")
+
+        TASKS['w2'].update(status='processing', progress=20)
+        update = json.loads(ws.recv(timeout=5))['tasks']
+        assert list(update) == ['w2'] and update['w2']['progress'] == 20
+        print("✓ only the changed task is pushed")
+
+        TASKS['w1'].update(status='completed', progress=100)
+        update = json.loads(ws.recv(timeout=5))['tasks']
+        assert update['w1']['status'] == 'completed'
+        time.sleep(0.2)
+        assert main._TASK_WATCHERS.get('w1') is None
+        print("✓ finished task pushed once, then unsubscribed")
+
+
+if __name__ == "__main__":
+    test_long_poll()
+    test_sse()
+    test_websocket()
+    print("\nAll tests completed!")
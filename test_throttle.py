@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Test script for the per-platform adaptive limiter
+"""
+import os
+import sys
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import _HostLimiter, _platform_key, _is_throttle_error
+
+
+def test_platform_key():
+    """Test platform grouping of URLs"""
+    print("Testing platform keys...")
+    cases = {
+        "https://www.youtube.com/watch?v=abc": "youtube",
+        "https://youtu.be/abc": "youtube",
+        "ytsearch1:some song audio": "youtube",
+        "https://v.douyin.com/abc123/": "douyin",
+        "https://b23.tv/xyz": "bilibili",
+        "https://www.bilibili.com/video/BV1xx411c7mD": "bilibili",
+    }
+    for url, expected in cases.items():
+        assert _platform_key(url) == expected, url
+        print(f"✓ {url} -> {expected}")
+
+
+def test_throttle_detection():
+    """Test which errors count as throttling"""
+    print("\nTesting throttle error detection...")
+    assert _is_throttle_error(Exception("HTTP Error 429: Too Many Requests"))
+    assert _is_throttle_error(Exception("Sign in to confirm you're not a bot"))
+    assert not _is_throttle_error(Exception("Video unavailable"))
+    assert _is_throttle_error(Exception("HTTP Error 403: Forbidden"))
+    # 视频 ID 里的 403 / 429 不算限流
+    assert not _is_throttle_error(Exception("ERROR: [douyin] 7301234290123456789: Video unavailable"))
+    assert not _is_throttle_error(Exception("ERROR: [douyin] 7294031234567890123: Video unavailable"))
+    print("✓ 429 / 403 / bot check detected, unavailable and numeric IDs ignored")
+
+
+def test_aimd():
+    """Test multiplicative decrease on throttling and additive recovery"""
+    print("\nTesting AIMD...")
+    cooldown, main.THROTTLE_COOLDOWN = main.THROTTLE_COOLDOWN, 0
+    try:
+        limiter = _HostLimiter('test', rate=100, burst=100, concurrency=8)
+        try:
+            with limiter.slot():
+                raise RuntimeError("HTTP Error 429: Too Many Requests")
+        except RuntimeError:
+            pass
+        snap = limiter.snapshot()
+        assert snap['concurrency_limit'] == 4 and snap['rate'] == 50 and snap['active'] == 0
+        print("✓ limit and rate halved after 429")
+
+        for _ in range(20):
+            with limiter.slot():
+                pass
+        snap = limiter.snapshot()
+        assert snap['concurrency_limit'] > 4 and snap['rate'] == 100
+        print("✓ limit and rate recover after successes")
+    finally:
+        main.THROTTLE_COOLDOWN = cooldown
+
+
+if __name__ == "__main__":
+    test_platform_key()
+    test_throttle_detection()
+    test_aimd()
+    print("\nAll tests completed!")
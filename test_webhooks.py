@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Test script for completion webhooks against a local stand-in receiver
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import _WebhookDispatcher, _webhook_payload
+
+
+class _Receiver(BaseHTTPRequestHandler):
+    fail_first = 0
+    delay = 0.0
+    received = []
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        cls = _Receiver
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(cls.delay)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with cls.lock:
+            cls.active -= 1
+            cls.received.append((dict(self.headers), body))
+            failing = cls.fail_first > 0
+            cls.fail_first -= 1
+        self.send_response(503 if failing else 204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Receiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/hook"
+
+
+def _reset(fail_first=0, delay=0.0):
+    _Receiver.fail_first, _Receiver.delay = fail_first, delay
+    _Receiver.received, _Receiver.active, _Receiver.max_active = [], 0, 0
+
+
+async def _until(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        await asyncio.sleep(0.05)
+
+
+def test_payload():
+    """Test payload fields built from a finished task"""
+    print("Testing webhook payload...")
+    t = {'status': 'completed', 'video_title': 'Song', 'duration': 200, 'audio_file': 'a.m4a',
+         'audio_files': [{'format': 'm4a', 'quality': 'good', 'filename': 'a.m4a'}],
+         'created_at': 100.0, 'started_at': 101.5, 'finished_at': 110.0}
+    payload = _webhook_payload('t1', t)
+    assert payload['event'] == 'task.completed' and payload['title'] == 'Song'
+    assert payload['file_url'].endswith('/api/download/a.m4a')
+    assert payload['files'][0]['url'] == payload['file_url']
+    assert payload['timings']['queued_seconds'] == 1.5 and payload['timings']['processing_seconds'] == 8.5
+    print("✓ title, duration, file URL and timings present")
+
+
+def test_signed_delivery_with_retry():
+    """Test HMAC signature and exponential-backoff retry on 5xx"""
+    print("\nTesting signed delivery with retry...")
+    server, url = _serve()
+    saved = main.WEBHOOK_SECRET, main.WEBHOOK_BACKOFF_BASE
+    main.WEBHOOK_SECRET, main.WEBHOOK_BACKOFF_BASE = 'sekret', 0.1
+    _reset(fail_first=2)
+
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            dispatcher = _WebhookDispatcher(os.path.join(tmp, 'webhooks.db'))
+            await dispatcher.enqueue('t1', url, {'task_id': 't1', 'status': 'completed'})
+            await _until(lambda: dispatcher.stats() == {})
+            await dispatcher.close()
+
+    try:
+        asyncio.run(run())
+        assert len(_Receiver.received) == 3
+        headers, body = _Receiver.received[-1]
+        assert headers['X-Webhook-Attempt'] == '3' and headers['X-Webhook-Id'] == 't1'
+        ts = headers['X-Webhook-Signature'].split(',')[0][2:]
+        expected = hmac.new(b'sekret', f"{ts}.".encode() + body, hashlib.sha256).hexdigest()
+        assert headers['X-Webhook-Signature'] == f"t={ts},v1={expected}"
+        assert json.loads(body)['status'] == 'completed'
+        print("✓ delivered on 3rd attempt with valid signature")
+    finally:
+        main.WEBHOOK_SECRET, main.WEBHOOK_BACKOFF_BASE = saved
+        server.shutdown()
+
+
+def test_persistence_and_concurrency_cap():
+    """Test that queued webhooks survive a restart and a slow receiver sees capped concurrency"""
+    print("\nTesting persistence and concurrency cap...")
+    server, url = _serve()
+    _reset(delay=0.3)
+
+    async def run(path):
+        # 第一个投递器在送出前就停止，回调留在队列里
+        first = _WebhookDispatcher(path)
+        for i in range(8):
+            await asyncio.to_thread(first.add, f"t{i}", url, {'task_id': f"t{i}"})
+        assert first.stats() == {'pending': 8}
+
+        second = _WebhookDispatcher(path)
+        second.start()
+        await _until(lambda: second.stats() == {})
+        await second.close()
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'webhooks.db')))
+        assert len(_Receiver.received) == 8
+        assert _Receiver.max_active <= main.WEBHOOK_CONCURRENCY, _Receiver.max_active
+        print(f"✓ 8 persisted webhooks delivered after restart, max {_Receiver.max_active} concurrent")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    test_payload()
+    test_signed_delivery_with_retry()
+    test_persistence_and_concurrency_cap()
+    print("\nAll tests completed!")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+分布式 worker：从共享作业队列领取 /api/process 任务并执行
+
+API 节点与 worker 使用相同的 JOB_QUEUE / JOB_QUEUE_PATH 配置，例如：
+    JOB_QUEUE=sqlite uvicorn main:app --port 8000
+    JOB_QUEUE=sqlite python3 worker.py
+"""
+
+import os
+import sys
+import uuid
+import signal
+import socket
+import asyncio
+import time
+
+import main
+
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", main.DOWNLOAD_WORKERS))
+WORKER_POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", 1.0))
+# 心跳间隔需明显短于租约，心跳同时把进度同步到队列
+HEARTBEAT_INTERVAL = max(1.0, main.JOB_LEASE_SECONDS / 3)
+
+
+async def run_job(queue: main.JobQueue, worker_id: str, job: dict) -> None:
+    """执行一个任务，期间定期续租并同步进度。"""
+    task_id = job['task_id']
+    main.TASKS[task_id] = job['task']
+    req = main.ProcessRequest(**job['payload'])
+    work = asyncio.create_task(main._process_task(task_id, req))
+    try:
+        while not work.done():
+            await asyncio.wait({work}, timeout=HEARTBEAT_INTERVAL)
+            if work.done():
+                break
+            alive = await asyncio.to_thread(
+                queue.heartbeat, task_id, worker_id, dict(main.TASKS[task_id]), main.JOB_LEASE_SECONDS
+            )
+            if not alive:
+                # 任务已被取消，或租约已被其他 worker 接管，放弃本次执行
+                print(f"[worker] lease lost or cancelled: {task_id}", file=sys.stderr)
+                work.cancel()
+                await asyncio.gather(work, return_exceptions=True)
+                return
+        t = main.TASKS[task_id]
+        if t.get('status') == 'pending' and t.get('retry_at'):
+            # 可重试的失败：延迟重新入队，退避期间本 worker 去领取别的任务
+            try:
+                await asyncio.to_thread(queue.retry, task_id, worker_id, dict(t), t['retry_at'])
+                return
+            except NotImplementedError:
+                t.update(status='failed', message='failed', retry_at=None, finished_at=time.time())
+        await asyncio.to_thread(queue.finish, task_id, worker_id, dict(main.TASKS[task_id]))
+    except asyncio.CancelledError:
+        # 关停宽限期已过：中断任务并交还队列，已下载的部分留给下一次领取续传
+        work.cancel()
+        await asyncio.gather(work, return_exceptions=True)
+        try:
+            await asyncio.to_thread(queue.release, task_id, worker_id, dict(main.TASKS[task_id]))
+        except NotImplementedError:
+            pass
+        raise
+    finally:
+        main.TASKS.pop(task_id, None)
+
+
+async def serve() -> None:
+    queue = main._job_queue()
+    if queue is None:
+        print("❌ 未配置作业队列，请设置 JOB_QUEUE（如 JOB_QUEUE=sqlite）")
+        return
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    running = set()
+    stopping = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except NotImplementedError:
+            pass
+
+    # 存储配置有误时启动即失败
+    await asyncio.to_thread(main._storage)
+    print(f"🚀 worker {worker_id} 已启动，并发 {WORKER_CONCURRENCY}，队列 {main.JOB_QUEUE}")
+    # 本 worker 完成的任务由自己投递回调，也接手队列里遗留的回调
+    main._webhooks().start()
+    while not stopping.is_set():
+        await slots.acquire()
+        job = await asyncio.to_thread(queue.claim, worker_id, main.JOB_LEASE_SECONDS)
+        if job is None:
+            slots.release()
+            try:
+                await asyncio.wait_for(stopping.wait(), WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        print(f"📥 领取任务 {job['task_id']}（第 {job['attempts']} 次）")
+        t = asyncio.create_task(run_job(queue, worker_id, job))
+        running.add(t)
+        t.add_done_callback(running.discard)
+        t.add_done_callback(lambda _: slots.release())
+
+    # 停止领取新任务，等待手上的任务最多 SHUTDOWN_GRACE_SECONDS 秒；仍未完成的中断后交还队列，
+    # 被强杀的任务则在租约过期后重新投递
+    print("👋 正在停止，等待进行中的任务完成...")
+    main._SHUTTING_DOWN = True
+    if running:
+        _, pending = await asyncio.wait(set(running), timeout=main.SHUTDOWN_GRACE_SECONDS)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            print(f"⏸ {len(pending)} 个未完成的任务已交还队列")
+    await main._shutdown_workers()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())